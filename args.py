@@ -8,6 +8,8 @@ def make_args():
     # general
     parser.add_argument('--dataset_name', dest='dataset_name', default='NTU',
                         type=str, help='RND3SAT DIMACS')
+    parser.add_argument('--benchmark', dest='benchmark', default='xsub', type=str,
+                        help='xsub; xview (comma separated list for the evaluation scripts)')
     parser.add_argument('--dataset_root', dest='dataset_root', default='dataset',
                         type=str, help='RND3SAT DIMACS')
     parser.add_argument('--loss', dest='loss', default='l2', type=str,
@@ -30,7 +32,10 @@ def make_args():
     parser.add_argument('--load_epoch', dest='load_epoch', default=0, type=int,
                         help='whether load_model')
     parser.add_argument('--batch_size', dest='batch_size', default=16,
-                        type=int)  # implemented via accumulating gradient
+                        type=int)  # micro-batch size, see --accum_steps
+    parser.add_argument('--accum_steps', dest='accum_steps', default=1, type=int,
+                        help='micro-batches accumulated per optimizer step '
+                             '(effective batch size: batch_size * accum_steps [* world size])')
     parser.add_argument('--num_enc_layers', dest='num_enc_layers', default=6, type=int)
     parser.add_argument('--num_conv_layers', dest='num_conv_layers', default=3, type=int)
     parser.add_argument('--activation', dest='activation', default='relu', type=str)
@@ -49,13 +54,121 @@ def make_args():
     parser.add_argument('--epoch_save', dest='epoch_save', default=500, type=int)  # save every
     parser.add_argument('--save_root', dest='save_root', default='saved_model', type=str)
     parser.add_argument('--save_name', dest='save_name', default='check_point', type=str)
+    parser.add_argument('--save_interval', dest='save_interval', default=0, type=int,
+                        help='optimizer steps between the mid-epoch checkpoints (0: at the end of the epochs only)')
+    parser.add_argument('--keep_last', dest='keep_last', default=3, type=int,
+                        help='last mid-epoch checkpoints kept in save_root')
+    parser.add_argument('--keep_epochs', dest='keep_epochs', default=0, type=int,
+                        help='last end of epoch checkpoints (save_name_<epoch>.pickle) kept in save_root, 0: all')
+    parser.add_argument('--keep_best', dest='keep_best', default=1, type=int,
+                        help='checkpoints of best validation accuracy kept in save_root')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='resume from the last checkpoint of save_root/save_name.json (mid-epoch if need be)')
     parser.add_argument('--model_dim', dest='model_dim', default=150, type=int)
     parser.add_argument('--log_dir', dest='log_dir', default=osp.join(os.getcwd(), 'logs33'), type=str)
     parser.add_argument('--gradflow_dir', dest='gradflow_dir', default=osp.join(os.getcwd(), 'gradflow33'), type=str)
+    parser.add_argument('--telemetry_interval', dest='telemetry_interval', default=10, type=int,
+                        help='optimizer steps between two snapshots of the gradient norms')
     parser.add_argument('--data_parallel', dest='data_parallel', default=False, type=bool, help='DataParallel')
     parser.add_argument('--cross_k', dest='cross_k', default=1, type=int, help='k value for cros validation')
     parser.add_argument('--alpha', dest='alpha', default=0.01, type=float)
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None, type=str, choices=['layer', 'branch'],
+                        help='recompute the activations of every encoder layer / branch in backward')
+    parser.add_argument('--stream', dest='stream', default='all', type=str,
+                        choices=['all', 'joint', 'bone', 'motion'],
+                        help='input channels the model is trained on: all; joint; bone; motion')
+    parser.add_argument('--streams', dest='streams', default='joint,bone,motion', type=str,
+                        help='comma separated streams of the ensemble, {stream} in save_name is replaced by the stream')
+    parser.add_argument('--stream_weights', dest='stream_weights', default=None, type=str,
+                        help='comma separated weights of the logits of the streams of the ensemble (default: 1)')
+    parser.add_argument('--tta', dest='tta', action='store_true', default=False,
+                        help='test-time augmentation of the test evaluation (views in one batched forward)')
+    parser.add_argument('--tta_windows', dest='tta_windows', default='75,94,112', type=str,
+                        help='comma separated frames of the centered crops of the views, 0 for the whole clip')
+    parser.add_argument('--tta_angles', dest='tta_angles', default='0', type=str,
+                        help='comma separated rotations of the views about the z axis in degrees')
+    parser.add_argument('--hop_bias', dest='hop_bias', action='store_true', default=False,
+                        help='learned per head and hop distance bias of the spatial attentions')
+    parser.add_argument('--max_hops', dest='max_hops', default=3, type=int,
+                        help='hop distances of the hop bias are clipped to max_hops')
+    parser.add_argument('--temporal_attention', dest='temporal_attention', default='linear', type=str,
+                        choices=['linear', 'full'],
+                        help='attention of the temporal layers: linear; full (softmax inside every sequence)')
+    parser.add_argument('--feature_map', dest='feature_map', default='elu', type=str, choices=['elu', 'favor'],
+                        help='feature map of the temporal linear attention: elu; favor (FAVOR+ random features)')
+    parser.add_argument('--nb_features', dest='nb_features', default=None, type=int,
+                        help='number of random features of the favor feature map (default: d * log(d))')
+    parser.add_argument('--redraw_interval', dest='redraw_interval', default=1000, type=int,
+                        help='optimizer steps between two redraws of the favor projections, 0 to never redraw')
+    parser.add_argument('--precision', dest='precision', default='fp32', type=str, choices=['fp32', 'bf16'],
+                        help='fp32; bf16 (autocast of the forward pass)')
     parser.add_argument('--mlp_head_hidden', dest='mlp_head_hidden', default=128, type=int)  # paper used: 2001
+    parser.add_argument('--num_classes', dest='num_classes', default=60, type=int)
+    parser.add_argument('--num_joints', dest='num_joints', default=25, type=int)
+
+    # deployment
+    parser.add_argument('--export_path', dest='export_path', default=osp.join(os.getcwd(), 'deploy', 'dgnn.pt'),
+                        type=str, help='path of the exported TorchScript model')
+    parser.add_argument('--max_frames', dest='max_frames', default=300, type=int,
+                        help='longest sequence supported by the exported model')
+
+    # distributed (train_dist.py)
+    parser.add_argument('--backend', dest='backend', default=None, type=str, choices=['nccl', 'gloo'],
+                        help='process group backend (default: nccl with GPUs, gloo on CPU)')
+    parser.add_argument('--nproc_per_node', dest='nproc_per_node', default=None, type=int,
+                        help='processes per node (default: the number of GPUs, 1 on CPU)')
+    parser.add_argument('--nnodes', dest='nnodes', default=1, type=int)
+    parser.add_argument('--node_rank', dest='node_rank', default=0, type=int)
+    parser.add_argument('--init_method', dest='init_method', default='tcp://localhost:12355', type=str,
+                        help='rendezvous of the processes: tcp://<node 0>:<port> or file:///<shared file>')
+    parser.add_argument('--threads', dest='threads', default=None, type=int,
+                        help='intra-op threads of every CPU process (default: its share of the cores)')
+
+    # hyperparameter sweep (sweep.py)
+    parser.add_argument('--sweep_spec', dest='sweep_spec', default='sweep.json', type=str,
+                        help='json file of the grid / random search, see sweep.make_trials')
+    parser.add_argument('--sweep_dir', dest='sweep_dir', default=osp.join(os.getcwd(), 'sweep'), type=str,
+                        help='checkpoints of the trials and results.csv')
+    parser.add_argument('--sweep_workers', dest='sweep_workers', default=None, type=int,
+                        help='trials run in parallel (default: one per core)')
+    parser.add_argument('--sweep_eta', dest='sweep_eta', default=3, type=int,
+                        help='successive halving: the best 1 / eta trials of a rung go on')
+    parser.add_argument('--sweep_min_epochs', dest='sweep_min_epochs', default=1, type=int,
+                        help='epochs of the first rung of successive halving')
+
+    # operator benchmark (benchmark.py)
+    parser.add_argument('--bench_ops', dest='bench_ops', default=None, type=str,
+                        help='comma separated operators (default: all, see benchmark.CASES)')
+    parser.add_argument('--bench_frames', dest='bench_frames', default='32,128', type=str,
+                        help='comma separated frames per sequence')
+    parser.add_argument('--bench_batch', dest='bench_batch', default='4,16', type=str,
+                        help='comma separated sequences per batch')
+    parser.add_argument('--bench_heads', dest='bench_heads', default='8', type=str,
+                        help='comma separated attention heads')
+    parser.add_argument('--bench_channels', dest='bench_channels', default='64,128', type=str,
+                        help='comma separated model channels')
+    parser.add_argument('--bench_repeats', dest='bench_repeats', default=20, type=int,
+                        help='timed forward / backward passes, the median is reported')
+    parser.add_argument('--bench_warmup', dest='bench_warmup', default=3, type=int)
+    parser.add_argument('--bench_output', dest='bench_output', default='benchmark.json', type=str)
+    parser.add_argument('--bench_baseline', dest='bench_baseline', default=None, type=str,
+                        help='output of a previous run to compare with')
+    parser.add_argument('--bench_tolerance', dest='bench_tolerance', default=0.1, type=float,
+                        help='relative slowdown over the baseline reported as a regression')
+
+    # synthetic raw data (synthetic.py)
+    parser.add_argument('--synthetic_dataset', dest='synthetic_dataset', default='ntu', type=str,
+                        choices=['ntu', 'ntu120', 'kinetics'])
+    parser.add_argument('--synthetic_samples', dest='synthetic_samples', default=1000, type=int)
+    parser.add_argument('--synthetic_out', dest='synthetic_out', default=None, type=str,
+                        help='directory of the raw files (default: dataset_root/raw)')
+    parser.add_argument('--synthetic_workers', dest='synthetic_workers', default=None, type=int,
+                        help='processes writing the files (default: one per core)')
+
+    # cross-validation (crossval.py)
+    parser.add_argument('--crossval_dir', dest='crossval_dir', default=osp.join(os.getcwd(), 'crossval'), type=str,
+                        help='models of the folds and results.csv')
+    parser.add_argument('--seed', dest='seed', default=0, type=int)
 
     parser.set_defaults(gpu=True,
                         batch_size=32,
@@ -0,0 +1,229 @@
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import torch
+
+from args import make_args
+from data.topology import get_topology
+from models.attentions import SparseAttention, LinearAttention, GlobalContextAttention, \
+    SpatialEncoderLayer, TemporalEncoderLayer
+from models.powernorm import MaskPowerNorm
+from utility.linalg import softmax_, spmm_, batched_spmm
+from utility.sequence import SequenceBatch
+
+
+def _randn(*shape, device=None):
+    return torch.randn(*shape, device=device).requires_grad_()
+
+
+# Every case builds (forward, inputs) for a configuration: forward() runs the operator on the
+# synthetic inputs and returns its output, the inputs (and the parameters of the modules) get
+# the gradients of backward. Spatial operators see (frames * batch) skeletons of the joints,
+# temporal ones the joints of (batch) sequences of (frames) frames.
+
+def _sparse_attention(cfg, topology, seq, device):
+    f, n, h, e = seq.batch.shape[0], topology.num_joints, cfg['heads'], cfg['channels'] // cfg['heads']
+    module = SparseAttention(e, attention_dropout=0., heads=h).to(device)
+    q, k, v = (_randn(f, n, h, e, device=device) for _ in range(3))
+    return lambda: module(q, k, v, topology.edge_index), [q, k, v]
+
+
+def _linear_attention(cfg, topology, seq, device, bi=False):
+    f, n, h, e = seq.batch.shape[0], topology.num_joints, cfg['heads'], cfg['channels'] // cfg['heads']
+    module = LinearAttention(e, attention_dropout=0.).to(device)
+    q, k, v = (_randn(n, f, h, e, device=device) for _ in range(3))
+    return lambda: module(q, k, v, seq if bi else None), [q, k, v]
+
+
+def _mask_power_norm(cfg, topology, seq, device):
+    module = MaskPowerNorm(cfg['channels'], group_num=cfg['heads']).to(device)
+    x = _randn(seq.batch.shape[0], topology.num_joints, cfg['channels'], device=device)
+    return lambda: module(x), [x]
+
+
+def _softmax(cfg, topology, seq, device):
+    src = _randn(seq.batch.shape[0], topology.num_edges, cfg['heads'], device=device)
+    return lambda: softmax_(src, topology.edge_index[0], num_nodes=topology.num_joints), [src]
+
+
+def _spmm(cfg, topology, seq, device):
+    f, n, h = seq.batch.shape[0], topology.num_joints, cfg['heads']
+    nz = _randn(f, topology.num_edges, h, device=device)
+    dense = _randn(f, n, h, cfg['channels'] // h, device=device)
+    return lambda: spmm_(topology.edge_index, nz, n, n, dense), [nz, dense]
+
+
+def _batched_spmm(cfg, topology, seq, device):
+    f, n, h = seq.batch.shape[0], topology.num_joints, cfg['heads']
+    nzt = _randn(f, topology.num_edges, h, device=device)
+    x = _randn(f, n, cfg['channels'] // h, device=device)
+    return lambda: batched_spmm(nzt, topology.edge_index, x, n, n), [nzt, x]
+
+
+def _global_context_attention(cfg, topology, seq, device):
+    module = GlobalContextAttention(cfg['channels']).to(device)
+    x = _randn(topology.num_joints, seq.batch.shape[0], cfg['channels'], device=device)
+    return lambda: module(x, seq), [x]
+
+
+def _spatial_encoder_layer(cfg, topology, seq, device):
+    module = SpatialEncoderLayer(cfg['channels'], cfg['channels'], cfg['heads'], dropout=[0.] * 4).to(device)
+    x = _randn(seq.batch.shape[0], topology.num_joints, cfg['channels'], device=device)
+    return lambda: module(x, topology.edge_index), [x]
+
+
+def _temporal_encoder_layer(cfg, topology, seq, device):
+    module = TemporalEncoderLayer(cfg['channels'], cfg['channels'], cfg['heads'], dropout=[0.] * 4).to(device)
+    x = _randn(topology.num_joints, seq.batch.shape[0], cfg['channels'], device=device)
+    return lambda: module(x, seq), [x]
+
+
+CASES = {
+    'sparse_attention': _sparse_attention,
+    'linear_attention': _linear_attention,
+    'linear_attention_bi': lambda *a: _linear_attention(*a, bi=True),
+    'mask_power_norm': _mask_power_norm,
+    'softmax_': _softmax,
+    'spmm_': _spmm,
+    'batched_spmm': _batched_spmm,
+    'global_context_attention': _global_context_attention,
+    'spatial_encoder_layer': _spatial_encoder_layer,
+    'temporal_encoder_layer': _temporal_encoder_layer,
+}
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(forward, inputs, device, repeats=20, warmup=3):
+    """median forward and backward times (ms), bytes of the tensors saved for backward and, on
+    CUDA, the peak allocated bytes of a step"""
+    saved = [0]
+
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    forward_times, backward_times = [], []
+    for i in range(warmup + repeats):
+        for t in inputs:
+            t.grad = None
+        if i == warmup and device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        saved[0] = 0
+        _sync(device)
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = forward()
+        _sync(device)
+        middle = time.perf_counter()
+        out.backward(torch.ones_like(out))
+        _sync(device)
+        end = time.perf_counter()
+        if i >= warmup:
+            forward_times.append((middle - start) * 1e3)
+            backward_times.append((end - middle) * 1e3)
+    return {'forward_ms': sorted(forward_times)[repeats // 2],
+            'backward_ms': sorted(backward_times)[repeats // 2],
+            'saved_mb': saved[0] / 2 ** 20,
+            'peak_mb': torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else None}
+
+
+def _key(result):
+    return result['op'], result['frames'], result['batch'], result['heads'], result['channels']
+
+
+def compare(results, baseline, tolerance):
+    """prints the times relative to the baseline, returns the results slower by more than
+    ``tolerance`` (forward or backward)"""
+    base = {_key(r): r for r in baseline['results']}
+    regressions = []
+    print('\n%-26s %6s %5s %5s %8s %14s %14s' % ('op', 'frames', 'batch', 'heads', 'channels',
+                                                 'forward x', 'backward x'))
+    for r in results:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        fwd, bwd = r['forward_ms'] / b['forward_ms'], r['backward_ms'] / b['backward_ms']
+        slower = max(fwd, bwd) > 1. + tolerance
+        if slower:
+            regressions.append(r)
+        print('%-26s %6d %5d %5d %8d %14.2f %14.2f%s' % (_key(r) + (fwd, bwd, '  <-' if slower else '')))
+    return regressions
+
+
+def _meta(device):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'device': str(device) if device.type == 'cpu' else torch.cuda.get_device_name(device),
+            'threads': torch.get_num_threads(),
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main():
+    """Forward / backward times and memory of the operators of the model on synthetic inputs,
+    for every combination of ``--bench_frames``, ``--bench_batch``, ``--bench_heads`` and
+    ``--bench_channels`` (comma separated), e.g.::
+
+        python benchmark.py --threads 8 --bench_output after.json --bench_baseline before.json
+
+    The results (and the machine, torch version, threads and commit) are written to
+    ``--bench_output``. With ``--bench_baseline`` (a previous output), the times are compared
+    and the exit status is 1 if one is slower by more than ``--bench_tolerance``.
+    """
+    args = make_args()
+    device = torch.device('cuda:0') if args.use_gpu and torch.cuda.is_available() else torch.device('cpu')
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    topology = get_topology(args.dataset_name, device=device)
+    ops = args.bench_ops.split(',') if args.bench_ops else list(CASES)
+    grid = itertools.product(*[[int(v) for v in values.split(',')] for values in
+                               (args.bench_frames, args.bench_batch, args.bench_heads, args.bench_channels)])
+
+    results = []
+    print('%-26s %6s %5s %5s %8s %11s %11s %9s' % ('op', 'frames', 'batch', 'heads', 'channels',
+                                                   'forward ms', 'backward ms', 'saved MB'))
+    for frames, batch, heads, channels in grid:
+        if channels % heads != 0:
+            continue
+        cfg = {'frames': frames, 'batch': batch, 'heads': heads, 'channels': channels}
+        seq = SequenceBatch.from_lengths(torch.full((batch,), frames, dtype=torch.long)).to(device)
+        for op in ops:
+            torch.manual_seed(args.seed)
+            forward, inputs = CASES[op](cfg, topology, seq, device)
+            result = dict(op=op, **cfg)
+            result.update(measure(forward, inputs, device, args.bench_repeats, args.bench_warmup))
+            results.append(result)
+            print('%-26s %6d %5d %5d %8d %11.3f %11.3f %9.2f' % (_key(result) + (
+                result['forward_ms'], result['backward_ms'], result['saved_mb'])))
+
+    with open(args.bench_output, 'w') as f:
+        json.dump({'meta': _meta(device), 'results': results}, f, indent=1)
+
+    if args.bench_baseline:
+        with open(args.bench_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.bench_tolerance)
+        print('\nbaseline: %s (%s threads)' % (baseline['meta']['commit'], baseline['meta']['threads']))
+        if regressions:
+            print('%d slower than the baseline by more than %d%%' % (len(regressions), args.bench_tolerance * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
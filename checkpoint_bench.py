@@ -0,0 +1,84 @@
+import time
+
+import torch
+
+from args import make_args
+from data.dataset3 import skeleton_parts, skeleton_hops, skeleton_edge_hops
+from models.net2s import DualGraphEncoder
+from optimizer import LabelSmoothingCrossEntropy
+from utility.helper import autocast
+from utility.sequence import SequenceBatch
+
+
+def train_step(model, x, adj, seq, label, loss_compute, precision, hops=None):
+    """one forward / backward, returns the bytes of the tensors saved for backward"""
+    saved = [0]
+
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        with autocast(x.device, precision):
+            out = model(x, adj=adj, bi=seq, hops=hops)
+        loss = loss_compute(out.float(), label)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return saved[0]
+
+
+def main():
+    """Memory / step time trade-off of the activation checkpointing modes of DualGraphEncoder
+    on synthetic clips (``--batch_size`` clips of ``--max_frames`` frames).
+
+    The activation memory is the size of the tensors saved for backward by the forward pass
+    (the recomputed ones are not saved), on CUDA the peak allocated memory is reported too.
+    """
+    args = make_args()
+    device = torch.device('cuda:0') if args.use_gpu and torch.cuda.is_available() else torch.device('cpu')
+    adj = skeleton_parts(dataset=args.dataset_name)[0].to(device)
+    hops = skeleton_edge_hops(args.dataset_name, args.max_hops, device) if args.hop_bias else None
+
+    lengths = torch.full((args.batch_size,), args.max_frames, dtype=torch.long)
+    seq = SequenceBatch.from_lengths(lengths).to(device)
+    x = torch.randn(int(lengths.sum()), 25, args.in_channels, device=device)
+    label = torch.randint(60, (args.batch_size,), device=device)
+    loss_compute = LabelSmoothingCrossEntropy().to(device)
+
+    print('%-8s %16s %14s %14s' % ('mode', 'activations MB', 'peak MB', 'step ms'))
+    for mode in (None, 'branch', 'layer'):
+        torch.manual_seed(0)
+        model = DualGraphEncoder(in_channels=args.in_channels,
+                                 hidden_channels=args.hid_channels,
+                                 out_channels=args.out_channels,
+                                 mlp_head_hidden=args.mlp_head_hidden,
+                                 num_layers=args.num_enc_layers,
+                                 num_heads=args.heads,
+                                 sequential=False,
+                                 num_conv_layers=args.num_conv_layers,
+                                 drop_rate=args.drop_rate,
+                                 checkpoint=mode,
+                                 feature_map=args.feature_map,
+                                 nb_features=args.nb_features,
+                                 redraw_interval=args.redraw_interval,
+                                 temporal_attention=args.temporal_attention,
+                                 hop_table=skeleton_hops(args.dataset_name, args.dataset_root) if args.hop_bias else None,
+                                 max_hops=args.max_hops).to(device)
+        model.train()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for i in range(6):
+            start = time.perf_counter()
+            saved = train_step(model, x, adj, seq, label, loss_compute, args.precision, hops)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i > 0:  # warmup
+                times.append((time.perf_counter() - start) * 1e3)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else float('nan')
+        print('%-8s %16.1f %14.1f %14.1f' % (mode or 'none', saved / 2 ** 20, peak, sorted(times)[len(times) // 2]))
+
+
+if __name__ == "__main__":
+    main()
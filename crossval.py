@@ -0,0 +1,160 @@
+import csv
+import os
+import os.path as osp
+import random
+import statistics
+import time
+from collections import Counter
+
+import torch
+import torch.multiprocessing as mp
+
+from args import make_args
+from data.dataset3 import SkeletonDataset
+from data.shared import SharedSkeletonData
+from data.topology import get_topology
+from models.ensemble import stream_input
+from models.kernels import redraw_on_step
+from models.powernorm import scale_warmup
+from optimizer import SGD_AGC, LabelSmoothingCrossEntropy
+from sweep import build_model
+from utility.helper import GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
+
+# state of the processes of the pool, set by _init_worker
+_worker = {}
+
+
+def subject_folds(subjects, k, seed=0):
+    """Splits the samples into ``k`` folds without a subject in two folds, of about the same
+    number of samples (the subjects, most samples first, go to the smallest fold).
+
+    :param subjects: subject of every sample, e.g. SkeletonDataset.subjects()
+    :return: k lists of sample indices
+    """
+    counts = Counter(subjects)
+    if len(counts) < k:
+        raise ValueError('{} subjects for {} folds'.format(len(counts), k))
+    order = sorted(counts)
+    random.Random(seed).shuffle(order)  # ties broken by the seed
+    order.sort(key=lambda s: -counts[s])
+    sizes = [0] * k
+    fold_of = {}
+    for subject in order:
+        fold = sizes.index(min(sizes))
+        fold_of[subject] = fold
+        sizes[fold] += counts[subject]
+    folds = [[] for _ in range(k)]
+    for i, subject in enumerate(subjects):
+        folds[fold_of[subject]].append(i)
+    return folds
+
+
+def _init_worker(dataset, cores, threads):
+    """pins the worker to its slice of the cores, keeps the handle of the shared dataset"""
+    slot = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, slot)
+    torch.set_num_threads(threads or len(slot))
+    _worker.update(dataset=dataset)
+
+
+def run_fold(fold, train_idx, valid_idx, args, path):
+    """Trains on ``train_idx`` for args.epoch_num epochs, validating on ``valid_idx`` after
+    every epoch, and returns the metrics of the fold (on the worker of the pool)"""
+    torch.manual_seed(args.seed + fold)
+    device = torch.device('cpu')
+    adj = get_topology(args.dataset_name).edge_index
+    model = scale_warmup(build_model(args), args.accum_steps).to(device)
+    optimizer = SGD_AGC(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+    redraw_on_step(model, optimizer)
+    lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=0.97)
+    loss_compute = LabelSmoothingCrossEntropy()
+
+    dataset = _worker['dataset']
+    train_loader = SequenceDataLoader(dataset[train_idx], batch_size=args.batch_size, shuffle=True)
+    valid_loader = SequenceDataLoader(dataset[valid_idx], batch_size=args.batch_size)
+    start = time.time()
+    best = 0.
+    for epoch in range(args.epoch_num):
+        model.train()
+        accumulator = GradientAccumulator(model, args.accum_steps, len(train_loader))
+        for i, (batch, seq) in enumerate(train_loader):
+            if i % args.accum_steps == 0:
+                optimizer.zero_grad()
+            out = model(stream_input(batch.x, args.stream), adj=adj, bi=seq)
+            accumulator.scale(loss_compute(out, batch.y.long()), i).backward()
+            if accumulator.is_step(i):
+                optimizer.step()
+        lr_scheduler.step()
+
+        model.eval()
+        metrics = RunningMetrics(topk=(1, 5))
+        with torch.no_grad():
+            for batch, seq in valid_loader:
+                out = model(stream_input(batch.x, args.stream), adj=adj, bi=seq)
+                metrics.update(loss_compute(out, batch.y.long()), out, batch.y)
+        result = metrics.compute()
+        best = max(best, result['accuracy'])
+        print('fold %d epoch %d: loss %.3f; accuracy %.3f' % (fold, epoch + 1, result['loss'], result['accuracy']))
+
+    torch.save({'epoch': args.epoch_num,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'loss': result['loss']}, path)
+    return {'fold': fold, 'train_samples': len(train_idx), 'valid_samples': len(valid_idx),
+            'accuracy': result['accuracy'], 'top5': result['top5'], 'loss': result['loss'],
+            'best_accuracy': best, 'train_time': time.time() - start}
+
+
+def write_results(path, results):
+    """one row per fold, then the mean and the standard deviation over the folds"""
+    names = ['accuracy', 'top5', 'best_accuracy', 'loss', 'train_time']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['fold', 'train_samples', 'valid_samples'] + names)
+        for r in results:
+            writer.writerow([r['fold'], r['train_samples'], r['valid_samples']] + [r[n] for n in names])
+        columns = [[r[n] for r in results] for n in names]
+        writer.writerow(['mean', '', ''] + [statistics.mean(c) for c in columns])
+        writer.writerow(['std', '', ''] + [statistics.stdev(c) if len(c) > 1 else 0. for c in columns])
+
+
+def main():
+    """Subject-disjoint ``--cross_k``-fold cross-validation on the training set.
+
+    The folds are trained at the same time in a pool of processes (at most one per fold) with
+    their own slice of the cores, all reading the same shared memory copy of the dataset. The
+    metrics of every fold and their mean / std are written to crossval_dir/results.csv, the
+    models to crossval_dir/fold_<k>.pickle.
+    """
+    args = make_args()
+    os.makedirs(args.crossval_dir, exist_ok=True)
+
+    dataset = SkeletonDataset(args.dataset_root, name='ntu_60',
+                              use_motion_vector=False,
+                              benchmark=args.benchmark, sample='train')
+    folds = subject_folds(dataset.subjects(), args.cross_k, args.seed)
+    dataset = SharedSkeletonData.from_dataset(dataset)
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    num_workers = min(args.cross_k, len(cores))
+    share = len(cores) // num_workers
+    ctx = mp.get_context('spawn')
+    slots = ctx.Queue()
+    for w in range(num_workers):
+        slots.put(cores[w * share:(w + 1) * share])
+
+    jobs = [(k, [i for j, fold in enumerate(folds) if j != k for i in fold], folds[k], args,
+             osp.join(args.crossval_dir, 'fold_%d.pickle' % k)) for k in range(args.cross_k)]
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(dataset, slots, args.threads)) as pool:
+        results = pool.starmap(run_fold, jobs, chunksize=1)
+    write_results(osp.join(args.crossval_dir, 'results.csv'), results)
+    accuracies = [r['accuracy'] for r in results]
+    print('%d-fold accuracy: %.2f +- %.2f' % (args.cross_k, statistics.mean(accuracies),
+                                             statistics.stdev(accuracies) if len(accuracies) > 1 else 0.))
+
+
+if __name__ == '__main__':
+    main()
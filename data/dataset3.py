@@ -11,6 +11,8 @@ from torch_geometric.data import Dataset, Data
 from torch_sparse import spspmm
 from tqdm import tqdm
 import random
+from utility.tree import hop_table
+from .topology import get_topology, topology_name
 from .sample_tools import random_choose, random_move
 
 torch.multiprocessing.set_sharing_strategy('file_system')
@@ -30,7 +32,7 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 
 
 def gen_bone_data(torch_data, adj):
-    bone_data = torch.zeros(torch_data.shape).to(torch_data.device)
+    bone_data = torch.zeros_like(torch_data)
     bone_data[:, 1:, :] = torch_data[:, adj[0], :] - torch_data[:, adj[1], :]
     # torch_data = torch.cat((torch_data, bone_data), dim=2)
     return bone_data
@@ -38,7 +40,7 @@ def gen_bone_data(torch_data, adj):
 
 def gen_motion_vector(torch_data):
     f, n = torch_data.shape[:2]
-    t = torch.zeros(f, n, 3)
+    t = torch_data.new_zeros(f, n, 3)
     t[:-1, :, :] = torch_data[1:, :, :3] - torch_data[:-1, :, :3]
     t[f - 1, :, :] = t[f - 2, :, :]
     return t
@@ -186,7 +188,7 @@ def get_nonzero_std(s):
 
 
 def num_processes():
-    return os.cpu_count() - 2
+    return max(os.cpu_count() - 2, 1)
 
 
 # NTU (A + A^2 + A^3)
@@ -205,33 +207,27 @@ def num_processes():
 
 
 def skeleton_parts(num_joints=25, dataset='ntu', cat=True):
-    if ('ntu' in dataset) or ('NTU' in dataset):
-        sk_adj = torch.tensor(
-            [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 21, 22, 23, 24],
-             [1, 20, 20, 2, 20, 4, 5, 6, 20, 8, 9, 10, 0, 12, 13, 14, 0, 16, 17, 18, 22, 7, 24, 11]])
-    elif 'kinetics' in dataset:
-        sk_adj = torch.tensor(
-            [[0, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17],
-             [1, 1, 2, 3, 1, 5, 6, 2, 8, 9, 5, 11, 12, 0, 0, 14, 15]]
-        )
-    else:
+    """bones of the skeleton of ``dataset`` and, if ``cat``, the pairs of joints at most 3 hops
+    apart (the edges of A + A^2 + A^3, without duplicates), see data.topology"""
+    if topology_name(dataset) is None:
         return None
-
+    topology = get_topology(dataset, num_hops=3)
     if not cat:
-        return sk_adj
+        return topology.skeleton
+    return topology.edge_index, topology.skeleton
 
-    sk_adj_undirected = torch.cat((sk_adj, torch.stack([sk_adj[1], sk_adj[0]])), dim=1)
-    _, idx = sk_adj_undirected[0].sort()
-    sk_adj_undirected = sk_adj_undirected[:, idx]
 
-    cat_adj = torch.cat([sk_adj_undirected,
-                         power_adj(sk_adj_undirected, max(num_joints, max(sk_adj_undirected[1]) + 1), 2),
-                         power_adj(sk_adj_undirected, max(num_joints, max(sk_adj_undirected[1]) + 1), 3)], dim=1)
+def skeleton_hops(dataset='ntu', cache_dir=None):
+    """hop distances between the joints of the skeleton of ``dataset`` (utility.tree.hop_table)"""
+    sk_adj = skeleton_parts(dataset=dataset, cat=False)
+    return hop_table(sk_adj, cache_dir=cache_dir)
 
-    _, idx = cat_adj[0].sort()
-    cat_adj = cat_adj[:, idx]
 
-    return cat_adj, sk_adj
+def skeleton_edge_hops(dataset='ntu', max_hops=3, device=None):
+    """hop distance (up to ``max_hops``) of every edge of skeleton_parts, the ``hops`` of the
+    models with the hop bias, from the cached data.topology registry"""
+    topology = get_topology(dataset, num_hops=3, device=device)
+    return topology.hop.clamp(max=max_hops) if max_hops < topology.num_hops else topology.hop
 
 
 def power_adj(adj, dim, p):
@@ -498,12 +494,12 @@ class SkeletonDataset(Dataset, ABC):
 
         return data
 
-    def process(self):
+    def select_samples(self):
+        """raw files (and labels) of the benchmark and sample of the dataset, in the order of the
+        processed samples"""
         sample_name = []
         sample_label = []
 
-        sparse_data_list = []
-
         if 'ntu' in self.name:
             is_training = False
             if self.missing_skeleton_path is not None:
@@ -538,6 +534,28 @@ class SkeletonDataset(Dataset, ABC):
                     sample_label.append(action_class - 1)
         else:
             sample_name = self.raw_file_names
+        return sample_name, sample_label
+
+    @property
+    def sample_names_file(self):
+        return osp.join(self.processed_dir, '{}_{}_{}_names.txt'.format(self.benchmark, self.sample, self.name))
+
+    def subjects(self):
+        """subject of every sample (ntu), from the file names of the processed samples (or of
+        the raw files if the dataset was processed without them)"""
+        if osp.exists(self.sample_names_file):
+            with open(self.sample_names_file) as f:
+                names = [line.strip() for line in f]
+        else:
+            names = [osp.split(file)[-1] for file in self.select_samples()[0]]
+        if len(names) != len(self.data):
+            raise RuntimeError('the raw files do not match the processed samples, process the dataset again')
+        subjects = [resolve_filename(name)[1] for name in names]
+        return [subjects[i] for i in self.indices()]
+
+    def process(self):
+        sparse_data_list = []
+        sample_name, sample_label = self.select_samples()
 
         pool = Pool(processes=num_processes())
 
@@ -570,6 +588,8 @@ class SkeletonDataset(Dataset, ABC):
         if 'ntu' in self.name:
             torch.save(sparse_data_list + noisy_sparse_data_list,
                        osp.join(self.processed_dir, self.processed_file_names))
+            with open(self.sample_names_file, 'w') as f:
+                f.writelines(osp.split(file)[-1] + '\n' for file in sample_name)
 
     def len(self):
         if 'kinetics' in self.name:
@@ -0,0 +1,57 @@
+import torch
+from torch_geometric.data import Dataset, Data
+
+__all__ = ['SharedSkeletonData']
+
+
+class SharedSkeletonData(Dataset):
+    """Read-only skeleton sequences packed in three tensors (the frames of all the sequences
+    one after the other, their offsets and labels) in shared memory.
+
+    Passing it to processes of torch.multiprocessing (e.g. the initargs of a Pool) sends the
+    handles of the shared memory, not the data: all the processes read the same copy.
+
+    :param x: frames of all the sequences     [total_frames, joints, channels]
+    :param offsets: first frame of every sequence and total_frames [num_sequences + 1]
+    :param y: labels                          [num_sequences]
+    """
+
+    def __init__(self, x, offsets, y):
+        self.x = x.share_memory_()
+        self.offsets = offsets.share_memory_()
+        self.y = y.share_memory_()
+        super(SharedSkeletonData, self).__init__(None)
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """packs the Data(x, y) items of ``dataset`` (e.g. a SkeletonDataset)"""
+        items = [dataset[i] for i in range(len(dataset))]
+        lengths = torch.tensor([data.x.shape[0] for data in items], dtype=torch.long)
+        offsets = torch.zeros(len(items) + 1, dtype=torch.long)
+        torch.cumsum(lengths, dim=0, out=offsets[1:])
+        y = torch.tensor([int(data.y) for data in items], dtype=torch.long)
+        return cls(torch.cat([data.x for data in items]), offsets, y)
+
+    def __reduce__(self):
+        # only the tensors (their shared memory handles) and the selected indices are sent
+        return _rebuild, (self.x, self.offsets, self.y, self._indices)
+
+    @property
+    def raw_file_names(self):
+        return []
+
+    @property
+    def processed_file_names(self):
+        return []
+
+    def len(self):
+        return self.y.shape[0]
+
+    def get(self, idx):
+        return Data(x=self.x[self.offsets[idx]:self.offsets[idx + 1]], y=int(self.y[idx]))
+
+
+def _rebuild(x, offsets, y, indices):
+    dataset = SharedSkeletonData(x, offsets, y)
+    dataset._indices = indices
+    return dataset
@@ -0,0 +1,89 @@
+import torch
+
+from utility.tree import hop_table
+
+__all__ = ['SKELETONS', 'Topology', 'get_topology', 'topology_name']
+
+# bones (child, parent) of the skeletons, the joint 0 being the root
+SKELETONS = {
+    'ntu': [[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 21, 22, 23, 24],
+            [1, 20, 20, 2, 20, 4, 5, 6, 20, 8, 9, 10, 0, 12, 13, 14, 0, 16, 17, 18, 22, 7, 24, 11]],
+    'kinetics': [[0, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17],
+                 [1, 1, 2, 3, 1, 5, 6, 2, 8, 9, 5, 11, 12, 0, 0, 14, 15]],
+}
+SKELETONS['ntu120'] = SKELETONS['ntu']
+
+_topologies = {}
+
+
+def topology_name(dataset):
+    """registry key of a dataset name (e.g. 'NTU', 'ntu_60', 'ntu_120', 'kinetics'), None if unknown"""
+    dataset = dataset.lower()
+    if 'kinetics' in dataset:
+        return 'kinetics'
+    if 'ntu' in dataset:
+        return 'ntu120' if '120' in dataset else 'ntu'
+    return None
+
+
+class Topology(object):
+    """k-hop adjacency of a skeleton, without duplicated edges.
+
+    Attributes:
+        skeleton (LongTensor): bones of the skeleton          [2, num_bones]
+        hop_table (LongTensor): hop distance of all the joint pairs [num_joints, num_joints]
+        edge_index (LongTensor): pairs of joints at most num_hops apart (self loops included),
+                                 sorted by row                 [2, num_edges]
+        hop (LongTensor): hop distance of every edge (0 .. num_hops), the hop type id of the
+                          hop bias of the spatial attentions [num_edges]
+        rowptr (LongTensor): CSR pointer of edge_index        [num_joints + 1]
+    """
+
+    def __init__(self, skeleton, hop_table, edge_index, hop, rowptr, num_hops):
+        self.skeleton = skeleton
+        self.hop_table = hop_table
+        self.edge_index = edge_index
+        self.hop = hop
+        self.rowptr = rowptr
+        self.num_hops = num_hops
+        self.num_joints = hop_table.shape[0]
+        self._devices = {}
+
+    @classmethod
+    def from_skeleton(cls, skeleton, num_joints=None, num_hops=3):
+        table = hop_table(skeleton, num_nodes=num_joints)
+        edge_index = (table <= num_hops).nonzero().t().contiguous()  # row major, i.e. sorted by row
+        rowptr = torch.zeros(table.shape[0] + 1, dtype=torch.long)
+        torch.cumsum(torch.bincount(edge_index[0], minlength=table.shape[0]), dim=0, out=rowptr[1:])
+        return cls(skeleton, table, edge_index, table[edge_index[0], edge_index[1]], rowptr, num_hops)
+
+    def to(self, device):
+        """copy of the topology on ``device``, made once per device"""
+        device = torch.device(device)
+        if device == self.edge_index.device:
+            return self
+        if device not in self._devices:
+            self._devices[device] = Topology(self.skeleton.to(device), self.hop_table.to(device),
+                                              self.edge_index.to(device), self.hop.to(device),
+                                              self.rowptr.to(device), self.num_hops)
+        return self._devices[device]
+
+    @property
+    def num_edges(self):
+        return self.edge_index.shape[1]
+
+    def __repr__(self):
+        return '{}(num_joints={}, num_hops={}, num_edges={})'.format(
+            self.__class__.__name__, self.num_joints, self.num_hops, self.num_edges)
+
+
+def get_topology(dataset='ntu', num_hops=3, device=None):
+    """:class:`Topology` of the skeleton of ``dataset``, built once per process"""
+    name = topology_name(dataset)
+    if name is None:
+        raise ValueError('unknown skeleton topology: {}'.format(dataset))
+    key = (name, num_hops)
+    if key not in _topologies:
+        _topologies[key] = Topology.from_skeleton(torch.tensor(SKELETONS[name]), num_hops=num_hops)
+    topology = _topologies[key]
+    return topology.to(device) if device is not None else topology
@@ -0,0 +1,96 @@
+import os.path as osp
+import time
+
+import torch
+from tqdm import tqdm
+
+from args import make_args
+from data.dataset3 import SkeletonDataset, skeleton_parts
+from models.ensemble import StreamEnsemble, stream_input, stream_channels
+from models.net2s import DualGraphEncoder
+from utility.helper import load_model_state
+from utility.sequence import SequenceDataLoader
+
+
+@torch.no_grad()
+def evaluate(ensemble, data_loader, adj, device, desc=None):
+    """top-1 accuracy of every stream and of the fused logits in a single pass over the data,
+    and the time spent in the forward of the ensemble"""
+    correct = torch.zeros(len(ensemble.streams) + 1, dtype=torch.long, device=device)
+    total = 0
+    elapsed = 0.
+    for batch, seq in tqdm(data_loader, desc=desc):
+        batch, seq = batch.to(device), seq.to(device)
+        start = time.perf_counter()
+        out = ensemble(batch.x, adj, seq, fuse=False)
+        fused = torch.einsum('s,sbc->bc', ensemble.weights, out)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed += time.perf_counter() - start
+        correct += (torch.cat([out, fused.unsqueeze(0)]).argmax(dim=-1) == batch.y).sum(dim=-1)
+        total += batch.y.shape[0]
+    return (correct.double() / total * 100.).tolist(), elapsed
+
+
+@torch.no_grad()
+def sequential_time(models, streams, data_loader, adj, device, max_batches=20):
+    """time of the forward of the stream models one after the other (the reference)"""
+    elapsed = 0.
+    for i, (batch, seq) in enumerate(data_loader):
+        if i == max_batches:
+            break
+        batch, seq = batch.to(device), seq.to(device)
+        start = time.perf_counter()
+        for model, stream in zip(models, streams):
+            model(stream_input(batch.x, stream), adj, seq)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed += time.perf_counter() - start
+    return elapsed, min(max_batches, len(data_loader))
+
+
+def main():
+    """Evaluates the ensemble of the stream models of ``--streams`` (e.g. ``joint,bone,motion``).
+
+    The checkpoint of every stream is save_root/save_name_<load_epoch>.pickle with ``{stream}``
+    in ``--save_name`` replaced by the stream. The models are stacked and run in a single
+    forward per batch, their logits are fused with ``--stream_weights``.
+    """
+    args = make_args()
+    device = torch.device('cuda:0') if args.use_gpu and torch.cuda.is_available() else torch.device('cpu')
+    adj = skeleton_parts(dataset=args.dataset_name)[0].to(device)
+    streams = args.streams.split(',')
+    weights = [float(w) for w in args.stream_weights.split(',')] if args.stream_weights else None
+
+    models = []
+    for stream in streams:
+        model = DualGraphEncoder(in_channels=stream_channels(stream, args.in_channels),
+                                 hidden_channels=args.hid_channels,
+                                 out_channels=args.out_channels,
+                                 mlp_head_hidden=args.mlp_head_hidden,
+                                 num_layers=args.num_enc_layers,
+                                 num_heads=args.heads,
+                                 sequential=False,
+                                 num_conv_layers=args.num_conv_layers,
+                                 drop_rate=args.drop_rate,
+                                 temporal_attention=args.temporal_attention)
+        model.load_state_dict(load_model_state(osp.join(args.save_root, args.save_name.format(stream=stream) +
+                                                        '_' + str(args.load_epoch) + '.pickle'), device))
+        models.append(model.to(device).eval())
+    ensemble = StreamEnsemble(models, streams, weights).to(device)
+
+    test_ds = SkeletonDataset(args.dataset_root, name='ntu_60',
+                              use_motion_vector=False,
+                              benchmark=args.benchmark, sample='val')
+    test_loader = SequenceDataLoader(test_ds, batch_size=args.batch_size, shuffle=False)
+    accuracy, elapsed = evaluate(ensemble, test_loader, adj, device, desc='ensemble')
+    reference, num_batches = sequential_time(models, streams, test_loader, adj, device)
+
+    for stream, acc in zip(streams + ['fused'], accuracy):
+        print('%-8s %8.2f' % (stream, acc))
+    print('forward per batch: stacked %.2f ms, sequential %.2f ms' %
+          (elapsed / len(test_loader) * 1e3, reference / num_batches * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import os.path as osp
+
+import torch
+
+from args import make_args
+from data.dataset3 import skeleton_parts
+from models.scriptable import ScriptableDualGraphEncoder
+from utility.helper import load_model_state
+
+
+def main():
+    """Exports a trained DualGraphEncoder checkpoint (save_root/save_name_<load_epoch>.pickle)
+    as a frozen and optimized TorchScript module for CPU serving (with the --hop_bias,
+    --feature_map, --nb_features and --temporal_attention of its training):
+
+        model = torch.jit.load(args.export_path)
+        logits = model(frames, lengths)  # frames: (total_frames, joints, channels), lengths: (clips,)
+    """
+    args = make_args()
+    device = torch.device('cpu')
+
+    state_dict = load_model_state(osp.join(args.save_root, args.save_name + '_' + str(args.load_epoch) + '.pickle'),
+                                  device)
+    adj = skeleton_parts(dataset=args.dataset_name)[0].to(device)
+    model = ScriptableDualGraphEncoder(in_channels=args.in_channels,
+                                       hidden_channels=args.hid_channels,
+                                       out_channels=args.out_channels,
+                                       mlp_head_hidden=args.mlp_head_hidden,
+                                       num_layers=args.num_enc_layers,
+                                       adj=adj,
+                                       num_heads=args.heads,
+                                       classes=state_dict['mlp_head.3.weight'].shape[0],
+                                       max_frames=args.max_frames,
+                                       feature_map=args.feature_map,
+                                       nb_features=args.nb_features,
+                                       temporal_attention=args.temporal_attention,
+                                       hop_table=state_dict['hop_table'] if args.hop_bias else None,
+                                       max_hops=args.max_hops)
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    with torch.no_grad():
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(model)))
+
+        # sanity check against the eager model on two random clips
+        lengths = torch.tensor([args.max_frames // 2, args.max_frames // 3])
+        x = torch.randn(int(lengths.sum()), model.num_joints, args.in_channels)
+        diff = (model(x, lengths) - scripted(x, lengths)).abs().max().item()
+    print('max abs difference with the eager model: %.3e' % diff)
+
+    if not osp.exists(osp.dirname(args.export_path)):
+        os.makedirs(osp.dirname(args.export_path))
+    torch.jit.save(scripted, args.export_path)
+    print('exported to', args.export_path)
+
+
+if __name__ == "__main__":
+    main()
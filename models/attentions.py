@@ -7,8 +7,9 @@ from einops import rearrange
 from torch.nn import Linear
 
 from utility.linalg import BatchedMask, softmax_, spmm_
+from utility.sequence import SequenceBatch, sequence_batch
 from fast_transformers.feature_maps import elu_feature_map
-from torch_scatter import scatter_sum, scatter_mean
+from torch_scatter import scatter_sum
 from .powernorm import MaskPowerNorm
 
 
@@ -22,22 +23,30 @@ class SparseAttention(nn.Module):
                  in_channels,
                  softmax_temp=None,
                  # num_adj=1,
-                 attention_dropout=0.1):
+                 attention_dropout=0.1,
+                 heads=None,
+                 max_hops=None):
         """
-        :param heads (int):
+        :param heads (int): number of heads, needed by the hop bias
         :param in_channels (int):
         :param softmax_temp (torch.Tensor): The temperature to use for the softmax attention.
                       (default: 1/sqrt(d_keys) where d_keys is computed at
                       runtime)
         :param attention_dropout (float): The dropout rate to apply to the attention
                            (default: 0.1)
+        :param max_hops (int): if given, a learned bias per head and hop distance (0 .. max_hops)
+                           between the joints of every edge is added to the scores
         """
         super(SparseAttention, self).__init__()
         self.in_channels = in_channels
         self.softmax_temp = softmax_temp
         self.dropout = attention_dropout
+        if max_hops is not None:
+            self.hop_bias = nn.Parameter(torch.zeros(max_hops + 1, heads))
+        else:
+            self.hop_bias = None
 
-    def forward(self, queries, keys, values, adj):
+    def forward(self, queries, keys, values, adj, hops=None):
         """Implements the multi-head softmax attention.
         Arguments
         ---------
@@ -45,6 +54,7 @@ class SparseAttention(nn.Module):
             :param keys: torch.Tensor (N, S, E) The tensor containing the keys
             :param values: torch.Tensor (N, S, D) The tensor containing the values
             :param adj: the adjacency matrix plays role of mask that encodes where each query can attend to
+            :param hops: hop distance between the joints of every edge of adj (for the hop bias)
         """
         # Extract some shapes and compute the temperature
         n, l, h, e = queries.shape  # batch, n_heads, length, depth
@@ -67,8 +77,12 @@ class SparseAttention(nn.Module):
             adj_ = adj_[:, idx]
             qk = qk[idx]"""
 
+        qk = softmax_temp * qk
+        if self.hop_bias is not None and hops is not None:
+            qk = qk + self.hop_bias.index_select(0, hops)  # (num_edges, heads), gathered per edge
+
         # Compute the attention and the weighted average, adj[0] is cols idx in the same row
-        alpha = fn.dropout(softmax_(softmax_temp * qk, adj[0]),
+        alpha = fn.dropout(softmax_(qk, adj[0], num_nodes=l),
                            p=self.dropout,
                            training=self.training)
         # sparse matmul, adj as indices and qk as nonzero
@@ -152,6 +166,37 @@ class FullAttention(nn.Module):  # B * T X V X C
         return v.contiguous()  # , torch.mean(att, dim=0)
 
 
+class BlockFullAttention(nn.Module):
+    """Softmax attention of every frame over the frames of its own sequence. The concatenated
+    sequences are padded to blocks of [B, max_length] so the cost is B * max_length ** 2 instead
+    of total_frames ** 2 for a dense mask over the whole batch.
+
+    Same interface as LinearAttention: queries, keys, values (N, L, H, E) with the frames of
+    all the sequences along L and bi the batch index or SequenceBatch of the frames.
+    """
+
+    def __init__(self, in_channels, softmax_temp=None, attention_dropout=0.1):
+        super(BlockFullAttention, self).__init__()
+        self.in_channels = in_channels
+        self.softmax_temp = softmax_temp
+        self.dropout = nn.Dropout(attention_dropout)
+
+    def forward(self, queries, keys, values, bi=None):
+        n, l, h, e = queries.shape
+        softmax_temp = self.softmax_temp or 1. / math.sqrt(e)
+        seq = sequence_batch(bi)
+        if seq is None:  # a single sequence
+            seq = SequenceBatch.from_lengths(torch.tensor([l], device=queries.device))
+        q, k, v = (seq.pad(x, dim=1) for x in (queries, keys, values))  # N B S H E
+
+        qk = torch.einsum('nblhe, nbshe -> nbhls', q, k).float() * softmax_temp
+        qk = qk.masked_fill(seq.padding_mask[:, None, None, :], float('-inf'))
+        # the padded queries still see the keys of their sequence, no empty row
+        att = torch.softmax(qk, dim=-1).to(values.dtype)
+        out = torch.einsum('nbhls, nbshd -> nblhd', self.dropout(att), v)
+        return seq.unpad(out, dim=1).contiguous()
+
+
 class LinearAttention(nn.Module):
     def __init__(self,
                  in_channels,
@@ -168,29 +213,34 @@ class LinearAttention(nn.Module):
             feature_map(in_channels) if feature_map else
             elu_feature_map(query_dims=in_channels)
         )
+        # drawn once: FavorFeatureMap redraws its own projections, see models.kernels.redraw_on_step
+        self.feature_map.new_feature_map(None)
 
     def forward(self, queries, keys, values, bi=None):
         n, l, h, e = queries.shape  # batch, n_heads, length, depth
         # _, _, s, d = values.shape
         softmax_temp = self.softmax_temp or (e ** -0.25)  # TODO: how to use this?
         (queries, keys) = map(lambda x: x * softmax_temp, (queries, keys))
-        self.feature_map.new_feature_map(queries.device)
         q = self.feature_map.forward_queries(queries)
         k = self.feature_map.forward_keys(keys)
 
         if bi is None:
             kv = torch.einsum("nshd, nshm -> nhmd", k, values)
-            z = 1 / (torch.einsum("nlhd, nhd -> nlh", q, k.sum(dim=1)) + self.eps)
+            # normalizer in float32 under autocast
+            z = 1 / (torch.sum(q.float() * k.float().sum(dim=1, keepdim=True), dim=-1) + self.eps)
             v = torch.einsum("nlhd, nhmd, nlh -> nlhm", q, kv, z)
         else:
+            seq = sequence_batch(bi)
             # change the dimensions of values to (N, H, L, 1, D) and keys to (N, H, L, D, 1)
             q = rearrange(q, 'n l h d -> n h l d')
             k = rearrange(k, 'n l h d -> n h l d')
             kv = torch.matmul(rearrange(k, 'n h l d -> n h l d 1'),
                               rearrange(values, 'n l h d -> n h l 1 d'))  # N H L D1 D2
-            kv = scatter_sum(kv, bi, dim=-3).index_select(dim=-3, index=bi)  # N H (L) D1 D2
-            k_ = scatter_sum(k, bi, dim=-2).index_select(dim=-2, index=bi)
-            z = 1 / torch.sum(q * k_, dim=-1)
+            kv = scatter_sum(kv, seq.batch, dim=-3,
+                             dim_size=seq.num_sequences).index_select(dim=-3, index=seq.batch)  # N H (L) D1 D2
+            k_ = scatter_sum(k.float(), seq.batch, dim=-2,
+                             dim_size=seq.num_sequences).index_select(dim=-2, index=seq.batch)
+            z = 1 / torch.sum(q.float() * k_, dim=-1)  # normalizer in float32 under autocast
             v = torch.matmul(rearrange(q, 'n h l d -> n h l 1 d'),
                              kv).squeeze(dim=-2) * z.unsqueeze(-1)
         return rearrange(v, 'n h l d -> n l h d').contiguous()
@@ -248,7 +298,11 @@ class SpatialEncoderLayer(nn.Module):
                  mdl_channels=64,
                  heads=8,
                  beta=True,
-                 dropout=None):
+                 dropout=None,
+                 max_hops=None):
+        """
+        :param max_hops: learned per head and hop distance attention bias (see SparseAttention)
+        """
         super(SpatialEncoderLayer, self).__init__()
         self.in_channels = in_channels
         self.mdl_channels = mdl_channels
@@ -265,7 +319,9 @@ class SpatialEncoderLayer(nn.Module):
         self.lin_qkv = Linear(in_channels, mdl_channels * 3, bias=False)
 
         self.multi_head_attn = SparseAttention(in_channels=mdl_channels // heads,
-                                               attention_dropout=dropout[1])
+                                               attention_dropout=dropout[1],
+                                               heads=heads,
+                                               max_hops=max_hops)
 
         self.add_norm_att = AddNorm(self.mdl_channels, False, self.dropout[2], self.heads)
         self.add_norm_ffn = AddNorm(self.mdl_channels, False, self.dropout[2], self.heads)
@@ -279,7 +335,7 @@ class SpatialEncoderLayer(nn.Module):
         self.add_norm_ffn.reset_parameters()
         self.ffn.reset_parameters()
 
-    def forward(self, x, adj=None):
+    def forward(self, x, adj=None, hops=None):
         f, n, c = x.shape
         query, key, value = self.lin_qkv(x).chunk(3, dim=-1)
 
@@ -293,7 +349,7 @@ class SpatialEncoderLayer(nn.Module):
         key = rearrange(key, 'f n(h c) -> f n h c', h=self.heads)
         value = rearrange(value, 'f n (h c) -> f n h c', h=self.heads)
 
-        t = self.multi_head_attn(query, key, value, adj)
+        t = self.multi_head_attn(query, key, value, adj, hops)
         t = rearrange(t, 'f n h c -> f n (h c)', h=self.heads)
 
         x = self.add_norm_att(x, t)
@@ -312,14 +368,16 @@ class GlobalContextAttention(nn.Module):
     def forward(self, x, batch_index):
         """
         :param x: tensor(joints, frames, channels)
-        :param batch_index: batch index
+        :param batch_index: batch index or SequenceBatch
         :return: reduced tensor
         """
+        seq = sequence_batch(batch_index)
+        lengths = seq.lengths.to(x.dtype).unsqueeze(-1)
         # Global context
-        gc = torch.matmul(scatter_mean(x, batch_index, dim=1), self.weights)
-        gc = torch.tanh(gc)[..., batch_index, :]  # extended according to batch index
+        gc = torch.matmul(scatter_sum(x, seq.batch, dim=1, dim_size=seq.num_sequences) / lengths, self.weights)
+        gc = torch.tanh(gc).index_select(-2, seq.batch)  # extended according to batch index
         gc_ = torch.sigmoid(torch.sum(torch.mul(x, gc), dim=-1, keepdim=True))
-        return scatter_mean(gc_ * x, index=batch_index, dim=1)
+        return scatter_sum(gc_ * x, index=seq.batch, dim=1, dim_size=seq.num_sequences) / lengths
 
 
 class SpatialFullEncoderLayer(nn.Module):
@@ -382,7 +440,14 @@ class TemporalEncoderLayer(nn.Module):
                  mdl_channels=64,
                  heads=8,
                  beta=False,
-                 dropout=0.1):
+                 dropout=0.1,
+                 feature_map=None,
+                 attention='linear'):
+        """
+        :param feature_map: factory of the feature map of the linear attention, called with the
+                            channels per head (default: elu feature map)
+        :param attention: 'linear' or 'full' (softmax attention inside every sequence)
+        """
         super(TemporalEncoderLayer, self).__init__()
         self.in_channels = in_channels
         self.mdl_channels = mdl_channels
@@ -395,8 +460,13 @@ class TemporalEncoderLayer(nn.Module):
 
         self.lin_qkv = Linear(in_channels, mdl_channels * 3, bias=False)
 
-        self.multi_head_attn = LinearAttention(in_channels=mdl_channels // heads,
-                                               attention_dropout=self.dropout[0])
+        if attention == 'full':
+            self.multi_head_attn = BlockFullAttention(in_channels=mdl_channels // heads,
+                                                      attention_dropout=self.dropout[0])
+        else:
+            self.multi_head_attn = LinearAttention(in_channels=mdl_channels // heads,
+                                                   feature_map=feature_map,
+                                                   attention_dropout=self.dropout[0])
 
         self.add_norm_att = AddNorm(self.mdl_channels, self.beta, self.dropout[2], self.heads)
         self.add_norm_ffn = AddNorm(self.mdl_channels, False, self.dropout[2], self.heads)
@@ -0,0 +1,204 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch_scatter import scatter_sum
+
+from utility.sequence import SequenceBatch, sequence_batch
+from .attentions import GlobalContextAttention
+from .powernorm import MaskPowerNorm
+
+__all__ = ['STREAM_CHANNELS', 'stream_input', 'stream_channels', 'stack_models', 'StreamEnsemble',
+           'StreamwiseLinear', 'StreamwiseAffine', 'StreamwisePowerNorm']
+
+# channels of the joint, bone and motion streams in the 9-channel input of SkeletonDataset
+STREAM_CHANNELS = {'joint': (0, 3), 'bone': (3, 6), 'motion': (6, 9)}
+
+
+def stream_input(x, stream='all'):
+    """channels of ``x`` (..., 9) consumed by a stream model"""
+    if stream == 'all':
+        return x
+    start, end = STREAM_CHANNELS[stream]
+    return x[..., start:end]
+
+
+def stream_channels(stream, in_channels=9):
+    """number of input channels of a stream model"""
+    if stream == 'all':
+        return in_channels
+    start, end = STREAM_CHANNELS[stream]
+    return end - start
+
+
+def _streamwise(p, x, dim):
+    """views the per stream vectors ``p`` [S, C] to broadcast over ``x`` whose streams are the
+    dimension ``dim`` and whose channels are the last one"""
+    return p.view(p.shape[:1] + (1,) * (x.dim() - dim - 2) + p.shape[1:])
+
+
+class StreamwiseLinear(nn.Module):
+    """nn.Linear with a separate weight for every stream, the streams being consecutive
+    blocks of the same size along the dimension ``dim`` of the input.
+
+    :param weight: tensor(streams, out_features, in_features)
+    :param bias: tensor(streams, out_features) or None
+    """
+
+    def __init__(self, weight, bias=None, dim=0):
+        super(StreamwiseLinear, self).__init__()
+        self.dim = dim
+        self.weight = nn.Parameter(weight, requires_grad=False)
+        self.bias = nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+    def extra_repr(self):
+        s, o, i = self.weight.shape
+        return 'streams={}, in_features={}, out_features={}, dim={}'.format(s, i, o, self.dim)
+
+    def forward(self, x):
+        num_streams = self.weight.shape[0]
+        # one (rows, in) x (in, out) product per stream
+        x = x.unflatten(self.dim, (num_streams, -1)).movedim(self.dim, 0)
+        shape = x.shape[:-1] + self.weight.shape[1:2]
+        x = x.reshape(num_streams, -1, x.shape[-1])
+        if self.bias is not None:
+            out = torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+        else:
+            out = torch.bmm(x, self.weight.transpose(1, 2))
+        return out.view(shape).movedim(0, self.dim).flatten(self.dim, self.dim + 1)
+
+
+class StreamwiseAffine(nn.Module):
+    """per stream and channel affine transform (e.g. an eval-mode batch norm)"""
+
+    def __init__(self, scale, shift, dim=0):
+        super(StreamwiseAffine, self).__init__()
+        self.dim = dim
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+
+    def forward(self, x):
+        x = x.unflatten(self.dim, (self.scale.shape[0], -1))
+        return torch.addcmul(_streamwise(self.shift, x, self.dim), x,
+                             _streamwise(self.scale, x, self.dim)).flatten(self.dim, self.dim + 1)
+
+
+class StreamwisePowerNorm(StreamwiseAffine):
+    """eval-mode MaskPowerNorm of every stream: group scaling and per stream affine"""
+
+    def __init__(self, gp, scale, shift, dim=0):
+        super(StreamwisePowerNorm, self).__init__(scale, shift, dim)
+        self.gp = gp
+
+    def forward(self, x, pad_mask=None, is_encoder=False):
+        return super(StreamwisePowerNorm, self).forward(self.gp(x))
+
+
+class StreamwiseContextAttention(GlobalContextAttention):
+    """GlobalContextAttention with the weights of every stream, the sequences of the
+    streams being consecutive blocks along the frames"""
+
+    def __init__(self, weights):
+        nn.Module.__init__(self)
+        self.in_channels = weights.shape[-1]
+        self.weights = nn.Parameter(weights, requires_grad=False)
+
+    def forward(self, x, batch_index):
+        seq = sequence_batch(batch_index)
+        lengths = seq.lengths.to(x.dtype).unsqueeze(-1)
+        gc = scatter_sum(x, seq.batch, dim=1, dim_size=seq.num_sequences) / lengths
+        gc = torch.matmul(gc.unflatten(1, (self.weights.shape[0], -1)), self.weights.unsqueeze(0)).flatten(1, 2)
+        gc = torch.tanh(gc).index_select(-2, seq.batch)
+        gc_ = torch.sigmoid(torch.sum(torch.mul(x, gc), dim=-1, keepdim=True))
+        return scatter_sum(gc_ * x, index=seq.batch, dim=1, dim_size=seq.num_sequences) / lengths
+
+
+def _batch_norm_affine(bn):
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps) if bn.affine else torch.rsqrt(bn.running_var + bn.eps)
+    shift = (bn.bias if bn.affine else 0.) - bn.running_mean * scale
+    return scale, shift
+
+
+def _power_norm_affine(norm):
+    scale = norm.weight * torch.rsqrt(norm.running_phi.view(-1) + norm.eps)
+    return scale, norm.bias
+
+
+def stack_models(models):
+    """Merges DualGraphEncoder models of the same architecture (e.g. trained on different
+    streams) into a single eval-only model running all of them in one forward.
+
+    The streams are stacked along the frames: the input holds the frames of every stream one
+    after the other and the batch has one sequence per stream and clip, so the attentions and
+    scatters run once for all the streams. The layers with parameters are replaced by their
+    streamwise versions (one batched matmul for all the streams).
+    """
+    models = [m.module if isinstance(m, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else m
+              for m in models]
+    if any(getattr(m, 'feature_maps', None) for m in models):
+        raise ValueError('the random features of the favor feature map are not supported, use elu')
+    stacked = copy.deepcopy(models[0]).eval()
+    modules = [dict(m.named_modules()) for m in models]
+
+    def stack(fn, name):
+        return [torch.stack(p).detach().clone() for p in zip(*[fn(m[name]) for m in modules])]
+
+    with torch.no_grad():
+        for name, module in list(stacked.named_modules()):
+            # the temporal layers work on (joints, frames, channels), the rest on (frames, ...)
+            dim = 1 if name.startswith('temporal_layers') else 0
+            if isinstance(module, nn.Linear):
+                weight, = stack(lambda m: [m.weight], name)
+                bias = stack(lambda m: [m.bias], name)[0] if module.bias is not None else None
+                new = StreamwiseLinear(weight, bias, dim=dim)
+            elif isinstance(module, nn.BatchNorm1d):
+                new = StreamwiseAffine(*stack(_batch_norm_affine, name), dim=dim)
+            elif isinstance(module, MaskPowerNorm):
+                new = StreamwisePowerNorm(module.gp, *stack(_power_norm_affine, name), dim=dim)
+            elif isinstance(module, GlobalContextAttention):
+                new = StreamwiseContextAttention(*stack(lambda m: [m.weights], name))
+            else:
+                continue
+            parent, _, attr = name.rpartition('.')
+            setattr(stacked.get_submodule(parent), attr, new)
+
+    streamwise = (StreamwiseLinear, StreamwiseAffine, StreamwiseContextAttention)
+    left = [name + '.' + name_ for name, m in stacked.named_modules() if not isinstance(m, streamwise)
+            for name_, _ in m.named_parameters(recurse=False)]
+    if left:
+        raise ValueError('no streamwise version of the parameters of {}'.format(', '.join(left)))
+    return stacked
+
+
+class StreamEnsemble(nn.Module):
+    """Ensemble of stream models (joint / bone / motion, see STREAM_CHANNELS) evaluated in a
+    single forward of their stacked version, the logits are fused with ``weights``.
+
+    :param models: DualGraphEncoder of every stream, same architecture
+    :param streams: stream of every model ('joint', 'bone', 'motion' or 'all')
+    :param weights: weight of the logits of every stream (default: 1)
+    """
+
+    def __init__(self, models, streams, weights=None):
+        super(StreamEnsemble, self).__init__()
+        assert len(models) == len(streams)
+        self.streams = list(streams)
+        self.model = stack_models(models)
+        weights = torch.ones(len(models)) if weights is None else torch.as_tensor(weights, dtype=torch.float)
+        self.register_buffer('weights', weights)
+
+    def forward(self, x, adj, bi, fuse=True):
+        """
+        :param x: tensor(frames, joints, 9), the input of all the streams
+        :param bi: batch index or SequenceBatch of the frames
+        :return: fused logits (sequences, classes), or the logits of every stream
+                 (streams, sequences, classes) if not ``fuse``
+        """
+        seq = sequence_batch(bi)
+        num_streams = len(self.streams)
+        x = torch.cat([stream_input(x, stream) for stream in self.streams], dim=0)
+        stacked = SequenceBatch.from_lengths(seq.lengths.repeat(num_streams))
+        out = self.model(x, adj, stacked).view(num_streams, seq.num_sequences, -1)
+        if not fuse:
+            return out
+        return torch.einsum('s,sbc->bc', self.weights.to(out.dtype), out)
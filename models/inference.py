@@ -0,0 +1,211 @@
+import copy
+
+import torch
+import torch.nn as nn
+from einops import rearrange
+
+from .attentions import AddNorm, FeedForward
+from .layers import WSConv1d, TemporalConv
+from .powernorm import MaskPowerNorm
+
+__all__ = ['optimize_for_inference', 'JointwiseLinear', 'FrozenPowerNorm', 'FoldedAddNorm']
+
+
+class JointwiseLinear(nn.Module):
+    """Linear layer with a separate weight for every joint, i.e. a shared
+    ``nn.Linear`` preceded by a per (joint, channel) affine transform.
+
+    :param weight: tensor(joints, out_channels, in_channels)
+    :param bias: tensor(joints, out_channels)
+    """
+
+    def __init__(self, weight, bias):
+        super(JointwiseLinear, self).__init__()
+        self.weight = nn.Parameter(weight, requires_grad=False)
+        self.bias = nn.Parameter(bias, requires_grad=False)
+
+    def extra_repr(self):
+        n, o, i = self.weight.shape
+        return 'joints={}, in_features={}, out_features={}'.format(n, i, o)
+
+    def forward(self, x):
+        """
+        :param x: tensor(frames, joints, in_channels)
+        :return: tensor(frames, joints, out_channels)
+        """
+        return torch.baddbmm(self.bias.unsqueeze(1), x.transpose(0, 1),
+                             self.weight.transpose(1, 2)).transpose(0, 1)
+
+
+class FrozenPowerNorm(nn.Module):
+    """Eval-mode :class:`MaskPowerNorm`: group scaling followed by the per
+    channel affine of ``running_phi``, ``weight`` and ``bias``, precomputed
+    once. Without ``scale`` and ``shift`` only the group scaling is applied
+    (the affine has been folded into the consumers of the output).
+    """
+
+    def __init__(self, gp, scale=None, shift=None):
+        super(FrozenPowerNorm, self).__init__()
+        self.gp = gp
+        self.register_buffer('scale', scale)
+        self.register_buffer('shift', shift)
+
+    @classmethod
+    def from_power_norm(cls, norm):
+        scale = norm.weight * torch.rsqrt(norm.running_phi.view(-1) + norm.eps)
+        return cls(norm.gp, scale.detach().clone(), norm.bias.detach().clone())
+
+    def forward(self, x, pad_mask=None, is_encoder=False):
+        x = self.gp(x)
+        if self.scale is None:
+            return x
+        return torch.addcmul(self.shift, x, self.scale)
+
+
+class FoldedAddNorm(nn.Module):
+    """Eval-mode :class:`AddNorm` without dropout.
+
+    If ``residual_scale`` is given, the residual input ``x`` is the group
+    scaled (affine-free) output of the previous norm and the affine of that
+    norm is applied here with a single ``addcmul`` (its shift being folded
+    into the bias of the layer producing ``y``).
+    """
+
+    def __init__(self, ln, residual_scale=None):
+        super(FoldedAddNorm, self).__init__()
+        self.ln = ln
+        self.register_buffer('residual_scale', residual_scale)
+
+    def forward(self, x, y):
+        if self.residual_scale is None:
+            return self.ln(y + x)
+        return self.ln(torch.addcmul(y, x, self.residual_scale))
+
+
+def _batch_norm_affine(bn):
+    """scale and shift of an eval-mode batch normalization"""
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+def fold_input_norm(model):
+    """Folds ``model.dn`` (BatchNorm1d over joints * channels) into ``model.lls``."""
+    lls = model.lls
+    scale, shift = _batch_norm_affine(model.dn)
+    n = scale.shape[0] // lls.in_features
+    scale = rearrange(scale, '(n c) -> n 1 c', n=n)
+    shift = rearrange(shift, '(n c) -> n c', n=n)
+    weight = lls.weight.unsqueeze(0) * scale  # n o c
+    bias = torch.matmul(shift, lls.weight.t())  # n o
+    if lls.bias is not None:
+        bias = bias + lls.bias
+    model.dn = nn.Identity()
+    model.lls = JointwiseLinear(weight, bias)
+
+
+def fold_encoder_layer(layer):
+    """Folds the affine of ``add_norm_att`` into the feed forward network.
+
+    ffn(a * u + b) + (a * u + b) == ffn'(u) + a * u with the first linear
+    scaled by ``a`` and ``b`` added to the biases, so the affine of the first
+    norm is never applied to the full tensor. The affine of ``add_norm_ffn``
+    cannot be folded: the outputs of the spatial and temporal branches are
+    summed and fed to both ``lin_qkv`` and the residual of the next layer.
+    """
+    att, ffn = layer.add_norm_att, layer.add_norm_ffn
+    first, last = layer.ffn.net[0], layer.ffn.net[-2]
+    if att.beta or ffn.beta or not isinstance(first, nn.Linear) or not isinstance(last, nn.Linear):
+        return
+
+    norm = FrozenPowerNorm.from_power_norm(att.ln)
+    scale, shift = norm.scale, norm.shift
+    first.bias.data.add_(torch.matmul(first.weight, shift))
+    first.weight.data.mul_(scale)
+    last.bias.data.add_(shift)
+
+    layer.add_norm_att = FoldedAddNorm(FrozenPowerNorm(norm.gp))
+    layer.add_norm_ffn = FoldedAddNorm(FrozenPowerNorm.from_power_norm(ffn.ln), residual_scale=scale)
+
+
+def fold_conv_norm(conv, bn=None):
+    """Returns a plain ``nn.Conv1d`` with the (cached) standardized weight of a
+    :class:`WSConv1d` and, optionally, a following ``BatchNorm1d`` folded in.
+    """
+    if isinstance(conv, WSConv1d):
+        weight = conv.standardize_weight(1e-4)
+    else:
+        weight = conv.weight
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(weight[:, 0, 0])
+    if bn is not None:
+        scale, shift = _batch_norm_affine(bn)
+        weight = weight * scale.view(-1, 1, 1)
+        bias = bias * scale + shift
+    folded = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                       bias=True, padding_mode=conv.padding_mode).to(weight.device)
+    folded.weight.data.copy_(weight)
+    folded.bias.data.copy_(bias)
+    return folded
+
+
+def _strip(module):
+    """Replaces dropout by identities and the remaining norms by their frozen versions."""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, nn.Identity())
+        elif isinstance(child, MaskPowerNorm):
+            setattr(module, name, FrozenPowerNorm.from_power_norm(child))
+        elif isinstance(child, AddNorm) and not child.beta:
+            setattr(module, name, FoldedAddNorm(FrozenPowerNorm.from_power_norm(child.ln)))
+        elif isinstance(child, TemporalConv):
+            child.conv = fold_conv_norm(child.conv, child.bn)
+            child.bn = nn.Identity()
+            child.dropout = nn.Identity()
+        elif isinstance(child, WSConv1d):
+            setattr(module, name, fold_conv_norm(child))
+        else:
+            _strip(child)
+
+
+@torch.no_grad()
+def optimize_for_inference(model, inplace=False):
+    """Returns an eval-only version of ``model`` with the normalization layers
+    folded into the adjacent linear layers:
+
+    * ``dn`` is folded into ``lls`` (one weight per joint),
+    * ``add_norm_att`` of every encoder layer is folded into its feed forward network,
+    * the remaining ``MaskPowerNorm`` use a precomputed scale and shift,
+    * ``WSConv1d`` use their standardized weight (and a following batch norm),
+    * dropout is removed.
+
+    The result is numerically equivalent to ``model.eval()`` up to floating
+    point rounding and must not be trained.
+
+    :param model: DualGraphEncoder (optionally wrapped in DataParallel)
+    :param inplace: modify ``model`` instead of a copy
+    :return: optimized model in eval mode
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+
+    if isinstance(getattr(model, 'dn', None), nn.BatchNorm1d) and isinstance(getattr(model, 'lls', None), nn.Linear):
+        fold_input_norm(model)
+
+    for layers in ('spatial_layers', 'temporal_layers'):
+        for layer in getattr(model, layers, []):
+            if isinstance(getattr(layer, 'add_norm_att', None), AddNorm) and \
+                    isinstance(getattr(layer, 'ffn', None), FeedForward):
+                fold_encoder_layer(layer)
+
+    _strip(model)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model
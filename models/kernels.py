@@ -1,17 +1,18 @@
 import torch
 import math
+import torch.nn as nn
 from einops import rearrange, repeat
 
 
 def orthogonal_matrix_chunks(cols, batch, qr_uniform_q=False, device=None):
     unstructured_block = torch.randn((batch, cols, cols), device=device)
-    q, r = torch.qr(unstructured_block.cpu(), some=True)
+    q, r = torch.linalg.qr(unstructured_block.cpu(), mode='reduced')
     q, r = map(lambda t: t.to(device), (q, r))
     # proposed by @Parskatt
     # to make sure Q is uniform https://arxiv.org/pdf/math-ph/0609050.pdf
     if qr_uniform_q:
         d = torch.diagonal(r, 0, dim1=1, dim2=2)
-        q *= d.unsqueeze(-1).sign()
+        q *= d.sign().unsqueeze(-2)  # columns of Q
     return q.transpose(2, 1)
 
 
@@ -29,7 +30,7 @@ def gaussian_orthogonal_random_matrix(nb_rows, nb_columns, scaling=0, qr_uniform
     else:
         raise ValueError(f'Invalid scaling {scaling}')
 
-    return torch.diag(multiplier) @ final_matrix
+    return multiplier.unsqueeze(-1) * final_matrix
 
 
 def generalized_kernel(data, *,
@@ -53,16 +54,14 @@ def generalized_kernel(data, *,
 
 
 def softmax_kernel(data, *, projection_matrix, is_query, normalize_data=True, eps=1e-4):
-    b, h, *_ = data.shape
-
+    """positive random features of the softmax kernel, for any layout of data (..., d)"""
     data_normalizer = (data.shape[-1] ** -0.25) if normalize_data else 1.
 
     ratio = (projection_matrix.shape[0] ** -0.5)
 
-    projection = repeat(projection_matrix, 'j d -> b h j d', b=b, h=h)
-    projection = projection.type_as(data).to(data.device)
+    projection = projection_matrix.type_as(data).to(data.device)
 
-    data_dash = torch.einsum('...id,...jd->...ij', (data_normalizer * data), projection)
+    data_dash = torch.matmul(data_normalizer * data, projection.t())
 
     diag_data = data ** 2
     diag_data = torch.sum(diag_data, dim=-1)
@@ -78,3 +77,73 @@ def softmax_kernel(data, *, projection_matrix, is_query, normalize_data=True, ep
                 torch.exp(data_dash - diag_data - torch.max(data_dash)) + eps)
 
     return data_dash.type_as(data)
+
+
+class FavorFeatureMap(nn.Module):
+    """FAVOR+ feature map (Performer, https://arxiv.org/abs/2009.14794) approximating the
+    softmax kernel with positive orthogonal random features (uniformly distributed blocks,
+    the raw Q of the QR decomposition biases the estimator). It has the interface of the
+    fast_transformers feature maps used by LinearAttention.
+
+    The projection matrix is a buffer. It is not redrawn in ``new_feature_map`` but by ``step``
+    every ``redraw_interval`` optimizer steps, see :func:`redraw_on_step`.
+
+    :param query_dims: dimension of the queries / keys (per head)
+    :param nb_features: number of random features (default: d * log(d))
+    :param redraw_interval: number of optimizer steps between two redraws, None or 0 to never redraw
+    """
+
+    def __init__(self, query_dims, nb_features=None, redraw_interval=1000, ortho_scaling=0, eps=1e-4):
+        super(FavorFeatureMap, self).__init__()
+        self.query_dims = query_dims
+        self.nb_features = nb_features or int(query_dims * math.log(query_dims))
+        self.redraw_interval = redraw_interval
+        self.ortho_scaling = ortho_scaling
+        self.eps = eps
+        self.steps = 0
+        self.register_buffer('projection', gaussian_orthogonal_random_matrix(self.nb_features, query_dims,
+                                                                             scaling=ortho_scaling,
+                                                                             qr_uniform_q=True))
+
+    def extra_repr(self):
+        return 'query_dims={}, nb_features={}, redraw_interval={}'.format(self.query_dims, self.nb_features,
+                                                                        self.redraw_interval)
+
+    @torch.no_grad()
+    def redraw(self):
+        self.projection.copy_(gaussian_orthogonal_random_matrix(self.nb_features, self.query_dims,
+                                                                scaling=self.ortho_scaling, qr_uniform_q=True,
+                                                                device=self.projection.device))
+
+    def step(self):
+        self.steps += 1
+        if self.redraw_interval and self.steps >= self.redraw_interval:
+            self.redraw()
+            self.steps = 0
+
+    def new_feature_map(self, device):
+        pass
+
+    def forward_queries(self, x):
+        # the inputs are already scaled by LinearAttention
+        return softmax_kernel(x, projection_matrix=self.projection, is_query=True, normalize_data=False,
+                              eps=self.eps)
+
+    def forward_keys(self, x):
+        return softmax_kernel(x, projection_matrix=self.projection, is_query=False, normalize_data=False,
+                              eps=self.eps)
+
+
+def redraw_on_step(model, optimizer):
+    """Advances the redraw counters of the favor feature maps of ``model`` after every step of
+    ``optimizer``: ``redraw_interval`` counts optimizer steps, not forwards (micro-batches of
+    gradient accumulation, VAT forwards). Returns the handle of the hook, None without favor
+    feature maps."""
+    feature_maps = [m for m in model.modules() if isinstance(m, FavorFeatureMap)]
+    if not feature_maps:
+        return None
+
+    def hook(*_):
+        for feature_map in feature_maps:
+            feature_map.step()
+    return optimizer.register_step_post_hook(hook)
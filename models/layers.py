@@ -15,7 +15,9 @@ from torch_geometric.utils import remove_self_loops, add_self_loops
 from torch_scatter import scatter_sum
 from torch_geometric.utils import degree
 
-from utility.linalg import batched_spmm, batched_transpose, softmax_
+from utility.linalg import batched_spmm, batched_transpose, softmax_, relational_adj, relational_self_loops, \
+    relational_softmax, relational_spmm
+from utility.sequence import SequenceBatch
 
 
 def clones(module, k):
@@ -87,38 +89,41 @@ class HGAConv(MessagePassing):
         zeros(self.bias)
 
     @staticmethod
-    def edge_score(adj, a_l, a_r):
+    def edge_score(adj, a_l, a_r, edge_type=None):
         """
         Args:
-            adj: adjacency matrix [2, num_edges] or (heads, [2, num_edges])
+            adj: adjacency matrix [2, num_edges] (of all the heads if edge_type is given)
             a_l: Tensor           [num_nodes, heads]
             a_r: Tensor           [num_nodes, heads]
+            edge_type: Tensor     [num_edges], head of every edge of a relational adjacency
         """
-        if isinstance(adj, Tensor):
-            if len(a_l.shape) == 2:  # [num_edges, heads]
-                return a_l[adj[1], :] + a_r[adj[0], :]
-            else:  # [batch, num_edges, heads]
-                a_l_ = rearrange(a_l, 'b n h -> n (b h)')
-                a_r_ = rearrange(a_r, 'b n h -> n (b h)')
-                out = a_l_[adj[1], :] + a_r_[adj[0], :]
-                return rearrange(out, 'n (b h) -> b n h', h=a_l.shape[-1])
-        a = []
-        for i in range(len(adj)):
-            a[i] = a_l[adj[i][1], i] + a_r[adj[i][0], i]
-        return a  # (heads, [num_edges, 1])
-
-    def _attention(self, adj, score):  # score: [num_edges, heads]
+        if edge_type is not None:  # [(batch,) num_edges], the score of the head of every edge
+            return a_l[..., adj[1], edge_type] + a_r[..., adj[0], edge_type]
+        if len(a_l.shape) == 2:  # [num_edges, heads]
+            return a_l[adj[1], :] + a_r[adj[0], :]
+        else:  # [batch, num_edges, heads]
+            a_l_ = rearrange(a_l, 'b n h -> n (b h)')
+            a_r_ = rearrange(a_r, 'b n h -> n (b h)')
+            out = a_l_[adj[1], :] + a_r_[adj[0], :]
+            return rearrange(out, 'n (b h) -> b n h', h=a_l.shape[-1])
+
+    def _attention(self, adj, score, edge_type=None, num_nodes=None):
+        """score: [num_edges, heads], or [num_edges] with the head of every edge in edge_type"""
         alpha = fn.leaky_relu(score, self.negative_slope)
-        alpha = softmax_(alpha, index=adj[1])  # , num_nodes=alpha.shape[-2])
+        if edge_type is None:
+            alpha = softmax_(alpha, index=adj[1])  # , num_nodes=alpha.shape[-2])
+        else:
+            alpha = relational_softmax(alpha, adj, edge_type, num_nodes, self.heads)
         self._alpha = alpha
         return fn.dropout(alpha, p=self.dropout, training=self.training)
 
-    def message_and_aggregate(self, adj, x, score):
+    def message_and_aggregate(self, adj, x, score, edge_type=None):
         """
         Args:
-            adj:   Tensor or list(Tensor)
+            adj:   Tensor
             x:     Union(Tensor, PairTensor) for bipartite graph
-            score: Tensor or list(Tensor)
+            score: Tensor or pair of Tensor for bipartite graph
+            edge_type: head of every edge of adj (relational adjacency), None if it is shared by the heads
         """
         # for bipartite graph, x_l -> out_ and x_r -> out_l (interleaved)
         x_l, x_r, out_, out_l = None, None, None, None
@@ -132,6 +137,17 @@ class HGAConv(MessagePassing):
             n = x_l.size(0)
             out_l = torch.zeros((m, c2, self.heads))
 
+        if edge_type is not None:  # all the heads at once, out: [(heads m), channels]
+            if x_r is None:
+                alpha = self._attention(adj, score, edge_type, n)
+                return relational_spmm(alpha, adj, edge_type, x_l, m, self.heads)
+            adj_t = torch.stack((adj[1], adj[0]))
+            alpha = self._attention(adj, score[0], edge_type, n)
+            alpha_ = self._attention(adj_t, score[1], edge_type, m)
+            out_ = relational_spmm(alpha, adj, edge_type, x_l, m, self.heads)
+            out_l = relational_spmm(alpha_, adj_t, edge_type, x_r, n, self.heads)
+            return out_l, out_
+
         if isinstance(adj, Tensor):
             if isinstance(score, Tensor):
                 alpha = self._attention(adj, score)  # [num_edges, heads]
@@ -155,19 +171,19 @@ class HGAConv(MessagePassing):
             return out_l, out_
             # return out_l.permute(1, 0, 2), out_.permute(1, 0, 2)
 
-    def propagate(self, adj, size=None, **kwargs):
+    def propagate(self, adj, size=None, edge_type=None, **kwargs):
         # propagate_type: (x: OptPairTensor, alpha: PairTensor)
         size = self.__check_input__(adj, size)
 
         x = kwargs.get('x', Pr.empty)  # OptPairTensor
         alpha = kwargs.get('alpha', Pr.empty)  # PairTensor
-        score = self.edge_score(adj=adj, a_l=alpha[0], a_r=alpha[1])
+        score = self.edge_score(adj=adj, a_l=alpha[0], a_r=alpha[1], edge_type=edge_type)
         if not isinstance(x, Tensor):
             alpha_ = kwargs.get('alpha_', Pr.empty)
-            score_ = self.edge_score(adj=adj, a_l=alpha_[1], a_r=alpha_[0])
+            score_ = self.edge_score(adj=adj, a_l=alpha_[1], a_r=alpha_[0], edge_type=edge_type)
             score = (score, score_)
 
-        out = self.message_and_aggregate(adj, x=x, score=score)
+        out = self.message_and_aggregate(adj, x=x, score=score, edge_type=edge_type)
 
         return self.update(out)
 
@@ -175,7 +191,8 @@ class HGAConv(MessagePassing):
         """
         Args:
             x: Union[Tensor, PairTensor]
-            adj: Tensor[2, num_edges] or list of Tensor
+            adj: Tensor[2, num_edges] shared by the heads, list of one Tensor[2, num_edges_h] per head
+                 or relational adjacency (edge_index, edge_type) as returned by relational_adj
             size: Size
             return_attention_weights (bool, optional): If set to :obj:`True`,
                 will additionally return the tuple
@@ -184,6 +201,12 @@ class HGAConv(MessagePassing):
         """
         h, c = self.heads, self.out_channels
         # assert (not isinstance(adj, Tensor)) and h == len(adj), 'Number of heads is number of adjacency matrices'
+        edge_type = None
+        if isinstance(adj, tuple) and len(adj) == 2 and adj[1].dim() == 1:
+            adj, edge_type = adj
+        elif not isinstance(adj, Tensor):
+            assert h == len(adj), 'Number of heads is number of adjacency matrices'
+            adj, edge_type = relational_adj(adj)
 
         x_l, x_r, alpha_l, alpha_r, alpha_l_, alpha_r_ = None, None, None, None, None, None
 
@@ -217,17 +240,17 @@ class HGAConv(MessagePassing):
             num_nodes = x_l.shape[-2]
             num_nodes = size[1] if size is not None else num_nodes
             num_nodes = x_r.shape[-2] if x_r is not None else num_nodes
-            if isinstance(adj, Tensor):
+            if edge_type is None:
                 adj = self_loop_augment(num_nodes, adj)  # TODO Bug found
             else:
-                for i in range(len(adj)):
-                    adj[i] = self_loop_augment(num_nodes, adj[i])
+                adj, edge_type = relational_self_loops(adj, edge_type, num_nodes, h)
 
         # propagate_type: (x: OptPairTensor, alpha: OptPairTensor)
         _x_ = (x_l, x_r) if x_r is not None else x_l
         _alpha_ = (alpha_l, alpha_r)
         alpha_ = (alpha_l_, alpha_r_)
         out = self.propagate(adj,
+                             edge_type=edge_type,
                              x=_x_,
                              alpha=_alpha_,
                              alpha_=alpha_,
@@ -260,7 +283,7 @@ class HGAConv(MessagePassing):
                 out = (out[0] + self.bias, out[1] + self.bias)
         if isinstance(return_attention_weights, bool):
             assert alpha is not None
-            return out, (adj, alpha)
+            return out, ((adj, edge_type) if edge_type is not None else adj, alpha)
         else:
             return out
 
@@ -457,10 +480,9 @@ class WSConv1d(nn.Conv1d):
 
     def standardize_weight(self, eps):
         var, mean = torch.var_mean(self.weight, dim=(1, 2), keepdims=True)
-        fan_in = torch.prod(torch.tensor(self.weight.shape))
+        fan_in = self.weight.numel()
 
-        scale = torch.rsqrt(torch.max(
-            var * fan_in, torch.tensor(eps).to(var.device))) * self.gain.view_as(var).to(var.device)
+        scale = torch.rsqrt(torch.clamp(var * fan_in, min=eps)) * self.gain.view_as(var)
         shift = mean * scale
         return self.weight * scale - shift
 
@@ -518,14 +540,19 @@ class LayerNorm(torch.nn.Module):
             out = x / (x.std(unbiased=False) + self.eps)
 
         else:
-            batch_size = int(batch.max()) + 1
-            norm = degree(batch, batch_size, dtype=x.dtype).clamp_(min=1)
+            if isinstance(batch, SequenceBatch):
+                batch_size = batch.num_sequences
+                norm = batch.lengths.to(x.dtype).clamp(min=1)
+                batch = batch.batch
+            else:
+                batch_size = int(batch.max()) + 1
+                norm = degree(batch, batch_size, dtype=x.dtype).clamp_(min=1)
             if len(x.shape) == 2:
                 norm = norm.mul_(x.size()[-1]).view(-1, 1)
             else:
                 norm = norm.mul_(x.size()[-1]).view(-1, 1, 1)
 
-            mean = scatter_sum(x, batch, dim=0).sum(dim=-1, keepdim=True) / norm
+            mean = scatter_sum(x, batch, dim=0, dim_size=batch_size).sum(dim=-1, keepdim=True) / norm
             x = x - mean[batch]
             var = scatter_sum(x * x, batch, dim=0, dim_size=batch_size
                               ).sum(dim=-1, keepdim=True)
@@ -6,8 +6,8 @@ import torch.nn as nn
 from einops import rearrange
 
 from models.positional_encoding import SeqPosEncoding
-from .attentions import SpatialEncoderLayer, TemporalEncoderLayer
-from .layers import GlobalContextAttention
+from utility.sequence import sequence_batch
+from .attentions import SpatialEncoderLayer, TemporalEncoderLayer, GlobalContextAttention
 
 
 class DualGraphEncoder(nn.Module, ABC):
@@ -89,7 +89,7 @@ class DualGraphEncoder(nn.Module, ABC):
 
         :param t: tensor
         :param adj: adjacency matrix (sparse)
-        :param bi: batch index
+        :param bi: batch index or SequenceBatch (built once per batch and shared by all layers)
         :return: tensor
         """
         """ if self.sequential:  # sequential architecture
@@ -101,25 +101,26 @@ class DualGraphEncoder(nn.Module, ABC):
                                                     t.shape[1:]) + t),  # residual and add_norm
                               'n b c -> b n c')
         else:  # parallel architecture"""
+        seq = sequence_batch(bi)
         t = self.lls(t)
         c = t.shape[-1]
         t = self.bn(rearrange(t, 'b n c -> b (n c)'))
         # t = rearrange(t, 'b (n c) -> b n c', c=c)
         t = rearrange(t, 'b (n c) -> n b c', c=c)
 
-        t = self.positional_encoding(t, bi)
+        t = self.positional_encoding(t, seq)
         t = rearrange(t, 'n b c -> b n c')
 
         # Core pipeline
         for i in range(self.num_layers):
-            t = self.spatial_layers[i](t, adj, tree_encoding=self.tree_encoding)
+            t = self.spatial_layers[i](t, adj)
             t = rearrange(t, 'f n c -> n f c')
-            t = self.temporal_layers[i](t, bi)
+            t = self.temporal_layers[i](t, seq)
             t = rearrange(t, 'n f c -> f n c')
 
         t = rearrange(t, 'f n c -> n f c')
         # bi_ = bi[:bi.shape[0]:2**self.num_layers]
-        t = rearrange(self.context_attention(t, batch_index=bi),
+        t = rearrange(self.context_attention(t, batch_index=seq),
                       'n f c -> f (n c)')  # bi is the shrunk along the batch index
         t = self.mlp_head(t)
         # return fn.sigmoid(t)  # dimension (b, n, oc)
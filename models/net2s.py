@@ -1,16 +1,20 @@
 from abc import ABC
+from functools import partial
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import global_mean_pool
 # from third_party.performer import SelfAttention
 from einops import rearrange
 
 from models.positional_encoding import SeqPosEncoding
+from utility.sequence import sequence_batch
 from utility.tree import tree_encoding_from_traversal
+from .kernels import FavorFeatureMap
 from .attentions import SpatialEncoderLayer, TemporalEncoderLayer, SpatialFullEncoderLayer, GlobalContextAttention
 from fast_transformers.masking import FullMask
-from .powernorm import MaskPowerNorm
+from .powernorm import MaskPowerNorm, frozen_stats
 
 
 class DualGraphEncoder(nn.Module, ABC):
@@ -26,13 +30,36 @@ class DualGraphEncoder(nn.Module, ABC):
                  drop_rate=None,
                  sequential=True,
                  trainable_factor=False,
-                 num_conv_layers=3):
+                 num_conv_layers=3,
+                 checkpoint=None,
+                 feature_map='elu',
+                 nb_features=None,
+                 redraw_interval=1000,
+                 temporal_attention='linear',
+                 hop_table=None,
+                 max_hops=3):
+        """
+        :param checkpoint: None, 'layer' or 'branch', recompute the activations of every encoder
+                           layer (or of every spatial / temporal branch) in backward instead of
+                           keeping them alive
+        :param feature_map: 'elu' or 'favor', feature map of the temporal linear attention
+        :param nb_features: number of random features of the favor feature map
+        :param redraw_interval: optimizer steps between two redraws of the favor projections (see
+                                models.kernels.redraw_on_step)
+        :param temporal_attention: 'linear' or 'full', attention of the temporal layers
+        :param hop_table: hop distances between the joints (utility.tree.hop_table), if given the
+                          spatial attentions learn a bias per head and hop distance (up to max_hops)
+        """
         super(DualGraphEncoder, self).__init__()
+        assert checkpoint in (None, 'layer', 'branch')
+        assert feature_map in ('elu', 'favor')
+        assert temporal_attention in ('linear', 'full')
+        self.checkpoint = checkpoint
         if drop_rate is None:
             self.drop_rate = [0.5, 0.5, 0.5, 0.5]  # temp_conv, sparse_attention, add_norm, ffn
         else:
             self.drop_rate = drop_rate
-        self.spatial_factor = nn.Parameter(torch.ones(num_layers)) * 0.5
+        self.spatial_factor = torch.ones(num_layers) * 0.5  # not a parameter (never was in the state_dict)
         self.sequential = sequential
         self.num_layers = num_layers
         self.num_conv_layers = num_conv_layers
@@ -51,17 +78,26 @@ class DualGraphEncoder(nn.Module, ABC):
 
         self.lls = nn.Linear(in_features=channels[0], out_features=channels[1])
 
+        if hop_table is not None:
+            hop_table = hop_table.clamp(max=max_hops)
+        self.register_buffer('hop_table', hop_table)
         self.spatial_layers = nn.ModuleList([
             SpatialEncoderLayer(in_channels=channels_[i],
                                 mdl_channels=channels_[i + 1],
                                 heads=num_heads,
-                                dropout=self.drop_rate) for i in range(num_layers)])
+                                dropout=self.drop_rate,
+                                max_hops=max_hops if hop_table is not None else None) for i in range(num_layers)])
 
         self.temporal_layers = nn.ModuleList([
             TemporalEncoderLayer(in_channels=channels_[i],
                                  mdl_channels=channels_[i + 1],
                                  heads=num_heads,
-                                 dropout=self.drop_rate) for i in range(num_layers)])
+                                 dropout=self.drop_rate,
+                                 feature_map=partial(FavorFeatureMap, nb_features=nb_features,
+                                                     redraw_interval=redraw_interval)
+                                 if feature_map == 'favor' else None,
+                                 attention=temporal_attention) for i in range(num_layers)])
+        self.feature_maps = [m for m in self.temporal_layers.modules() if isinstance(m, FavorFeatureMap)]
 
         self.context_attention = GlobalContextAttention(in_channels=out_channels)
 
@@ -74,14 +110,17 @@ class DualGraphEncoder(nn.Module, ABC):
             nn.Linear(mlp_head_hidden, classes)
         )
 
-    def forward(self, t, adj, bi):  # t: tensor, adj: dataset.skeleton_
+    def forward(self, t, adj, bi, hops=None):  # t: tensor, adj: dataset.skeleton_
         """
 
         :param t: tensor
         :param adj: adjacency matrix (sparse)
-        :param bi: batch index
+        :param bi: batch index or SequenceBatch (built once per batch and shared by all layers)
+        :param hops: hop distance of every edge of adj (data.dataset3.skeleton_edge_hops, cached
+                     by the topology registry), gathered from the hop_table if not given
         :return: tensor
         """
+        seq = sequence_batch(bi)
         c = t.shape[-1]
         t = self.dn(rearrange(t, 'b n c -> b (n c)'))
         t = self.lls(rearrange(t, 'b (n c) -> b n c', c=c))
@@ -90,25 +129,56 @@ class DualGraphEncoder(nn.Module, ABC):
         # t = rearrange(t, 'b (n c) -> b n c', c=c)
         t = rearrange(t, 'b n c -> n b c')
 
-        t = self.positional_encoding(t, bi)
+        t = self.positional_encoding(t, seq)
         t = rearrange(t, 'n b c -> b n c')
         att = None
+        # hop distance of the joints of every edge, for the hop bias of the spatial attentions
+        if hops is None and self.hop_table is not None:
+            hops = self.hop_table[adj[0], adj[1]]
 
         # Core pipeline
         for i in range(self.num_layers):
-            u = t  # branch
-            # t = self.spatial_layers[i](t, FullMask(25, 25, device=t.device))
-            t = self.spatial_layers[i](t, adj)
-            u = rearrange(u, 'f n c -> n f c')
-            u = self.temporal_layers[i](u, bi)
-            u = rearrange(u, 'n f c -> f n c')
-            t = u + t
+            if self.checkpoint == 'layer':
+                t = self.checkpointed([self.spatial_layers[i], self.temporal_layers[i]],
+                                      self.encoder_layer, t, i, adj, seq, hops)
+            else:
+                t = self.encoder_layer(t, i, adj, seq, hops)
 
         t = rearrange(t, 'f n c -> n f c')
         # bi_ = bi[:bi.shape[0]:2**self.num_layers]
-        t = rearrange(self.context_attention(t, batch_index=bi),
+        t = rearrange(self.context_attention(t, batch_index=seq),
                       'n f c -> f (n c)')  # bi is the shrunk along the batch index
         # t = rearrange(global_mean_pool(t, bi), 'f n c -> f (n c)')
         t = self.mlp_head(t)
         # return fn.sigmoid(t)  # dimension (b, n, oc)
         return t
+
+    def encoder_layer(self, t, i, adj, seq, hops=None):
+        spatial, temporal = self.spatial_layers[i], self.temporal_layers[i]
+        u = rearrange(t, 'f n c -> n f c')  # branch
+        if self.checkpoint == 'branch':
+            # t = self.spatial_layers[i](t, FullMask(25, 25, device=t.device))
+            t = self.checkpointed([spatial], spatial, t, adj, hops)
+            u = self.checkpointed([temporal], temporal, u, seq)
+        else:
+            t = spatial(t, adj, hops)
+            u = temporal(u, seq)
+        return rearrange(u, 'n f c -> f n c') + t
+
+    def checkpointed(self, modules, fn, t, *args):
+        """fn(t, *args) with its activations recomputed in backward. The first pass runs the
+        MaskPowerNorm of ``modules`` with frozen statistics, they are updated by the recomputation
+        so every norm sees one update per step, with the same output in both passes.
+        """
+        if not (self.training and torch.is_grad_enabled()):
+            return fn(t, *args)
+        calls = [0]
+
+        def run(x):
+            calls[0] += 1
+            if calls[0] > 1:  # recomputation in backward
+                return fn(x, *args)
+            with frozen_stats(*modules):
+                return fn(x, *args)
+
+        return checkpoint(run, t, use_reentrant=True)
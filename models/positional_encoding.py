@@ -1,12 +1,11 @@
-import networkx as nx
 import numpy as np
 import torch
-from scipy.sparse import coo_matrix
-from scipy.sparse.csgraph import breadth_first_tree
 # sequential relative
 # tree-based
 from torch import nn
 
+from utility.sequence import sequence_batch
+
 
 # from utility.linalg import bfs_enc
 
@@ -30,6 +29,11 @@ def bfs_enc(edges, root, device):
 
 
 def tree_struct_pos_enc(adj, max_chs, func=None, device=None):
+    # not on the model path, see utility.tree.hop_table
+    import networkx as nx
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import breadth_first_tree
+
     row = np.array(adj[0].cpu().tolist())
     col = np.array(adj[1].cpu().tolist())
     num_tokens = max(row) + 1
@@ -63,30 +67,36 @@ class SeqPosEncoding(nn.Module):
             self.weight = nn.Parameter(torch.randn(model_dim, model_dim) * scale)
         else:
             self.weight = None
+        self._table = None  # sin/cos table cached for the longest sequence seen so far
 
-    @staticmethod
-    def segment(pos, bi, device):
-        offset = torch.zeros(max(bi) + 1).to(device)
-        diff = bi[1:] - bi[:-1]
-        offset[1:] = torch.nonzero((diff == 1), as_tuple=True)[0]
-        return pos - offset[bi]
+    def table(self, length, device):
+        """sin/cos encodings of the positions [0, length), cached and grown on demand"""
+        if self._table is None or self._table.shape[0] < length or self._table.device != device:
+            d = self.model_dim
+            # grown, never shrunk (also when rebuilt on another device)
+            rows = max(length, 0 if self._table is None else self._table.shape[0])
+            pos = torch.arange(rows, dtype=torch.float, device=device).reshape(-1, 1)
+            dim = torch.arange(d, dtype=torch.float, device=device).reshape(1, -1)
+            phase = (pos / 1e4) ** (dim / d)
+            self._table = torch.where(dim.long() % 2 == 0, torch.sin(phase), torch.cos(phase))
+        return self._table[:length]
 
     def forward(self, x, bi=None) -> torch.Tensor:
-        d = self.model_dim
-        sequence_length = x.shape[-2]
-        pos = torch.arange(sequence_length, dtype=torch.float).to(x.device)
-        if bi is not None:
-            pos = self.segment(pos, bi, x.device)
-        pos = pos.reshape(1, -1, 1).to(x.device)
-        dim = torch.arange(d, dtype=torch.float).reshape(1, 1, -1).to(x.device)
-        phase = (pos / 1e4) ** (dim / d)
-        assert x.shape[-2] == sequence_length and x.shape[-1] == self.model_dim
-        if self.weight is None:
-            return x + torch.where(dim.long() % 2 == 0, torch.sin(phase), torch.cos(phase))
-        return x + torch.matmul(torch.where(dim.long() % 2 == 0,
-                                            torch.sin(phase),
-                                            torch.cos(phase)),
-                                self.weight)
+        """
+        :param x: tensor (..., frames, channels)
+        :param bi: batch index or SequenceBatch of the concatenated frames
+        """
+        assert x.shape[-1] == self.model_dim
+        seq = sequence_batch(bi)
+        if seq is None:
+            enc = self.table(x.shape[-2], x.device)
+        else:
+            enc = self.table(seq.max_length, x.device)
+        if self.weight is not None:
+            enc = torch.matmul(enc, self.weight)
+        if seq is not None:
+            enc = enc.index_select(0, seq.positions)
+        return x + enc.to(x.dtype)
 
 
 def test():
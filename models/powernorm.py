@@ -1,9 +1,11 @@
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
 
-__all__ = ['MaskPowerNorm']
+__all__ = ['MaskPowerNorm', 'frozen_stats', 'scale_warmup']
 
 
 def _sum_ft(tensor):
@@ -11,6 +13,15 @@ def _sum_ft(tensor):
     return tensor.sum(dim=0).sum(dim=-1)
 
 
+def _second_moment(x, pad_mask=None):
+    """per channel second moment of x (... x C) over the non padded positions"""
+    if pad_mask is not None:
+        # B x T -> T x B, True on the real positions
+        x = x[~pad_mask.transpose(0, 1)]
+    x = x.reshape(-1, x.shape[-1])
+    return torch.einsum('nc,nc->c', x, x) / x.shape[0]
+
+
 class GroupScaling1D(nn.Module):
     r"""Scales inputs by the second moment for the entire layer.
     """
@@ -25,14 +36,12 @@ class GroupScaling1D(nn.Module):
 
     def forward(self, input):
         # calculate second moment
-        # different group use different mean
-        T, B, C = input.shape[0], input.shape[1], input.shape[2]
-        Cg = C // self.group_num
-        gn_input = input.contiguous().reshape(T, B, self.group_num, Cg)
-        moment2 = torch.repeat_interleave(torch.mean(gn_input * gn_input, dim=3, keepdim=True), \
-                                          repeats=Cg, dim=-1).contiguous().reshape(T, B, C)
+        # different group use different mean, broadcast over the Cg channels of the group
+        shape = input.shape
+        gn_input = input.reshape(*shape[:-1], self.group_num, shape[-1] // self.group_num)
+        moment2 = torch.mean(gn_input * gn_input, dim=-1, keepdim=True)
         # divide out second moment
-        return input / torch.sqrt(moment2 + self.eps)
+        return (gn_input * torch.rsqrt(moment2 + self.eps)).view(shape)
 
 
 def _unsqueeze_ft(tensor):
@@ -42,63 +51,60 @@ def _unsqueeze_ft(tensor):
 
 class PowerFunction(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, x, weight, bias, running_phi, eps, afwd, abkw, ema_gz, \
-                debug, warmup_iters, current_iter, mask_x):
+    def forward(ctx, x, weight, bias, running_phi, ema_gz, var, eps, afwd, abkw,
+                warmup_iters, current_iter, track_stats):
+        """
+        x: N x C, var: C (second moment of the real positions of x)
+        running_phi, ema_gz: 1 x C x 1 x 1 buffers, updated in place if track_stats
+        current_iter: host side iteration counter
+        """
         ctx.eps = eps
-        ctx.debug = debug
-        current_iter = current_iter.item()
-        ctx.current_iter = current_iter
-        ctx.warmup_iters = warmup_iters
         ctx.abkw = abkw
-        rmax = 1
-        N, C, H, W = x.size()
-        x2 = (mask_x * mask_x).mean(dim=0)
+        ctx.track_stats = track_stats
+        C = x.shape[-1]
+        phi = running_phi.view(C)
 
-        var = x2.reshape(1, C, 1, 1)
         if current_iter <= warmup_iters:
-            z = x / (var + eps).sqrt()
+            z = x * torch.rsqrt(var + eps)
         else:
-            z = x / (running_phi + eps).sqrt()
+            z = x * torch.rsqrt(phi + eps)
 
-        y = z
         ctx.save_for_backward(z, var, weight, ema_gz)
 
-        if current_iter < warmup_iters:
-            running_phi.copy_(
-                running_phi * (current_iter - 1) / current_iter + var.mean(dim=0, keepdim=True) / current_iter)
-        running_phi.copy_(afwd * running_phi + (1 - afwd) * var.mean(dim=0, keepdim=True))
-        y = weight.reshape(1, C, 1, 1) * y + bias.reshape(1, C, 1, 1)
-        return y
+        if track_stats:
+            if current_iter < warmup_iters:
+                phi.mul_((current_iter - 1) / current_iter).add_(var, alpha=1 / current_iter)
+            phi.mul_(afwd).add_(var, alpha=1 - afwd)
+        return torch.addcmul(bias, z, weight)
 
     @staticmethod
     def backward(ctx, grad_output):
         eps = ctx.eps
-        debug = ctx.debug
-        current_iter = ctx.current_iter
-        warmup_iters = ctx.warmup_iters
         abkw = ctx.abkw
 
-        N, C, H, W = grad_output.size()
-        z, var, weight, ema_gz = ctx.saved_variables
+        z, var, weight, ema_gz = ctx.saved_tensors
+        C = z.shape[-1]
+        gz_ema = ema_gz.view(C)
 
-        y = z
-        g = grad_output * weight.reshape(1, C, 1, 1)
-        g = g * 1
+        g = grad_output * weight
+        approx_grad_g = torch.addcmul(g, gz_ema, z, value=-(1 - abkw))
+        if ctx.track_stats:
+            gz_ema.add_(torch.einsum('nc,nc->c', approx_grad_g, z), alpha=1 / z.shape[0])
 
-        gz = (g * z).mean(dim=3).mean(dim=2).mean(dim=0)
-
-        approx_grad_g = (g - (1 - abkw) * ema_gz * z)
-        ema_gz.add_((approx_grad_g * z).mean(dim=3, keepdim=True).mean(dim=2, keepdim=True).mean(dim=0, keepdim=True))
-
-        gx = 1. / torch.sqrt(var + eps) * approx_grad_g
-        return gx, (grad_output * y).sum(dim=3).sum(dim=2).sum(dim=0), grad_output.sum(dim=3).sum(dim=2).sum(dim=0), \
-               None, None, None, None, None, None, None, None, None, None
+        gx = approx_grad_g * torch.rsqrt(var + eps)
+        return gx, torch.einsum('nc,nc->c', grad_output, z), grad_output.sum(dim=0), \
+               None, None, None, None, None, None, None, None, None
 
 
 class MaskPowerNorm(nn.Module):
     """
     An implementation of masked batch normalization, used for testing the numerical
     stability.
+
+    The normalization is computed on the native ``T x B x C`` layout. The
+    iteration counter is kept on the host (``current_iter``) and mirrored into
+    the ``iters`` buffer so that checkpoints stay compatible. The running
+    statistics are only updated while ``track_stats`` is set.
     """
 
     def __init__(self, num_features, eps=1e-5, alpha_fwd=0.9, alpha_bkw=0.9, \
@@ -123,60 +129,65 @@ class MaskPowerNorm(nn.Module):
         self.warmup_iters = warmup_iters
         self.gp = GroupScaling1D(group_num=group_num)
         self.group_num = group_num
+        self.current_iter = 0
+        self.track_stats = True
 
     def extra_repr(self):
         return '{num_features}, eps={eps}, alpha_fwd={afwd}, alpha_bkw={abkw}, ' \
                'affine={affine}, warmup={warmup_iters}, group_num={group_num}'.format(**self.__dict__)
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        super(MaskPowerNorm, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                         missing_keys, unexpected_keys, error_msgs)
+        self.current_iter = int(self.iters.item())
+
     def forward(self, input, pad_mask=None, is_encoder=False):
         """
-        input:  T x B x C -> B x C x T
-             :  B x C x T -> T x B x C
+        input:  T x B x C (or L x C)
         pad_mask: B x T (padding is True)
+        The normalization (and its statistics) is computed in float32, also under autocast.
         """
-        shaped_input = (len(input.shape) == 2)
-        if shaped_input:
-            input = input.unsqueeze(0)
-        T, B, C = input.shape
-        input = self.gp(input)
-
-        # construct the mask_input, size to be (BxL) x C: L is the real length here
-        if pad_mask is None:
-            mask_input = input.clone()
-        else:
-            # Transpose the bn_mask (B x T -> T x B)
-            bn_mask = ~pad_mask
-            bn_mask = bn_mask.transpose(0, 1)
-
-        if pad_mask is not None:
-            pad_size = (~bn_mask).sum()
-            mask_input = input[bn_mask, :]
-        else:
-            mask_input = input.clone()
-
-        mask_input = mask_input.reshape(-1, self.num_features)
-
-        input = input.permute(1, 2, 0).contiguous()
-        input_shape = input.size()
-        input = input.reshape(input.size(0), self.num_features, -1)
-        input = input.unsqueeze(-1)
-
-        if self.training:
-            self.iters.copy_(self.iters + 1)
-            output = PowerFunction.apply(input, self.weight, self.bias, self.running_phi, self.eps, \
-                                         self.afwd, self.abkw, self.ema_gz, self.debug, self.warmup_iters, self.iters,
-                                         mask_input)
-
-        else:
-            N, C, H, W = input.size()
-            var = self.running_phi
-            output = input / (var + self.eps).sqrt()
-            output = self.weight.reshape(1, C, 1, 1) * output + self.bias.reshape(1, C, 1, 1)
-
-        output = output.reshape(input_shape)
-        output = output.permute(2, 0, 1).contiguous()
-        # Reshape it.
-        if shaped_input:
-            output = output.squeeze(0)
-
-        return output
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            input = self.gp(input.float())
+
+            if not self.training:
+                scale = self.weight * torch.rsqrt(self.running_phi.view(-1) + self.eps)
+                return torch.addcmul(self.bias, input, scale)
+
+            current_iter = self.current_iter + 1
+            if self.track_stats:
+                self.current_iter = current_iter
+                self.iters.fill_(current_iter)
+
+            var = _second_moment(input.detach(), pad_mask)
+            output = PowerFunction.apply(input.view(-1, self.num_features), self.weight, self.bias,
+                                         self.running_phi, self.ema_gz, var, self.eps, self.afwd, self.abkw,
+                                         self.warmup_iters, current_iter, self.track_stats)
+            return output.view(input.shape)
+
+
+@contextmanager
+def frozen_stats(*modules):
+    """Runs the MaskPowerNorm layers of ``modules`` without updating their running statistics
+    and iteration counters (e.g. the first pass of a checkpointed segment which is recomputed,
+    and then tracked, in backward)."""
+    norms = [m for module in modules for m in module.modules() if isinstance(m, MaskPowerNorm)]
+    states = [m.track_stats for m in norms]
+    for m in norms:
+        m.track_stats = False
+    try:
+        yield
+    finally:
+        for m, state in zip(norms, states):
+            m.track_stats = state
+
+
+def scale_warmup(module, factor):
+    """Multiplies the warmup iterations of the MaskPowerNorm layers of ``module`` by ``factor``
+    (e.g. the number of accumulated micro-batches per optimizer step): their counters count
+    the forwards, the warmup stays the same number of optimizer steps."""
+    for m in module.modules():
+        if isinstance(m, MaskPowerNorm):
+            m.warmup_iters = m.warmup_iters * factor
+    return module
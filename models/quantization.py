@@ -0,0 +1,35 @@
+import torch
+import torch.nn as nn
+
+__all__ = ['QUANTIZED_LAYERS', 'quantizable_layers', 'quantize_dynamic']
+
+# the linear layers dominating the cost of DualGraphEncoder, the attention math stays in float
+QUANTIZED_LAYERS = ('lin_qkv', 'ffn', 'lls', 'mlp_head')
+
+
+def quantizable_layers(model, layers=QUANTIZED_LAYERS):
+    """names of the nn.Linear modules of ``model`` that belong to one of ``layers``"""
+    return [name for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and any(layer in name.split('.') for layer in layers)]
+
+
+def quantize_dynamic(model, layers=QUANTIZED_LAYERS, dtype=torch.qint8, inplace=False):
+    """Post-training dynamic quantization of the linear layers of a model for CPU inference.
+
+    The weights of the selected nn.Linear are quantized to int8 ahead of time, their inputs
+    are quantized on the fly (per batch) so no calibration data is needed. Everything else
+    (the attentions, norms, scatters) runs in float.
+
+    :param model: DualGraphEncoder, possibly already processed by optimize_for_inference
+    :param layers: names of the modules whose linear layers are quantized
+    :param dtype: torch.qint8 or torch.float16
+    :param inplace: quantize ``model`` instead of a copy
+    :return: quantized model in eval mode
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        model = model.module
+    model.eval()
+    qconfig = torch.quantization.float16_dynamic_qconfig if dtype == torch.float16 else \
+        torch.quantization.default_dynamic_qconfig
+    qconfig_spec = {name: qconfig for name in quantizable_layers(model, layers)}
+    return torch.quantization.quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=dtype, inplace=inplace)
@@ -0,0 +1,353 @@
+"""TorchScript-compatible, inference-only version of models.net2s.DualGraphEncoder.
+
+The modules mirror the attribute names of the original ones, so the state_dict of a
+trained DualGraphEncoder loads as is, with any of its variants: hop bias of the spatial
+attentions, elu or favor feature map of the linear attention, linear or full temporal
+attention. There are no einops patterns and no isinstance branches. Dropout, the redraws of
+the favor projections and the running statistics updates of the norms are not implemented
+(eval only).
+"""
+import math
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as fn
+from torch import Tensor
+from torch_scatter import scatter_sum
+
+__all__ = ['ScriptableDualGraphEncoder']
+
+
+def sequence_positions(lengths: Tensor):
+    """batch index and position inside its sequence of every frame"""
+    batch = torch.repeat_interleave(torch.arange(lengths.shape[0], device=lengths.device), lengths)
+    offsets = torch.cumsum(lengths, dim=0) - lengths
+    positions = torch.arange(batch.shape[0], device=lengths.device) - offsets.index_select(0, batch)
+    return batch, positions
+
+
+class GroupScaling1D(nn.Module):
+    def __init__(self, eps: float = 1e-5, group_num: int = 4):
+        super(GroupScaling1D, self).__init__()
+        self.eps = eps
+        self.group_num = group_num
+
+    def forward(self, x: Tensor):
+        shape = list(x.shape)
+        g = x.reshape(shape[:-1] + [self.group_num, shape[-1] // self.group_num])
+        moment2 = torch.mean(g * g, dim=-1, keepdim=True)
+        return (g * torch.rsqrt(moment2 + self.eps)).view(shape)
+
+
+class PowerNorm(nn.Module):
+    """eval-mode models.powernorm.MaskPowerNorm"""
+
+    def __init__(self, num_features: int, eps: float = 1e-5, group_num: int = 1):
+        super(PowerNorm, self).__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_features))
+        self.bias = nn.Parameter(torch.zeros(num_features))
+        self.register_buffer('running_phi', torch.ones(1, num_features, 1, 1))
+        self.register_buffer('ema_gz', torch.zeros(1, num_features, 1, 1))
+        self.register_buffer('iters', torch.zeros(1, dtype=torch.long))
+        self.gp = GroupScaling1D(group_num=group_num)
+
+    def forward(self, x: Tensor):
+        scale = self.weight * torch.rsqrt(self.running_phi.view(-1) + self.eps)
+        return torch.addcmul(self.bias, self.gp(x), scale)
+
+
+class AddNorm(nn.Module):
+    def __init__(self, normalized_shape: int, heads: int):
+        super(AddNorm, self).__init__()
+        self.ln = PowerNorm(normalized_shape, group_num=heads)
+
+    def forward(self, x: Tensor, y: Tensor):
+        return self.ln(y + x)
+
+
+class FeedForward(nn.Module):
+    def __init__(self, in_channels: int, hidden_channels: int):
+        super(FeedForward, self).__init__()
+        self.net = nn.Sequential(
+            nn.Linear(in_channels, hidden_channels),
+            nn.GELU(),
+            nn.Identity(),
+            nn.Linear(hidden_channels, in_channels),
+            nn.Identity()
+        )
+
+    def forward(self, x: Tensor):
+        return self.net(x)
+
+
+class SparseAttention(nn.Module):
+    def __init__(self, heads: int, max_hops: Optional[int] = None):
+        super(SparseAttention, self).__init__()
+        if max_hops is not None:
+            self.hop_bias = nn.Parameter(torch.zeros(max_hops + 1, heads))
+        else:
+            self.hop_bias = None
+
+    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, adj: Tensor, hops: Optional[Tensor]):
+        """
+        :param queries, keys, values: tensor(frames, joints, heads, channels)
+        :param adj: tensor(2, num_edges), sorted by row
+        :param hops: hop distance between the joints of every edge (for the hop bias)
+        """
+        n = queries.shape[-3]
+        softmax_temp = 1. / math.sqrt(queries.shape[-1])
+        row, col = adj[0], adj[1]
+        qk = torch.sum(queries.index_select(-3, row) * keys.index_select(-3, col), dim=-1) * softmax_temp
+        hop_bias = self.hop_bias
+        if hop_bias is not None and hops is not None:
+            qk = qk + hop_bias.index_select(0, hops)
+        alpha = (qk - qk.max()).exp()
+        alpha = alpha / (scatter_sum(alpha, row, dim=-2, dim_size=n).index_select(-2, row) + 1e-16)
+        return scatter_sum(values.index_select(-3, col) * alpha.unsqueeze(-1), row, dim=-3, dim_size=n)
+
+
+class EluFeatureMap(nn.Module):
+    """fast_transformers elu_feature_map (no parameters)"""
+
+    def forward(self, x: Tensor, is_query: bool):
+        return fn.elu(x) + 1
+
+
+class FavorFeatureMap(nn.Module):
+    """models.kernels.FavorFeatureMap with the projection of the checkpoint (never redrawn)"""
+
+    def __init__(self, query_dims: int, nb_features: Optional[int] = None, eps: float = 1e-4):
+        super(FavorFeatureMap, self).__init__()
+        nb_features = nb_features or int(query_dims * math.log(query_dims))
+        self.ratio = nb_features ** -0.5
+        self.eps = eps
+        self.register_buffer('projection', torch.zeros(nb_features, query_dims))
+
+    def forward(self, x: Tensor, is_query: bool):
+        data_dash = torch.matmul(x, self.projection.t())
+        diag_data = torch.sum(x * x, dim=-1, keepdim=True) / 2.
+        if is_query:
+            stabilizer = torch.amax(data_dash, dim=-1, keepdim=True)
+        else:
+            stabilizer = torch.max(data_dash)
+        return self.ratio * (torch.exp(data_dash - diag_data - stabilizer) + self.eps)
+
+
+class LinearAttention(nn.Module):
+    def __init__(self, in_channels: int, feature_map: str = 'elu', nb_features: Optional[int] = None):
+        super(LinearAttention, self).__init__()
+        self.in_channels = in_channels
+        if feature_map == 'favor':
+            self.feature_map = FavorFeatureMap(in_channels, nb_features)
+        else:
+            self.feature_map = EluFeatureMap()
+
+    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, batch: Tensor, positions: Tensor,
+                lengths: Tensor):
+        """
+        :param queries, keys, values: tensor(joints, frames, heads, channels)
+        :param batch: sequence index of every frame
+        """
+        num_sequences = lengths.shape[0]
+        softmax_temp = queries.shape[-1] ** -0.25
+        q = self.feature_map(queries * softmax_temp, True).transpose(1, 2)  # n h l d
+        k = self.feature_map(keys * softmax_temp, False).transpose(1, 2)
+        v = values.transpose(1, 2)
+        kv = torch.matmul(k.unsqueeze(-1), v.unsqueeze(-2))  # n h l d1 d2
+        kv = scatter_sum(kv, batch, dim=-3, dim_size=num_sequences).index_select(-3, batch)
+        k_ = scatter_sum(k, batch, dim=-2, dim_size=num_sequences).index_select(-2, batch)
+        z = 1 / torch.sum(q * k_, dim=-1)
+        out = torch.matmul(q.unsqueeze(-2), kv).squeeze(-2) * z.unsqueeze(-1)
+        return out.transpose(1, 2).contiguous()
+
+
+class BlockFullAttention(nn.Module):
+    def forward(self, queries: Tensor, keys: Tensor, values: Tensor, batch: Tensor, positions: Tensor,
+                lengths: Tensor):
+        """
+        :param queries, keys, values: tensor(joints, frames, heads, channels)
+        :param batch, positions: sequence index and position in the sequence of every frame
+        """
+        n, h, e = queries.shape[0], queries.shape[2], queries.shape[3]
+        b, s = lengths.shape[0], int(lengths.max())
+        softmax_temp = 1. / math.sqrt(e)
+        index = batch * s + positions  # frames padded to [B, max_length]
+        q = queries.new_zeros(n, b * s, h, e).index_copy(1, index, queries).view(n, b, s, h, e)
+        k = keys.new_zeros(n, b * s, h, e).index_copy(1, index, keys).view(n, b, s, h, e)
+        v = values.new_zeros(n, b * s, h, values.shape[3]).index_copy(1, index, values).view(n, b, s, h, -1)
+        qk = torch.einsum('nblhe,nbshe->nbhls', q, k) * softmax_temp
+        padding = torch.arange(s, device=lengths.device).unsqueeze(0) >= lengths.unsqueeze(-1)  # B S
+        att = torch.softmax(qk.masked_fill(padding[:, None, None, :], float('-inf')), dim=-1)
+        out = torch.einsum('nbhls,nbshd->nblhd', att, v)
+        return out.reshape(n, b * s, h, -1).index_select(1, index).contiguous()
+
+
+class SpatialEncoderLayer(nn.Module):
+    def __init__(self, in_channels: int, mdl_channels: int, heads: int, max_hops: Optional[int] = None):
+        super(SpatialEncoderLayer, self).__init__()
+        self.heads = heads
+        self.lin_qkv = nn.Linear(in_channels, mdl_channels * 3, bias=False)
+        self.multi_head_attn = SparseAttention(heads, max_hops)
+        self.add_norm_att = AddNorm(mdl_channels, heads)
+        self.add_norm_ffn = AddNorm(mdl_channels, heads)
+        self.ffn = FeedForward(mdl_channels, mdl_channels)
+
+    def forward(self, x: Tensor, adj: Tensor, hops: Optional[Tensor]):
+        f, n, c = x.shape[0], x.shape[1], x.shape[2]
+        qkv = self.lin_qkv(x).view(f, n, 3, self.heads, -1)
+        t = self.multi_head_attn(qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2], adj, hops)
+        x = self.add_norm_att(x, t.reshape(f, n, -1))
+        return self.add_norm_ffn(x, self.ffn(x))
+
+
+class TemporalEncoderLayer(nn.Module):
+    def __init__(self, in_channels: int, mdl_channels: int, heads: int, feature_map: str = 'elu',
+                 nb_features: Optional[int] = None, attention: str = 'linear'):
+        super(TemporalEncoderLayer, self).__init__()
+        self.heads = heads
+        self.lin_qkv = nn.Linear(in_channels, mdl_channels * 3, bias=False)
+        if attention == 'full':
+            self.multi_head_attn = BlockFullAttention()
+        else:
+            self.multi_head_attn = LinearAttention(mdl_channels // heads, feature_map, nb_features)
+        self.add_norm_att = AddNorm(mdl_channels, heads)
+        self.add_norm_ffn = AddNorm(mdl_channels, heads)
+        self.ffn = FeedForward(mdl_channels, mdl_channels)
+
+    def forward(self, x: Tensor, batch: Tensor, positions: Tensor, lengths: Tensor):
+        n, f, c = x.shape[0], x.shape[1], x.shape[2]
+        qkv = self.lin_qkv(x).view(n, f, 3, self.heads, -1)
+        t = self.multi_head_attn(qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2], batch, positions, lengths)
+        x = self.add_norm_att(x, t.view(n, f, -1))
+        return self.add_norm_ffn(x, self.ffn(x))
+
+
+class GlobalContextAttention(nn.Module):
+    def __init__(self, in_channels: int):
+        super(GlobalContextAttention, self).__init__()
+        self.weights = nn.Parameter(torch.empty(in_channels, in_channels))
+
+    def forward(self, x: Tensor, batch: Tensor, lengths: Tensor):
+        """
+        :param x: tensor(joints, frames, channels)
+        :return: tensor(joints, sequences, channels)
+        """
+        lengths = lengths.to(x.dtype).unsqueeze(-1)
+        num_sequences = lengths.shape[0]
+        gc = torch.matmul(scatter_sum(x, batch, dim=1, dim_size=num_sequences) / lengths, self.weights)
+        gc = torch.tanh(gc).index_select(-2, batch)
+        gc_ = torch.sigmoid(torch.sum(x * gc, dim=-1, keepdim=True))
+        return scatter_sum(gc_ * x, batch, dim=1, dim_size=num_sequences) / lengths
+
+
+class ScriptableDualGraphEncoder(nn.Module):
+    """Same constructor arguments (and state_dict) as DualGraphEncoder, plus the
+    adjacency matrix of the skeleton which is stored as a (non persistent) buffer.
+    The positional encodings are precomputed for up to ``max_frames`` frames.
+
+    :param feature_map: 'elu' or 'favor', feature map of the temporal linear attention
+    :param nb_features: number of random features of the favor feature map
+    :param temporal_attention: 'linear' or 'full', attention of the temporal layers
+    :param hop_table: hop distances between the joints, if given the spatial attentions have
+                      the hop bias (the table is also loaded from the state_dict)
+    """
+
+    def __init__(self,
+                 in_channels: int,
+                 hidden_channels: int,
+                 out_channels: int,
+                 mlp_head_hidden: int,
+                 num_layers: int,
+                 adj: Tensor,
+                 num_heads: int = 8,
+                 num_joints: int = 25,
+                 classes: int = 60,
+                 max_frames: int = 300,
+                 feature_map: str = 'elu',
+                 nb_features: Optional[int] = None,
+                 temporal_attention: str = 'linear',
+                 hop_table: Optional[Tensor] = None,
+                 max_hops: int = 3,
+                 **kwargs):
+        super(ScriptableDualGraphEncoder, self).__init__()
+        assert feature_map in ('elu', 'favor')
+        assert temporal_attention in ('linear', 'full')
+        self.num_layers = num_layers
+        self.num_joints = num_joints
+        channels = [in_channels] + [hidden_channels] * (num_layers - 1) + [out_channels]
+        channels_ = channels[1:] + [out_channels]
+
+        self.dn = nn.BatchNorm1d(in_channels * num_joints, affine=True)
+        self.lls = nn.Linear(in_features=channels[0], out_features=channels[1])
+        if hop_table is not None:
+            hop_table = hop_table.clamp(max=max_hops)
+        self.register_buffer('hop_table', hop_table)
+        self.spatial_layers = nn.ModuleList([
+            SpatialEncoderLayer(channels_[i], channels_[i + 1], num_heads,
+                                max_hops if hop_table is not None else None) for i in range(num_layers)])
+        self.temporal_layers = nn.ModuleList([
+            TemporalEncoderLayer(channels_[i], channels_[i + 1], num_heads, feature_map, nb_features,
+                                 temporal_attention) for i in range(num_layers)])
+        self.context_attention = GlobalContextAttention(in_channels=out_channels)
+        self.mlp_head = nn.Sequential(
+            nn.Linear(out_channels * num_joints, mlp_head_hidden),
+            nn.LeakyReLU(),
+            nn.Identity(),
+            nn.Linear(mlp_head_hidden, classes)
+        )
+
+        # same encoding as models.positional_encoding.SeqPosEncoding
+        pos = torch.arange(max_frames, dtype=torch.float).reshape(-1, 1)
+        dim = torch.arange(hidden_channels, dtype=torch.float).reshape(1, -1)
+        phase = (pos / 1e4) ** (dim / hidden_channels)
+        self.register_buffer('pos_table', torch.where(dim.long() % 2 == 0, torch.sin(phase), torch.cos(phase)),
+                             persistent=False)
+        self.register_buffer('adj', adj, persistent=False)
+
+    @classmethod
+    def from_model(cls, model, adj, **kwargs):
+        """Builds the scriptable version of a DualGraphEncoder and copies its weights."""
+        num_layers = model.num_layers
+        attention = model.temporal_layers[0].multi_head_attn
+        hop_bias = model.spatial_layers[0].multi_head_attn.hop_bias
+        script_model = cls(in_channels=model.lls.in_features,
+                           hidden_channels=model.lls.out_features,
+                           out_channels=model.context_attention.in_channels,
+                           mlp_head_hidden=model.mlp_head[0].out_features,
+                           num_layers=num_layers,
+                           adj=adj,
+                           num_heads=model.spatial_layers[0].heads,
+                           num_joints=model.num_joints,
+                           classes=model.num_classes,
+                           feature_map='favor' if model.feature_maps else 'elu',
+                           nb_features=model.feature_maps[0].nb_features if model.feature_maps else None,
+                           temporal_attention='linear' if hasattr(attention, 'feature_map') else 'full',
+                           hop_table=model.hop_table,
+                           max_hops=hop_bias.shape[0] - 1 if hop_bias is not None else 3,
+                           **kwargs)
+        script_model.load_state_dict(model.state_dict())
+        return script_model.to(adj.device).eval()
+
+    def forward(self, t: Tensor, lengths: Tensor):
+        """
+        :param t: tensor(frames, joints, channels), the frames of the sequences concatenated
+        :param lengths: number of frames of each sequence
+        :return: logits tensor(sequences, classes)
+        """
+        f, n, c = t.shape[0], t.shape[1], t.shape[2]
+        batch, positions = sequence_positions(lengths)
+        t = self.lls(self.dn(t.reshape(f, n * c)).view(f, n, c))
+        t = t + self.pos_table.index_select(0, positions).unsqueeze(1)
+        hop_table = self.hop_table
+        hops: Optional[Tensor] = None
+        if hop_table is not None:
+            hops = hop_table[self.adj[0], self.adj[1]]
+
+        for spatial, temporal in zip(self.spatial_layers, self.temporal_layers):
+            u = temporal(t.transpose(0, 1), batch, positions, lengths)
+            t = spatial(t, self.adj, hops) + u.transpose(0, 1)
+
+        t = self.context_attention(t.transpose(0, 1), batch, lengths)  # n b c
+        return self.mlp_head(t.transpose(0, 1).reshape(lengths.shape[0], -1))
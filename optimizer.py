@@ -77,6 +77,8 @@ class SGD_AGC(Optimizer):
         nesterov (bool, optional): enables Nesterov momentum (default: False)
         dampening (float, optional): dampening for momentum (default: 0.01)
         eps (float, optional): dampening for momentum (default: 1e-3)
+        foreach (bool, optional): update all the parameters of a group with the multi-tensor
+            (torch._foreach_*) ops instead of one parameter at a time (default: True)
     Example:
         >>> optimizer = torch.optim.SGD_AGC(model.parameters(), lr=0.1, momentum=0.9)
         >>> optimizer.zero_grad()
@@ -107,7 +109,7 @@ class SGD_AGC(Optimizer):
 
     def __init__(self, params, lr=required, momentum=0, dampening=0,
                  weight_decay=0, nesterov=False, clipping=1e-2, eps=1e-3,
-                 eta=5e-4, gamma=0.55):
+                 eta=5e-4, gamma=0.55, foreach=True):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if momentum < 0.0:
@@ -121,7 +123,8 @@ class SGD_AGC(Optimizer):
             raise ValueError("Invalid eps value: {}".format(eps))
 
         defaults = dict(lr=lr, momentum=momentum, dampening=dampening,
-                        weight_decay=weight_decay, nesterov=nesterov, clipping=clipping, eps=eps)
+                        weight_decay=weight_decay, nesterov=nesterov, clipping=clipping, eps=eps,
+                        foreach=foreach)
         if nesterov and (momentum <= 0 or dampening != 0):
             raise ValueError(
                 "Nesterov momentum requires a momentum and zero dampening")
@@ -137,6 +140,7 @@ class SGD_AGC(Optimizer):
         super(SGD_AGC, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('nesterov', False)
+            group.setdefault('foreach', True)
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -151,58 +155,163 @@ class SGD_AGC(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
-            for p in group['params']:
-                if p.grad is None:
-                    continue
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            if group['foreach']:
+                _multi_tensor_agc(params, grads, group)
+            else:
+                _single_tensor_agc(params, grads, group)
+
+        self.t += 1
 
-                param_norm = torch.max(unitwise_norm(
-                    p.detach()), torch.tensor(group['eps']).to(p.device))
-                max_norm = param_norm * group['clipping']
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+            momentum_buffers = [self.state[p].get('momentum_buffer') for p in params]
+            if group['foreach']:
+                _multi_tensor_sgd(params, grads, momentum_buffers, group)
+            else:
+                _single_tensor_sgd(params, grads, momentum_buffers, group)
+            if group['momentum'] != 0:
+                for p, buf in zip(params, momentum_buffers):
+                    self.state[p]['momentum_buffer'] = buf
+
+        return loss
 
-                # add noise to gradients
-                '''normal = torch.empty(1).normal_(  # p.shape
-                    mean=0, std=math.sqrt(self.eta / ((1 + self.t) ** self.gamma))).to(p.device)
-                p.grad += normal'''
 
-                # Gradient clipping
-                grad_norm = unitwise_norm(p.grad.detach())
+def _single_tensor_agc(params, grads, group):
+    for p, grad in zip(params, grads):
+        param_norm = torch.max(unitwise_norm(
+            p.detach()), torch.tensor(group['eps']).to(p.device))
+        max_norm = param_norm * group['clipping']
+
+        # add noise to gradients
+        '''normal = torch.empty(1).normal_(  # p.shape
+            mean=0, std=math.sqrt(self.eta / ((1 + self.t) ** self.gamma))).to(p.device)
+        p.grad += normal'''
+
+        # Gradient clipping
+        grad_norm = unitwise_norm(grad.detach())
+
+        trigger = grad_norm > max_norm  # TODO: not working if "grad_norm < max_norm"
+
+        clipped_grad = grad * \
+            (max_norm / torch.max(grad_norm,
+                                  torch.tensor(1e-6).to(grad_norm.device)))
+        grad.detach().copy_(torch.where(trigger, clipped_grad, grad))
+
+
+def _agc_factor(param_norm, grad_norm, clipping, eps):
+    """scale of the gradients of unitwise norm grad_norm (1 if not clipped)"""
+    max_norm = param_norm.clamp_(min=eps).mul_(clipping)
+    factor = max_norm / grad_norm.clamp(min=1e-6)
+    return torch.where(grad_norm > max_norm, factor, torch.ones_like(factor))
+
+
+def _multi_tensor_agc(params, grads, group):
+    """AGC of all the gradients of a group with a few kernels: the norms of the vectors and
+    scalars with _foreach_norm, the unitwise norms of the matrices of a shape on their stack,
+    then one _foreach_mul_ of the gradients by their scale"""
+    vectors = [i for i, p in enumerate(params) if p.ndim <= 1]
+    by_shape = {}
+    for i, p in enumerate(params):
+        if p.ndim > 4:
+            raise ValueError('Wrong input dimensions')
+        if p.ndim > 1:
+            by_shape.setdefault((p.shape, p.dtype, p.device), []).append(i)
+
+    index, factors = [], []
+    if vectors:
+        param_norm = torch.stack(torch._foreach_norm([params[i] for i in vectors]))
+        grad_norm = torch.stack(torch._foreach_norm([grads[i] for i in vectors]))
+        index += vectors
+        factors += _agc_factor(param_norm, grad_norm, group['clipping'], group['eps']).unbind(0)
+    for (shape, _, _), idx in by_shape.items():
+        # unitwise_norm of the stacked tensors: over the rows of the matrices, over the
+        # input channels and kernel of the 4d weights
+        dim = [1] if len(shape) <= 3 else [2, 3, 4]
+        param_norm = torch.linalg.vector_norm(torch.stack([params[i] for i in idx]), dim=dim, keepdim=True)
+        grad_norm = torch.linalg.vector_norm(torch.stack([grads[i] for i in idx]), dim=dim, keepdim=True)
+        index += idx
+        factors += _agc_factor(param_norm, grad_norm, group['clipping'], group['eps']).unbind(0)
+    torch._foreach_mul_([grads[i] for i in index], factors)
+
+
+def _single_tensor_sgd(params, grads, momentum_buffers, group):
+    weight_decay = group['weight_decay']
+    momentum = group['momentum']
+    dampening = group['dampening']
+    nesterov = group['nesterov']
+
+    for i, p in enumerate(params):
+        d_p = grads[i]
+        if weight_decay != 0:
+            d_p = d_p.add(p, alpha=weight_decay)
+        if momentum != 0:
+            buf = momentum_buffers[i]
+            if buf is None:
+                buf = momentum_buffers[i] = torch.clone(d_p).detach()
+            else:
+                buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+            if nesterov:
+                d_p = d_p.add(buf, alpha=momentum)
+            else:
+                d_p = buf
+
+        p.add_(d_p, alpha=-group['lr'])
+
+
+def _multi_tensor_sgd(params, grads, momentum_buffers, group):
+    weight_decay = group['weight_decay']
+    momentum = group['momentum']
+    dampening = group['dampening']
+    nesterov = group['nesterov']
+
+    if weight_decay != 0:
+        grads = torch._foreach_add(grads, params, alpha=weight_decay)
+    if momentum != 0:
+        new = [i for i, buf in enumerate(momentum_buffers) if buf is None]
+        old = [i for i, buf in enumerate(momentum_buffers) if buf is not None]
+        if old:
+            bufs = [momentum_buffers[i] for i in old]
+            torch._foreach_mul_(bufs, momentum)
+            torch._foreach_add_(bufs, [grads[i] for i in old], alpha=1 - dampening)
+        for i in new:
+            momentum_buffers[i] = torch.clone(grads[i]).detach()
+        if nesterov:
+            grads = torch._foreach_add(grads, momentum_buffers, alpha=momentum)
+        else:
+            grads = momentum_buffers
 
-                trigger = grad_norm > max_norm  # TODO: not working if "grad_norm < max_norm"
+    torch._foreach_add_(params, grads, alpha=-group['lr'])
 
-                clipped_grad = p.grad * \
-                    (max_norm / torch.max(grad_norm,
-                                          torch.tensor(1e-6).to(grad_norm.device)))
-                p.grad.detach().copy_(torch.where(trigger, clipped_grad, p.grad))
 
-        self.t += 1
+@torch.no_grad()
+def l2_penalty(parameters, l2_lambda):
+    """value of ``l2_lambda * sum(p ** 2)`` over ``parameters`` (for the logs, no gradient)"""
+    params = [p for p in parameters if p.requires_grad]
+    if not params or l2_lambda == 0:
+        return 0.
+    return l2_lambda * torch.stack(torch._foreach_norm(params)).square().sum()
 
-        for group in self.param_groups:
-            weight_decay = group['weight_decay']
-            momentum = group['momentum']
-            dampening = group['dampening']
-            nesterov = group['nesterov']
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                d_p = p.grad
-                if weight_decay != 0:
-                    d_p = d_p.add(p, alpha=weight_decay)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
-                    if nesterov:
-                        d_p = d_p.add(buf, alpha=momentum)
-                    else:
-                        d_p = buf
-
-                p.add_(d_p, alpha=-group['lr'])
 
-        return loss
+def l2_regularize_(parameters, l2_lambda):
+    """Adds the gradient of ``l2_lambda * sum(p ** 2)`` to the gradients of ``parameters``
+    (after the backward) and returns the value of the penalty, instead of adding the penalty
+    of every parameter to the loss.
+    """
+    params = [p for p in parameters if p.requires_grad]
+    if not params or l2_lambda == 0:
+        return 0.
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    torch._foreach_add_([p.grad for p in params], params, alpha=2 * l2_lambda)
+    return l2_penalty(params, l2_lambda)
 
 
 class CosineAnnealingWarmupRestarts(_LRScheduler):
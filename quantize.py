@@ -0,0 +1,116 @@
+import io
+import os.path as osp
+import time
+
+import torch
+from tqdm import tqdm
+
+from args import make_args
+from data.dataset3 import SkeletonDataset, skeleton_parts, skeleton_hops, skeleton_edge_hops
+from models.inference import optimize_for_inference
+from models.net2s import DualGraphEncoder
+from models.quantization import quantize_dynamic, quantizable_layers
+from utility.helper import load_model_state
+from utility.sequence import SequenceBatch, SequenceDataLoader
+
+
+def model_size(model):
+    """size in MB of the serialized state_dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+@torch.no_grad()
+def evaluate(models, data_loader, adj, hops=None, desc=None):
+    """top-1 accuracy of every model on the same batches"""
+    correct = [0] * len(models)
+    total = 0
+    for batch, seq in tqdm(data_loader, desc=desc):
+        for i, model in enumerate(models):
+            correct[i] += (model(batch.x, adj=adj, bi=seq, hops=hops).argmax(dim=-1) == batch.y).sum().item()
+        total += batch.y.shape[0]
+    return [c / total * 100. for c in correct]
+
+
+@torch.no_grad()
+def latency(model, dataset, adj, num_clips, hops=None, repeat=20, warmup=3):
+    """median latency in ms of a forward on ``num_clips`` clips"""
+    data_list = [dataset[i] for i in range(num_clips)]
+    x = torch.cat([data.x for data in data_list], dim=0)
+    seq = SequenceBatch.from_lengths(torch.tensor([data.x.shape[0] for data in data_list]))
+    times = []
+    for i in range(warmup + repeat):
+        start = time.perf_counter()
+        model(x, adj=adj, bi=seq, hops=hops)
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1e3)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    """Dynamic int8 quantization of the linear layers of a trained DualGraphEncoder.
+
+    For every benchmark of ``--benchmark`` (e.g. ``xsub,xview``) the checkpoint
+    save_root/save_name_<load_epoch>.pickle is loaded (``{benchmark}`` in ``--save_name`` is
+    replaced by the benchmark) and evaluated on the validation split in float and in int8.
+    Both models have their norms folded by optimize_for_inference. Dynamic quantization
+    needs no calibration data: the activation ranges are computed per batch.
+    """
+    args = make_args()
+    device = torch.device('cpu')
+    adj = skeleton_parts(dataset=args.dataset_name)[0].to(device)
+    hops = skeleton_edge_hops(args.dataset_name, args.max_hops, device) if args.hop_bias else None
+
+    rows = []
+    for benchmark in args.benchmark.split(','):
+        model = DualGraphEncoder(in_channels=args.in_channels,
+                                 hidden_channels=args.hid_channels,
+                                 out_channels=args.out_channels,
+                                 mlp_head_hidden=args.mlp_head_hidden,
+                                 num_layers=args.num_enc_layers,
+                                 num_heads=args.heads,
+                                 sequential=False,
+                                 num_conv_layers=args.num_conv_layers,
+                                 drop_rate=args.drop_rate,
+                                 feature_map=args.feature_map,
+                                 nb_features=args.nb_features,
+                                 redraw_interval=args.redraw_interval,
+                                 temporal_attention=args.temporal_attention,
+                                 hop_table=skeleton_hops(args.dataset_name, args.dataset_root) if args.hop_bias else None,
+                                 max_hops=args.max_hops)
+        save_name = args.save_name.format(benchmark=benchmark)
+        model.load_state_dict(load_model_state(osp.join(args.save_root,
+                                                        save_name + '_' + str(args.load_epoch) + '.pickle'),
+                                               device))
+        float_model = optimize_for_inference(model)
+        int8_model = quantize_dynamic(float_model)
+        print('quantized layers:', ', '.join(quantizable_layers(float_model)))
+
+        test_ds = SkeletonDataset(args.dataset_root, name='ntu_60',
+                                  use_motion_vector=False,
+                                  benchmark=benchmark, sample='val')
+        test_loader = SequenceDataLoader(test_ds, batch_size=args.batch_size, shuffle=False)
+        float_acc, int8_acc = evaluate([float_model, int8_model], test_loader, adj, hops, desc=benchmark)
+
+        row = {'benchmark': benchmark,
+               'float_acc': float_acc, 'int8_acc': int8_acc,
+               'float_mb': model_size(float_model), 'int8_mb': model_size(int8_model)}
+        for num_clips in (1, 4):
+            row['float_ms_%d' % num_clips] = latency(float_model, test_ds, adj, num_clips, hops)
+            row['int8_ms_%d' % num_clips] = latency(int8_model, test_ds, adj, num_clips, hops)
+        rows.append(row)
+
+    print('\n%-9s %9s %9s %8s | %8s %8s | %10s %10s %8s | %10s %10s %8s' %
+          ('benchmark', 'acc fp32', 'acc int8', 'delta', 'MB fp32', 'MB int8',
+           'ms fp32 x1', 'ms int8 x1', 'speedup', 'ms fp32 x4', 'ms int8 x4', 'speedup'))
+    for r in rows:
+        print('%-9s %9.2f %9.2f %+8.2f | %8.2f %8.2f | %10.2f %10.2f %7.2fx | %10.2f %10.2f %7.2fx' %
+              (r['benchmark'], r['float_acc'], r['int8_acc'], r['int8_acc'] - r['float_acc'],
+               r['float_mb'], r['int8_mb'],
+               r['float_ms_1'], r['int8_ms_1'], r['float_ms_1'] / r['int8_ms_1'],
+               r['float_ms_4'], r['int8_ms_4'], r['float_ms_4'] / r['int8_ms_4']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import copy
+import csv
+import itertools
+import json
+import math
+import os
+import os.path as osp
+import random
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from args import make_args
+from data.dataset3 import SkeletonDataset, skeleton_hops, skeleton_edge_hops
+from data.shared import SharedSkeletonData
+from data.topology import get_topology
+from models.ensemble import stream_input, stream_channels
+from models.kernels import redraw_on_step
+from models.net2s import DualGraphEncoder
+from models.powernorm import scale_warmup
+from optimizer import SGD_AGC, LabelSmoothingCrossEntropy
+from utility.helper import GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
+
+# state of the processes of the pool, set by _init_worker
+_worker = {}
+
+
+def make_trials(spec, seed=0):
+    """Hyperparameters of every trial of a sweep spec, e.g.
+
+        {"method": "grid", "params": {"lr": [0.1, 0.05], "heads": [4, 8]}}
+        {"method": "random", "num_trials": 32,
+         "params": {"lr": {"low": 1e-3, "high": 0.2, "log": true}, "hid_channels": [32, 64, 96]}}
+
+    grid: all the combinations of the lists; random: num_trials draws, a value of a list or
+    uniform (log-uniform with "log") in [low, high] ("int": true rounds it).
+    """
+    params = spec['params']
+    if spec.get('method', 'grid') == 'grid':
+        names = list(params)
+        return [dict(zip(names, values)) for values in itertools.product(*[params[n] for n in names])]
+
+    rng = random.Random(seed)
+
+    def draw(space):
+        if isinstance(space, list):
+            return rng.choice(space)
+        low, high = space['low'], space['high']
+        if space.get('log', False):
+            value = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            value = rng.uniform(low, high)
+        return int(round(value)) if space.get('int', False) else value
+
+    return [{name: draw(space) for name, space in params.items()} for _ in range(spec['num_trials'])]
+
+
+def rungs(min_epochs, max_epochs, eta):
+    """epochs after which the trials are compared by successive halving"""
+    epochs = [min_epochs]
+    while epochs[-1] * eta < max_epochs:
+        epochs.append(epochs[-1] * eta)
+    if epochs[-1] < max_epochs:
+        epochs.append(max_epochs)
+    return epochs
+
+
+def _init_worker(train_ds, valid_ds, cores, threads):
+    """pins the worker to its slice of the cores, keeps the handles of the shared datasets"""
+    slot = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, slot)
+    torch.set_num_threads(threads or len(slot))
+    _worker.update(train_ds=train_ds, valid_ds=valid_ds)
+
+
+def build_model(args):
+    return DualGraphEncoder(in_channels=stream_channels(args.stream, args.in_channels),
+                            hidden_channels=args.hid_channels,
+                            out_channels=args.out_channels,
+                            mlp_head_hidden=args.mlp_head_hidden,
+                            num_layers=args.num_enc_layers,
+                            num_heads=args.heads,
+                            sequential=False,
+                            num_conv_layers=args.num_conv_layers,
+                            drop_rate=args.drop_rate,
+                            checkpoint=args.checkpoint,
+                            feature_map=args.feature_map,
+                            nb_features=args.nb_features,
+                            redraw_interval=args.redraw_interval,
+                            temporal_attention=args.temporal_attention,
+                            hop_table=skeleton_hops(args.dataset_name, args.dataset_root) if args.hop_bias else None,
+                            max_hops=args.max_hops)
+
+
+def run_trial(trial, args, epochs, path):
+    """Trains the trial up to ``epochs`` epochs, resuming from its checkpoint ``path``, and
+    returns its validation accuracy (on the worker of the pool)"""
+    torch.manual_seed(args.seed + trial['id'])
+    args = copy.copy(args)
+    for name, value in trial['params'].items():
+        setattr(args, name, value)
+    device = torch.device('cpu')
+    adj = get_topology(args.dataset_name).edge_index
+    hops = skeleton_edge_hops(args.dataset_name, args.max_hops) if args.hop_bias else None
+    model = scale_warmup(build_model(args), args.accum_steps).to(device)
+    optimizer = SGD_AGC(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+    redraw_on_step(model, optimizer)
+    lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=0.97)
+    loss_compute = LabelSmoothingCrossEntropy()
+    start_epoch = 0
+    if osp.exists(path):
+        checkpoint = torch.load(path)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        lr_scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        start_epoch = checkpoint['epoch']
+        torch.manual_seed(args.seed + 1000 * trial['id'] + start_epoch)
+
+    train_loader = SequenceDataLoader(_worker['train_ds'], batch_size=args.batch_size, shuffle=True)
+    valid_loader = SequenceDataLoader(_worker['valid_ds'], batch_size=args.batch_size)
+    start = time.time()
+    for epoch in range(start_epoch, epochs):
+        model.train()
+        accumulator = GradientAccumulator(model, args.accum_steps, len(train_loader))
+        for i, (batch, seq) in enumerate(train_loader):
+            if i % args.accum_steps == 0:
+                optimizer.zero_grad()
+            out = model(stream_input(batch.x, args.stream), adj=adj, bi=seq, hops=hops)
+            accumulator.scale(loss_compute(out, batch.y.long()), i).backward()
+            if accumulator.is_step(i):
+                optimizer.step()
+        lr_scheduler.step()
+
+    model.eval()
+    metrics = RunningMetrics()
+    with torch.no_grad():
+        for batch, seq in valid_loader:
+            out = model(stream_input(batch.x, args.stream), adj=adj, bi=seq, hops=hops)
+            metrics.update(loss_compute(out, batch.y.long()), out, batch.y)
+    torch.save({'epoch': epochs,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scheduler_state_dict': lr_scheduler.state_dict()}, path)
+    result = metrics.compute()
+    return trial['id'], result['accuracy'], result['loss'], time.time() - start
+
+
+def write_results(path, trials):
+    names = sorted({name for trial in trials for name in trial['params']})
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['trial'] + names + ['epochs', 'val_accuracy', 'val_loss', 'train_time', 'status'])
+        for trial in sorted(trials, key=lambda t: -t.get('accuracy', -1.)):
+            writer.writerow([trial['id']] + [trial['params'].get(name) for name in names] +
+                            [trial.get('epochs', 0), trial.get('accuracy'), trial.get('loss'),
+                             round(trial.get('time', 0.), 1), trial['status']])
+
+
+def main():
+    """Hyperparameter sweep of ``--sweep_spec`` (see make_trials) with successive halving.
+
+    The trials run in a pool of ``--sweep_workers`` processes with their own slice of the cores,
+    all reading the same shared memory copy of the dataset. Every trial is trained up to the
+    first rung of epochs (``--sweep_min_epochs``, then times ``--sweep_eta`` up to
+    ``--epoch_num``), the best 1 / eta trials of a rung go on to the next one. A fold of the
+    training set (1 / ``--cross_k``) is held out for the validation. The results table is
+    written to sweep_dir/results.csv after every rung.
+    """
+    args = make_args()
+    with open(args.sweep_spec) as f:
+        spec = json.load(f)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+
+    dataset = SkeletonDataset(args.dataset_root, name='ntu_60',
+                              use_motion_vector=False,
+                              benchmark=args.benchmark, sample='train')
+    dataset = SharedSkeletonData.from_dataset(dataset)
+    perm = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(args.seed)).tolist()
+    num_valid = len(dataset) // args.cross_k
+    train_ds, valid_ds = dataset[perm[num_valid:]], dataset[perm[:num_valid]]
+
+    trials = [{'id': i, 'params': params, 'status': 'pending'}
+              for i, params in enumerate(make_trials(spec, args.seed))]
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    num_workers = min(args.sweep_workers or len(cores), len(trials), len(cores))
+    share = len(cores) // num_workers
+    ctx = mp.get_context('spawn')
+    slots = ctx.Queue()
+    for w in range(num_workers):
+        slots.put(cores[w * share:(w + 1) * share])
+
+    alive = trials
+    schedule = rungs(args.sweep_min_epochs, args.epoch_num, args.sweep_eta)
+    with ctx.Pool(num_workers, initializer=_init_worker,
+                  initargs=(train_ds, valid_ds, slots, args.threads)) as pool:
+        for k, epochs in enumerate(schedule):
+            jobs = [(t, args, epochs, osp.join(args.sweep_dir, 'trial_%d.pickle' % t['id'])) for t in alive]
+            for trial_id, accuracy, loss, elapsed in pool.starmap(run_trial, jobs, chunksize=1):
+                trial = trials[trial_id]
+                trial.update(epochs=epochs, accuracy=accuracy, loss=loss, status='running',
+                             time=trial.get('time', 0.) + elapsed)
+            alive = sorted(alive, key=lambda t: -t['accuracy'])
+            keep = max(len(alive) // args.sweep_eta, 1) if k + 1 < len(schedule) else len(alive)
+            for trial in alive[keep:]:
+                trial['status'] = 'stopped'
+            alive = alive[:keep]
+            write_results(osp.join(args.sweep_dir, 'results.csv'), trials)
+            print('rung %d (%d epochs): best trial %d, %.2f%%' % (k, epochs, alive[0]['id'], alive[0]['accuracy']))
+    for trial in alive:
+        trial['status'] = 'done'
+    write_results(osp.join(args.sweep_dir, 'results.csv'), trials)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import json
+import math
+import os
+import os.path as osp
+import string
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from args import make_args
+from data.topology import SKELETONS
+
+# rest poses (meters, x right, y up, z away from the camera) of the joints of the skeletons
+REST_POSES = {
+    'ntu': [[0., 0., 0.], [0., .3, 0.], [0., .62, 0.], [0., .75, 0.],            # spine, neck, head
+            [-.18, .55, 0.], [-.22, .28, 0.], [-.24, .05, 0.], [-.25, -.02, 0.],  # left arm
+            [.18, .55, 0.], [.22, .28, 0.], [.24, .05, 0.], [.25, -.02, 0.],      # right arm
+            [-.09, -.02, 0.], [-.1, -.42, 0.], [-.1, -.8, 0.], [-.1, -.85, -.1],  # left leg
+            [.09, -.02, 0.], [.1, -.42, 0.], [.1, -.8, 0.], [.1, -.85, -.1],      # right leg
+            [0., .55, 0.],                                                       # spine shoulder
+            [-.25, -.08, 0.], [-.22, -.03, 0.], [.25, -.08, 0.], [.22, -.03, 0.]],  # hand tips, thumbs
+    'kinetics': [[0., .72, -.08], [0., .55, 0.],                                  # nose, neck
+                 [.18, .55, 0.], [.22, .28, 0.], [.24, .05, 0.],                  # right arm
+                 [-.18, .55, 0.], [-.22, .28, 0.], [-.24, .05, 0.],               # left arm
+                 [.09, -.02, 0.], [.1, -.42, 0.], [.1, -.8, 0.],                  # right leg
+                 [-.09, -.02, 0.], [-.1, -.42, 0.], [-.1, -.8, 0.],               # left leg
+                 [.03, .76, -.07], [-.03, .76, -.07], [.07, .74, 0.], [-.07, .74, 0.]],  # eyes, ears
+}
+REST_POSES['ntu120'] = REST_POSES['ntu']
+
+# mutual actions (two persons) of NTU RGB+D 60 / 120
+MUTUAL_ACTIONS = set(range(50, 61)) | set(range(106, 121))
+
+# classes, setups and subjects of the datasets
+SCALES = {'ntu': (60, 17, 40), 'ntu120': (120, 32, 106), 'kinetics': (400, None, None)}
+
+
+def _tree(dataset):
+    """parent of every joint (-1 for the root) and the joints in the order of the tree"""
+    children, parents = SKELETONS[dataset]
+    num_joints = len(REST_POSES[dataset])
+    parent = [-1] * num_joints
+    for c, p in zip(children, parents):
+        parent[c] = p
+    order = [parent.index(-1)]
+    for j in order:
+        order += [c for c in range(num_joints) if parent[c] == j]
+    return parent, order
+
+
+def _rotations(axis, angle):
+    """rotation matrices (Rodrigues) of the unit ``axis`` [3] by the angles [T] -> [T, 3, 3]"""
+    k = np.array([[0., -axis[2], axis[1]], [axis[2], 0., -axis[0]], [-axis[1], axis[0], 0.]])
+    sin, cos = np.sin(angle)[:, None, None], np.cos(angle)[:, None, None]
+    return np.eye(3) + sin * k + (1. - cos) * (k @ k)
+
+
+def action_pattern(dataset, action, seed=0):
+    """joint rotations of an action class, the same for all its samples: per joint a rotation
+    axis, amplitude (rad), frequency (Hz) and phase of its oscillation"""
+    rng = np.random.default_rng([seed, action])
+    num_joints = len(REST_POSES[dataset])
+    axis = rng.normal(size=(num_joints, 3))
+    return {'axis': axis / np.linalg.norm(axis, axis=1, keepdims=True),
+            'amplitude': rng.uniform(0., .6, num_joints) * (rng.random(num_joints) < .6),
+            'frequency': rng.uniform(.2, 1.5, num_joints),
+            'phase': rng.uniform(0., 2 * math.pi, num_joints)}
+
+
+def body_motion(dataset, pattern, num_frames, rng, root=(0., 0., 3.), yaw=0., fps=30.):
+    """Joint positions [T, J, 3] of a body doing the action ``pattern`` (forward kinematics of
+    the skeleton tree, every joint rotating its bones about its axis), with the variations of a
+    sample: tempo, amplitude, size, position (``root``), orientation (``yaw``), drift and noise."""
+    parent, order = _tree(dataset)
+    rest = np.array(REST_POSES[dataset]) * rng.uniform(.9, 1.1)
+    t = np.arange(num_frames) / fps * rng.uniform(.8, 1.2)
+    amplitude = pattern['amplitude'] * rng.uniform(.8, 1.2)
+    phase = pattern['phase'] + rng.normal(0., .3, len(rest))
+
+    rotation = [None] * len(rest)
+    positions = np.zeros((num_frames, len(rest), 3))
+    for j in order:
+        local = _rotations(pattern['axis'][j], amplitude[j] * np.sin(2 * math.pi * pattern['frequency'][j] * t + phase[j]))
+        if parent[j] < 0:
+            rotation[j] = _rotations(np.array([0., 1., 0.]), np.full(num_frames, yaw)) @ local
+            drift = rng.normal(0., .1, 3) * t[:, None] / max(t[-1], 1.)
+            positions[:, j] = np.array(root) + rest[j] + drift
+        else:
+            rotation[j] = rotation[parent[j]] @ local
+            positions[:, j] = positions[:, parent[j]] + rotation[j] @ (rest[j] - rest[parent[j]])
+    return positions + rng.normal(0., .005, positions.shape)
+
+
+def ntu_filename(setup, camera, subject, replication, action):
+    return 'S%03dC%03dP%03dR%03dA%03d.skeleton' % (setup, camera, subject, replication, action)
+
+
+def ntu_samples(num_samples, dataset='ntu', seed=0, ignored=()):
+    """file names of ``num_samples`` distinct samples, the actions in turn (balanced), the
+    setups, cameras, subjects and replications at random, none of ``ignored``"""
+    num_actions, num_setups, num_subjects = SCALES[dataset]
+    rng = np.random.default_rng(seed)
+    names, seen = [], set(ignored)
+    while len(names) < num_samples:
+        name = ntu_filename(rng.integers(1, num_setups + 1), rng.integers(1, 4), rng.integers(1, num_subjects + 1),
+                            rng.integers(1, 3), len(names) % num_actions + 1)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def _ntu_bodies(name, dataset, seed):
+    action = int(name[name.find('A') + 1: name.find('A') + 4])
+    rng = np.random.default_rng([seed, int(''.join(c for c in name if c.isdigit()))])
+    # clip lengths of NTU RGB+D: about 30 to 300 frames, 2.5 s in the median at 30 fps
+    num_frames = int(np.clip(rng.lognormal(math.log(75.), .35), 32, 300))
+    pattern = action_pattern(dataset, action, seed)
+    if action in MUTUAL_ACTIONS:  # two persons facing each other
+        x = rng.uniform(.3, .6)
+        return [body_motion(dataset, pattern, num_frames, rng, root=(-x, 0., 3.2), yaw=math.pi / 2),
+                body_motion(dataset, pattern, num_frames, rng, root=(x, 0., 3.2), yaw=-math.pi / 2)], rng
+    root = (rng.uniform(-.5, .5), rng.uniform(-.2, .2), rng.uniform(2.5, 4.))
+    return [body_motion(dataset, pattern, num_frames, rng, root=root, yaw=rng.uniform(-.5, .5))], rng
+
+
+def write_skeleton(path, name, dataset='ntu', seed=0):
+    """Writes the .skeleton file ``name`` (its action from the name) in the format of the Kinect
+    v2 files of NTU RGB+D: frames, bodies, their 25 joints (camera space, depth and color
+    pixels, orientation, tracking state)."""
+    bodies, rng = _ntu_bodies(name, dataset, seed)
+    ids = rng.integers(72057594037927936, 72057594037999999, len(bodies))
+    lines = [str(bodies[0].shape[0])]
+    for t in range(bodies[0].shape[0]):
+        lines.append(str(len(bodies)))
+        for body_id, body in zip(ids, bodies):
+            lines.append('%d 0 1 1 1 1 0 %.7f %.7f 2' % (body_id, rng.normal(0., .05), rng.normal(0., .05)))
+            lines.append(str(body.shape[1]))
+            for x, y, z in body[t]:
+                lines.append('%.7f %.7f %.7f %.4f %.4f %.3f %.3f 0 0 0 0 2' % (
+                    x, y, z, 256. + 365. * x / z, 212. - 365. * y / z, 960. + 1060. * x / z, 540. - 1060. * y / z))
+    with open(osp.join(path, name), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return name
+
+
+def write_kinetics(path, index, seed=0):
+    """Writes the video ``index`` of the skeleton Kinetics format (OpenPose 18 joints in
+    normalized image coordinates and their scores, per frame), returns its name and label"""
+    num_actions = SCALES['kinetics'][0]
+    rng = np.random.default_rng([seed, index])
+    name = ''.join(rng.choice(list(string.ascii_letters + string.digits + '-_'), 11))
+    action = index % num_actions
+    # 10 s clips at 30 fps, some cut short
+    num_frames = 300 if rng.random() < .8 else int(rng.integers(100, 300))
+    pattern = action_pattern('kinetics', action, seed)
+    bodies = [body_motion('kinetics', pattern, num_frames, rng,
+                          root=(rng.uniform(-.8, .8), rng.uniform(-.2, .2), rng.uniform(2., 5.)),
+                          yaw=rng.uniform(-.5, .5)) for _ in range(rng.choice([1, 2], p=[.7, .3]))]
+    data = []
+    for t in range(num_frames):
+        skeletons = []
+        if rng.random() > .02:  # frames without detection
+            for body in bodies:
+                xy = np.stack([.5 + .35 * body[t, :, 0] / body[t, :, 2], .5 - .35 * body[t, :, 1] / body[t, :, 2]], -1)
+                skeletons.append({'pose': np.round(np.clip(xy, 0., 1.), 3).ravel().tolist(),
+                                  'score': np.round(rng.uniform(.3, 1., len(xy)), 3).tolist()})
+        data.append({'frame_index': t + 1, 'skeleton': skeletons})
+    with open(osp.join(path, name + '.json'), 'w') as f:
+        json.dump({'data': data, 'label': 'action_%03d' % action, 'label_index': action}, f)
+    return name, action
+
+
+def main():
+    """Writes ``--synthetic_samples`` synthetic raw samples of ``--synthetic_dataset`` to
+    ``--synthetic_out`` (default: dataset_root/raw, where SkeletonDataset reads them), e.g. for
+    the benchmarks of the ingestion, the loaders and the training without the real datasets::
+
+        python synthetic.py --synthetic_dataset ntu --synthetic_samples 2000
+        python datagen.py
+
+    ntu / ntu120: NTU RGB+D .skeleton files named SsssCcccPpppRrrrAaaa (the actions in turn,
+    setups, cameras, subjects and replications at random; two bodies for the mutual actions).
+    kinetics: the json files of the skeleton Kinetics and their labels in <out>_label.json.
+    The motion of an action is the same oscillation of the joints of the skeleton for all its
+    samples (with per sample variations), the files only depend on ``--seed``.
+    """
+    args = make_args()
+    dataset = args.synthetic_dataset
+    out = args.synthetic_out or osp.join(args.dataset_root, 'raw')
+    os.makedirs(out, exist_ok=True)
+
+    with Pool(processes=args.synthetic_workers or os.cpu_count()) as pool:
+        if dataset == 'kinetics':
+            labels = pool.map(partial(write_kinetics, out, seed=args.seed), range(args.synthetic_samples))
+            with open(out.rstrip('/') + '_label.json', 'w') as f:
+                json.dump({name: {'has_skeleton': True, 'label': 'action_%03d' % action, 'label_index': action}
+                           for name, action in labels}, f)
+        else:
+            missing = osp.join(os.getcwd(), 'samples_with_missing_skeletons.txt' if dataset == 'ntu'
+                               else 'samples_with_missing_skeletons_120.txt')
+            ignored = []
+            if osp.exists(missing):
+                with open(missing) as f:
+                    ignored = [line.strip() + '.skeleton' for line in f]
+            names = ntu_samples(args.synthetic_samples, dataset, args.seed, ignored)
+            pool.map(partial(write_skeleton, out, dataset=dataset, seed=args.seed), names, chunksize=16)
+    print('{} {} samples written to {}'.format(args.synthetic_samples, dataset, out))
+
+
+if __name__ == '__main__':
+    main()
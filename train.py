@@ -1,67 +1,27 @@
-import os
 import os.path as osp
 import time
 from random import shuffle
 
-import matplotlib
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
-
-import numpy as np
 import torch
 import torch.nn as nn
 from tensorboardX import SummaryWriter
-from torch_geometric.data import DataLoader
 from tqdm import tqdm, trange
 
 from args import make_args
 from data.dataset3 import SkeletonDataset
 from models.net import DualGraphEncoder
-from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts
-from utility.helper import make_checkpoint, load_checkpoint
+from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts, l2_penalty, l2_regularize_
+from models.powernorm import scale_warmup
+from utility.checkpoint import CheckpointManager, ResumableSampler, training_state, restore_training_state
+from utility.helper import load_checkpoint, autocast, GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
+from utility.telemetry import GradientTelemetry
+from utility.tta import TestTimeAugmentation
 from random import shuffle
 #import imageio
 #import adamod
 
-def gif_grad_flow(path, gif_path, name):
-    with imageio.get_writer(osp.join(gif_path, name + '.gif'), mode='I') as writer:
-        for filename in path:
-            image = imageio.imread(filename)
-            writer.append_data(image)
-
-    for filename in path:
-        os.remove(filename)
-
-def plot_grad_flow(named_parameters, path, writer, step):
-    ave_grads = []
-    layers = []
-    empty_grads = []
-    # total_norm = 0
-    for n, p in named_parameters:
-        if p.requires_grad and not (("bias" in n) or ("norm" in n) or ("bn" in n) or ("gain" in n)):
-            if p.grad is not None:
-                # writer.add_scalar('gradients/' + n, p.grad.norm(2).item(), step)
-                # writer.add_histogram('gradients/' + n, p.grad, step)
-                # total_norm += p.grad.data.norm(2).item()
-                layers.append(n)
-                ave_grads.append(p.grad.abs().mean().cpu().item())
-            else:
-                empty_grads.append({n: p.mean().cpu().item()})
-    # total_norm = total_norm ** (1. / 2)
-    # print("Norm : ", total_norm)
-    #plt.tight_layout()
-    plt.plot(ave_grads, alpha=0.3, color="b")
-    plt.hlines(0, 0, len(ave_grads) + 1, linewidth=1.5, color="k")
-    plt.xticks(np.arange(0, len(ave_grads), 1), layers, rotation="vertical", fontsize=4)
-    plt.xlim(xmin=0, xmax=len(ave_grads))
-    plt.xlabel("Layers")
-    plt.ylabel("average gradient")
-    plt.title("Gradient flow" + str(step))
-    plt.grid(True)
-    plt.savefig(path, dpi=300)
-    #plt.close()
-    # plt.show()
-
 
 def run_epoch(data_loader,
               model,
@@ -73,7 +33,10 @@ def run_epoch(data_loader,
               desc=None,
               args=None,
               writer=None,
-              epoch_num=0):
+              epoch_num=0,
+              telemetry=None,
+              checkpoint=None,
+              tta=None):
     """Standard Training and Logging Function
 
         :param data_loader:
@@ -87,43 +50,51 @@ def run_epoch(data_loader,
         :param args:
         :param writer:
         :param epoch_num:
+        :param telemetry: GradientTelemetry of the gradient norms and flow plots (every
+                          args.telemetry_interval optimizer steps, a plot every 400)
+        :param checkpoint: called with the number of batches done every args.save_interval
+                           optimizer steps, e.g. to save a mid-epoch checkpoint
+        :param tta: TestTimeAugmentation of the evaluation (logits averaged over the views)
 
     """
     # torch.autograd.set_detect_anomaly(True)
-    running_loss = 0.
-    accuracy = 0.
-    correct = 0
-    total_samples = 0
+    metrics = RunningMetrics()
     start = time.time()
     total_batch = len(dataset) // args.batch_size + 1
-    gradflow_file_list = []
-    for i, batch in tqdm(enumerate(data_loader),
-                         total=total_batch,
-                         desc=desc):
-        batch = batch.to(device)
-        sample, label, bi = batch.x, batch.y, batch.batch.to(device)
-
-        with torch.set_grad_enabled(is_train):
-            out = model(sample, adj=dataset.skeleton_.to(device), bi=bi)
-            loss = loss_compute(out, label.long())
+    adj = dataset.skeleton_.to(device)
+    accumulator = GradientAccumulator(model, args.accum_steps, len(data_loader))
+    for i, (batch, seq) in tqdm(enumerate(data_loader),
+                                total=total_batch,
+                                desc=desc):
+        batch, seq = batch.to(device), seq.to(device)
+        sample, label, bi = batch.x, batch.y, seq
+
+        with torch.set_grad_enabled(is_train), accumulator.sync(i):
+            with autocast(device, args.precision):
+                if tta is not None and not is_train:
+                    out = tta(model, sample, bi, adj=adj)
+                else:
+                    out = model(sample, adj=adj, bi=bi)
+            loss = loss_compute(out.float(), label.long())
             loss_ = loss
             if is_train:
-                l2_lambda = args.weight_decay
-                for param in model.parameters():
-                    if param.requires_grad:
-                        loss += l2_lambda * torch.sum(((param)) ** 2)
-                
-                optimizer.zero_grad()
-                loss.backward()
-                # torch.nn.utils.clip_grad_norm_(model.parameters(), 9.0)
-                optimizer.step()
-                if i % 400 == 0:
-                    step = (i + 1) + total_batch * epoch_num
-                    path = osp.join(os.getcwd(), 'gradflow')
-                    if not osp.exists(path):
-                        os.mkdir(path)
-                    plot_grad_flow(model.named_parameters(), osp.join(path, '%3d:%d.png' % (epoch_num, i)), writer, step)
-                    gradflow_file_list.append(osp.join(path, '%3d:%d.png' % (epoch_num, i)))
+                if i % args.accum_steps == 0:
+                    optimizer.zero_grad()
+                accumulator.scale(loss, i).backward()
+                if not accumulator.is_step(i):
+                    # the penalty of the parameters of the window, reported with every micro-batch
+                    loss_ = loss + l2_penalty(model.parameters(), args.weight_decay)
+                else:
+                    loss_ = loss + l2_regularize_(model.parameters(), args.weight_decay)
+                    # torch.nn.utils.clip_grad_norm_(model.parameters(), 9.0)
+                    optimizer.step()
+                    update = i // args.accum_steps
+                    plot = update % 400 == 0
+                    if telemetry is not None and (update % args.telemetry_interval == 0 or plot):
+                        step = (i + 1) + total_batch * epoch_num
+                        telemetry.snapshot(step, plot=plot, **{'train/step_loss': loss_})
+                    if checkpoint is not None and args.save_interval and (update + 1) % args.save_interval == 0:
+                        checkpoint(i + 1)
 
                 # plot_grad_flow(model.named_parameters(), writer, (i + 1) + total_batch * epoch_num)
                 # for name, param in model.named_parameters():
@@ -131,23 +102,15 @@ def run_epoch(data_loader,
                 # writer.add_scalar('gradients/' + name, param.grad.norm(2).item(), (i + 1) + total_batch * epoch_num)
 
             # statistics
-            running_loss += loss_.item()
-            pred = torch.max(out, 1)[1]
-            total_samples += label.size(0)
-            correct += (pred == label).double().sum().item()
-    
-    gif_path = osp.join(os.getcwd(), 'gif_gradlow')
-    if not osp.exists(gif_path):
-        os.mkdir(gif_path)
-    #gif_grad_flow(gradflow_file_list, gif_path, str(epoch_num))
-    gradflow_file_list = []
+            metrics.update(loss_, out, label)
 
+    result = metrics.compute()
     elapsed = time.time() - start
-    accuracy = correct / total_samples * 100.
+    accuracy = result['accuracy']
     print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
-          (running_loss / total_batch, accuracy, elapsed / len(dataset)))
+          (result['loss'], accuracy, elapsed / len(dataset)))
 
-    return running_loss / total_batch, accuracy
+    return result['loss'], accuracy
 
 
 def main():
@@ -182,9 +145,9 @@ def main():
     # train_loader = DataLoader(train_ds.data,
     #                          batch_size=args.batch_size,
     #                          shuffle=True)
-    test_loader = DataLoader(test_ds,
-                             batch_size=args.batch_size,
-                             shuffle=True)
+    test_loader = SequenceDataLoader(test_ds,
+                                     batch_size=args.batch_size,
+                                     shuffle=True)
 
     # criterion = LabelSmoothing(V, padding_idx=dataset.pad_id, smoothing=0.1)
     # make_model black box
@@ -197,7 +160,7 @@ def main():
                              sequential=False,
                              num_conv_layers=args.num_conv_layers,
                              drop_rate=args.drop_rate)
-    model = model.to(device)
+    model = scale_warmup(model, args.accum_steps).to(device)
     print(sum(p.numel() for p in model.parameters()))
     # noam_opt = get_std_opt(model, args)
 
@@ -213,22 +176,51 @@ def main():
                                            model, optimizer)
         print("Load Model: ", last_epoch)
 
+    # checkpoints written in the background, the last and best ones are kept
+    checkpoints = CheckpointManager(args.save_root, args.save_name, args.keep_last, args.keep_best,
+                                    args.keep_epochs or None)
+    sampler_state = None
+    if args.resume and checkpoints.latest() is not None:
+        state = checkpoints.load_latest(device)
+        last_epoch, _ = restore_training_state(state, model, optimizer, lr_scheduler)
+        train_ds = train_ds[state['order']]
+        if state['batch'] > 0:  # mid-epoch: same split, the sampler skips the batches done
+            sampler_state = state['sampler_state_dict']
+        print("Resume: epoch {} batch {}".format(last_epoch, state['batch']))
+
     loss_compute = nn.CrossEntropyLoss().to(device)
+    telemetry = GradientTelemetry(writer, model, plot_dir=args.gradflow_dir)
+    tta = TestTimeAugmentation(window_sizes=[int(w) for w in args.tta_windows.split(',')],
+                               angles=[float(a) for a in args.tta_angles.split(',')]) if args.tta else None
 
     for epoch in trange(last_epoch, args.epoch_num + last_epoch):
-        shuffled_list = [i for i in range(len(train_ds))]
-        shuffle(shuffled_list)
-        train_ds = train_ds[shuffled_list]
+        if sampler_state is None:
+            shuffled_list = [i for i in range(len(train_ds))]
+            shuffle(shuffled_list)
+            train_ds = train_ds[shuffled_list]
 
         train_ds_ = train_ds[:last_train]
         valid_ds_ = train_ds[last_train:]
 
-        train_loader = DataLoader(train_ds_,
-                                  batch_size=args.batch_size,
-                                  shuffle=True)
-        valid_loader = DataLoader(valid_ds_,
-                                  batch_size=args.batch_size,
-                                  shuffle=True)
+        train_sampler = ResumableSampler(train_ds_, seed=args.seed)
+        train_sampler.set_epoch(epoch)
+        if sampler_state is not None:
+            train_sampler.load_state_dict(sampler_state)
+            sampler_state = None
+        first_batch = train_sampler.start // args.batch_size
+
+        def save(batches):
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch, first_batch + batches,
+                                            sampler_state=train_sampler.state_dict(batches * args.batch_size),
+                                            order=train_ds.indices()),
+                             step='{}_{}'.format(epoch, first_batch + batches))
+
+        train_loader = SequenceDataLoader(train_ds_,
+                                          batch_size=args.batch_size,
+                                          sampler=train_sampler)
+        valid_loader = SequenceDataLoader(valid_ds_,
+                                          batch_size=args.batch_size,
+                                          shuffle=True)
         # print('Epoch: {} Training...'.format(epoch))
         model.train(True)
         lr = optimizer.state_dict()['param_groups'][0]['lr']
@@ -236,16 +228,14 @@ def main():
 
         loss, accuracy = run_epoch(train_loader, model, optimizer,
                                    loss_compute, train_ds_, device, is_train=True,
-                                   desc="Train Epoch {}".format(epoch + 1), args=args, writer=writer, epoch_num=epoch)
+                                   desc="Train Epoch {}".format(epoch + 1), args=args, writer=writer, epoch_num=epoch,
+                                   telemetry=telemetry, checkpoint=save)
         print('Epoch: {} Evaluating...'.format(epoch + 1))
 
         # TODO Save model
         writer.add_scalar('train/train_loss', loss, epoch + 1)
         writer.add_scalar('train/train_overall_acc', accuracy, epoch + 1)
 
-        if epoch % args.epoch_save == 0:
-            make_checkpoint(args.save_root, args.save_name, epoch, model, optimizer, loss)
-
         # Validation
         model.eval()
         loss, accuracy = run_epoch(valid_loader, model, optimizer,
@@ -258,15 +248,23 @@ def main():
         # if epoch > 15:
         lr_scheduler.step()
 
+        # save_name_<epoch>.pickle, also read by load_checkpoint (--load_model)
+        if epoch % args.epoch_save == 0:
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch + 1, 0,
+                                            order=train_ds.indices(), loss=loss),
+                             step=epoch, metric=accuracy, epoch=True)
+
         if (epoch+1) % 5 == 0:
             model.eval()
             loss, accuracy = run_epoch(test_loader, model, optimizer,
                                     loss_compute, test_ds, device, is_train=False,
-                                    desc="Final test: ", args=args, writer=writer, epoch_num=epoch)
+                                    desc="Final test: ", args=args, writer=writer, epoch_num=epoch, tta=tta)
 
             writer.add_scalar('test/test_loss', loss, epoch + 1)
             writer.add_scalar('test/test_overall_acc', accuracy, epoch + 1)
 
+    telemetry.close()
+    checkpoints.close()
     writer.export_scalars_to_json(osp.join(args.log_dir, "all_scalars.json"))
     writer.close()
 
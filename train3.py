@@ -10,14 +10,19 @@ import numpy as np
 import torch
 import torch.nn as nn
 from tensorboardX import SummaryWriter
-from torch_geometric.data import DataLoader
 from tqdm import tqdm, trange
 
 from args import make_args
-from data.dataset3 import SkeletonDataset, skeleton_parts
+from data.dataset3 import SkeletonDataset, skeleton_parts, skeleton_hops, skeleton_edge_hops
+from models.kernels import redraw_on_step
 from models.net2s import DualGraphEncoder
-from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts, ZeroOneClipper, MaxOneClipper, LabelSmoothingCrossEntropy
-from utility.helper import make_checkpoint, load_checkpoint
+from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts, LabelSmoothingCrossEntropy
+from models.powernorm import scale_warmup
+from utility.checkpoint import CheckpointManager, ResumableSampler, training_state, restore_training_state
+from utility.helper import load_checkpoint, autocast, GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
+from utility.tta import TestTimeAugmentation
 from random import shuffle
 
 matplotlib.use('Agg')
@@ -92,10 +97,14 @@ def run_epoch(data_loader,
               writer=None,
               epoch_num=0,
               adj=None,
-              l1_penalty=False):
+              hops=None,
+              l1_penalty=False,
+              checkpoint=None,
+              tta=None):
     """Standard Training and Logging Function
 
         :param adj:
+        :param hops: hop distance of every edge of adj, for the hop bias (None: without)
         :param data_loader:
         :param model:
         :param optimizer:
@@ -107,24 +116,29 @@ def run_epoch(data_loader,
         :param args:
         :param writer:
         :param epoch_num:
+        :param checkpoint: called with the number of batches done every args.save_interval
+                           optimizer steps, e.g. to save a mid-epoch checkpoint
+        :param tta: TestTimeAugmentation of the evaluation (logits averaged over the views)
 
     """
     # torch.autograd.set_detect_anomaly(True)
-    running_loss = 0.
-    accuracy = 0.
-    correct = 0
-    total_samples = 0
+    metrics = RunningMetrics(confusion=is_test)
     start = time.time()
     total_batch = len(dataset) // args.batch_size + 1
-    for i, batch in tqdm(enumerate(data_loader),
-                         total=total_batch,
-                         desc=desc):
-        batch = batch.to(device)
-        sample, label, bi = batch.x, batch.y, batch.batch
-
-        with torch.set_grad_enabled(is_train) and torch.autograd.set_detect_anomaly(True):
-            out = model(sample, adj=adj, bi=bi)
-            loss = loss_compute(out, label.long())
+    accumulator = GradientAccumulator(model, args.accum_steps, len(data_loader))
+    for i, (batch, seq) in tqdm(enumerate(data_loader),
+                                total=total_batch,
+                                desc=desc):
+        batch, seq = batch.to(device), seq.to(device)
+        sample, label, bi = batch.x, batch.y, seq
+
+        with torch.set_grad_enabled(is_train) and torch.autograd.set_detect_anomaly(True), accumulator.sync(i):
+            with autocast(device, args.precision):
+                if tta is not None and not is_train:
+                    out = tta(model, sample, bi, adj=adj, hops=hops)
+                else:
+                    out = model(sample, adj=adj, bi=bi, hops=hops)
+            loss = loss_compute(out.float(), label.long())
             loss_ = loss
             if is_train:
                 if l1_penalty:
@@ -134,9 +148,14 @@ def run_epoch(data_loader,
                         l1_loss += l1p(param, target=torch.zeros_like(param))
                     factor = 0.9
                     loss += l1_loss * factor                    #l1_regularization
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                if i % args.accum_steps == 0:
+                    optimizer.zero_grad()
+                accumulator.scale(loss, i).backward()
+                if accumulator.is_step(i):
+                    optimizer.step()
+                    update = i // args.accum_steps
+                    if checkpoint is not None and args.save_interval and (update + 1) % args.save_interval == 0:
+                        checkpoint(i + 1)
                 if i % 400 == 0:
                     step = (i + 1) + total_batch * epoch_num
                     path = osp.join(os.getcwd(), args.gradflow_dir)
@@ -146,23 +165,22 @@ def run_epoch(data_loader,
                                    step)
 
             # statistics
-            running_loss += loss_.item()
-            pred = torch.max(out, 1)[1]
-            total_samples += label.size(0)
-            corr = (pred == label)
-            correct += corr.double().sum().item()
-            if is_test:
-                for j in range(len(label)):
-                    gt_list[label[j].item()] += 1
-                    cr_list[label[j].item()] += corr[j].item()
-                    wr_list[label[j].item()] += not (corr[j].item())
+            metrics.update(loss_, out, label)
 
+    if metrics.confusion:
+        gt, cr, wr = metrics.class_counts()
+        for j in range(len(gt)):
+            gt_list[j] += gt[j]
+            cr_list[j] += cr[j]
+            wr_list[j] += wr[j]
+
+    result = metrics.compute()
     elapsed = time.time() - start
-    accuracy = correct / total_samples * 100.
+    accuracy = result['accuracy']
     print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
-          (running_loss / total_batch, accuracy, elapsed / len(dataset)))
+          (result['loss'], accuracy, elapsed / len(dataset)))
 
-    return running_loss / total_batch, accuracy
+    return result['loss'], accuracy
 
 
 def main():
@@ -182,13 +200,15 @@ def main():
                               benchmark=args.benchmark, sample='val')
 
     adj = skeleton_parts(dataset=args.dataset_name)[0].to(device)
+    hops = skeleton_edge_hops(args.dataset_name, args.max_hops, device) if args.hop_bias else None
 
-    train_loader = DataLoader(train_ds.data,
-                              batch_size=args.batch_size,
-                              shuffle=True)
-    test_loader = DataLoader(test_ds,
-                             batch_size=args.batch_size,
-                             shuffle=True)
+    train_sampler = ResumableSampler(train_ds, seed=args.seed)
+    train_loader = SequenceDataLoader(train_ds,
+                                      batch_size=args.batch_size,
+                                      sampler=train_sampler)
+    test_loader = SequenceDataLoader(test_ds,
+                                     batch_size=args.batch_size,
+                                     shuffle=True)
 
     last_epoch = 0
     model = DualGraphEncoder(in_channels=args.in_channels,
@@ -197,22 +217,31 @@ def main():
                              mlp_head_hidden=args.mlp_head_hidden,
                              num_layers=args.num_enc_layers,
                              num_heads=args.heads,
-                             num_features=args.num_features,
                              sequential=False,
                              num_conv_layers=args.num_conv_layers,
-                             drop_rate=args.drop_rate)
+                             drop_rate=args.drop_rate,
+                             checkpoint=args.checkpoint,
+                             feature_map=args.feature_map,
+                             nb_features=args.nb_features,
+                             redraw_interval=args.redraw_interval,
+                             temporal_attention=args.temporal_attention,
+                             hop_table=skeleton_hops(args.dataset_name, args.dataset_root) if args.hop_bias else None,
+                             max_hops=args.max_hops)
 
     if torch.cuda.device_count() > 1 and args.data_parallel:
         num_gpu = torch.cuda.device_count()
         print("Let's use ", num_gpu, " GPUs!")
         adj = torch.stack([adj] * num_gpu).to(device)
+        if hops is not None:
+            hops = torch.stack([hops] * num_gpu).to(device)
         model = nn.DataParallel(model)
 
-    model = model.to(device)
+    model = scale_warmup(model, args.accum_steps).to(device)
     print(sum(p.numel() for p in model.parameters()))
     # noam_opt = get_std_opt(model, args)
 
     optimizer = SGD_AGC(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
+    redraw_on_step(model, optimizer)
     # optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     # decay_rate = 0.96
     # lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=decay_rate)
@@ -220,7 +249,7 @@ def main():
                                                  min_lr=1e-4, warmup_steps=3, gamma=0.7)
 
     # weight_clipper = ZeroOneClipper()
-    weight_clipper = MaxOneClipper()
+    # weight_clipper = MaxOneClipper()
 
     if args.load_model:
         last_epoch = args.load_epoch
@@ -229,14 +258,38 @@ def main():
                                            model, optimizer)
         print("Load Model: ", last_epoch)
 
+    # checkpoints written in the background, the last and best ones are kept
+    checkpoints = CheckpointManager(args.save_root, args.save_name, args.keep_last, args.keep_best,
+                                    args.keep_epochs or None)
+    sampler_state = None
+    if args.resume and checkpoints.latest() is not None:
+        state = checkpoints.load_latest(device)
+        last_epoch, _ = restore_training_state(state, model, optimizer, lr_scheduler)
+        if state['batch'] > 0:  # mid-epoch: the sampler skips the batches done
+            sampler_state = state['sampler_state_dict']
+        print("Resume: epoch {} batch {}".format(last_epoch, state['batch']))
+
     loss_compute = LabelSmoothingCrossEntropy().to(device)
     l1_penalty = False
+    tta = TestTimeAugmentation(window_sizes=[int(w) for w in args.tta_windows.split(',')],
+                               angles=[float(a) for a in args.tta_angles.split(',')]) if args.tta else None
 
     for epoch in trange(last_epoch, args.epoch_num + last_epoch):
         gt_list = [0 for _ in range(60)]
         cr_list = [0 for _ in range(60)]
         wr_list = [0 for _ in range(60)]
 
+        train_sampler.set_epoch(epoch)
+        if sampler_state is not None:
+            train_sampler.load_state_dict(sampler_state)
+            sampler_state = None
+        first_batch = train_sampler.start // args.batch_size
+
+        def save(batches):
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch, first_batch + batches,
+                                            sampler_state=train_sampler.state_dict(batches * args.batch_size)),
+                             step='{}_{}'.format(epoch, first_batch + batches))
+
         model.train(True)
         lr = optimizer.state_dict()['param_groups'][0]['lr']
         writer.add_scalar('params/lr', lr, epoch)
@@ -247,6 +300,8 @@ def main():
                                                desc="Train Epoch {}".format(epoch + 1), args=args, writer=writer,
                                                epoch_num=epoch,
                                                adj=adj,
+                                               hops=hops,
+                                               checkpoint=save,
                                                l1_penalty=l1_penalty)
         print('Epoch: {} Evaluating...'.format(epoch + 1))
 
@@ -254,15 +309,13 @@ def main():
         writer.add_scalar('train/train_loss', train_loss, epoch + 1)
         writer.add_scalar('train/train_overall_acc', train_accuracy, epoch + 1)
 
-        if epoch % args.epoch_save == 0:
-            make_checkpoint(args.save_root, args.save_name, epoch, model, optimizer, train_loss)
-
         # Validation
         model.eval()
         test_loss, test_accuracy = run_epoch(test_loader, model, optimizer,
                                              loss_compute, test_ds, device, gt_list=gt_list, cr_list=cr_list,
                                              wr_list=wr_list, is_train=False, is_test=True,
-                                             desc="Final test: ", args=args, writer=writer, epoch_num=epoch, adj=adj, l1_penalty=l1_penalty)
+                                             desc="Final test: ", args=args, writer=writer, epoch_num=epoch, adj=adj,
+                                             hops=hops, l1_penalty=l1_penalty, tta=tta)
 
         writer.add_scalar('test/test_loss', test_loss, epoch + 1)
         writer.add_scalar('test/test_overall_acc', test_accuracy, epoch + 1)
@@ -272,6 +325,11 @@ def main():
         # if epoch > 15:
 
         lr_scheduler.step()
+
+        # save_name_<epoch>.pickle, also read by load_checkpoint (--load_model)
+        if epoch % args.epoch_save == 0:
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch + 1, 0, loss=train_loss),
+                             step=epoch, metric=test_accuracy, epoch=True)
         if train_accuracy - 5 > test_accuracy:
             l1_penalty=True
         #     model.apply(weight_clipper)
@@ -281,6 +339,7 @@ def main():
         #         if ('ffn' in name or 'mlp_head'in name) and isinstance(module, nn.Linear):
         #             module.apply(weight_clipper)
 
+    checkpoints.close()
     writer.export_scalars_to_json(osp.join(args.log_dir, "all_scalars.json"))
     writer.close()
 
@@ -1,29 +1,46 @@
 import os
 import time
 import torch
-import torch.nn.functional as F
 import torch.multiprocessing as mp
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data.distributed import DistributedSampler
 
-from torch_geometric.data import DataLoader
-import torch_geometric.transforms as T
-
-from data.dataset3 import SkeletonDataset, skeleton_parts
+from data.dataset3 import SkeletonDataset, skeleton_hops, skeleton_edge_hops
+from data.topology import get_topology
+from models.kernels import redraw_on_step
 from models.net2s import DualGraphEncoder
 from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts, LabelSmoothingCrossEntropy
-from utility.helper import make_checkpoint, load_checkpoint
-from random import shuffle
+from models.powernorm import scale_warmup
+from utility.helper import autocast, GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
 from tqdm import tqdm, trange
 from args import make_args
 
 
-def run(rank, world_size):
-    os.environ['MASTER_ADDR'] = 'localhost'
-    os.environ['MASTER_PORT'] = '12355'
-    dist.init_process_group('nccl', rank=rank, world_size=world_size)
-    args = make_args()
+def setup(local_rank, nproc_per_node, args):
+    """Joins the process group, returns the global rank, the world size and the device of
+    the process. On CPU, the process gets its own slice of the cores of the node."""
+    rank = args.node_rank * nproc_per_node + local_rank
+    world_size = args.nnodes * nproc_per_node
+    if args.backend == 'nccl':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        share = max(len(cores) // nproc_per_node, 1)
+        cores = cores[local_rank * share:(local_rank + 1) * share] or cores
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(args.threads or len(cores))
+    dist.init_process_group(args.backend, init_method=args.init_method, rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+
+def run(local_rank, nproc_per_node, args):
+    rank, world_size, device = setup(local_rank, nproc_per_node, args)
 
     train_ds = SkeletonDataset(args.dataset_root, name='ntu_60',
                                use_motion_vector=False, sample='train')
@@ -31,14 +48,12 @@ def run(rank, world_size):
     test_ds = SkeletonDataset(args.dataset_root, name='ntu_60',
                               use_motion_vector=False, sample='val')
 
-    shuffled_list = [i for i in range(len(train_ds))]
-    shuffle(shuffled_list)
-    train_ds = train_ds[shuffled_list]
-
+    # every rank trains on its shard of a permutation drawn from the epoch (set_epoch)
     train_sampler = DistributedSampler(train_ds, num_replicas=world_size,
-                                       rank=rank)
-    train_loader = DataLoader(train_ds,
-                              batch_size=args.batch_size)
+                                       rank=rank, shuffle=True)
+    train_loader = SequenceDataLoader(train_ds,
+                                      batch_size=args.batch_size,
+                                      sampler=train_sampler)
 
     model = DualGraphEncoder(in_channels=args.in_channels,
                              hidden_channels=args.hid_channels,
@@ -48,84 +63,99 @@ def run(rank, world_size):
                              num_heads=args.heads,
                              sequential=False,
                              num_conv_layers=args.num_conv_layers,
-                             drop_rate=args.drop_rate).to(rank)
-    model = DistributedDataParallel(model, device_ids=[rank])
+                             drop_rate=args.drop_rate,
+                             checkpoint=args.checkpoint,
+                             feature_map=args.feature_map,
+                             nb_features=args.nb_features,
+                             redraw_interval=args.redraw_interval,
+                             temporal_attention=args.temporal_attention,
+                             hop_table=skeleton_hops(args.dataset_name, args.dataset_root) if args.hop_bias else None,
+                             max_hops=args.max_hops)
+    model = scale_warmup(model, args.accum_steps).to(device)
+    model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    redraw_on_step(model, optimizer)
     # optimizer = SGD_AGC(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.weight_decay)
     loss_compute = LabelSmoothingCrossEntropy()
 
-    if rank == 0:
-        test_loader = DataLoader(test_ds,
-                                 batch_size=args.batch_size)
+    # the evaluation is sharded without padding (no sample counted twice), the metrics of the
+    # shards are all-reduced
+    test_loader = SequenceDataLoader(test_ds[list(range(rank, len(test_ds), world_size))],
+                                     batch_size=args.batch_size)
 
     last_epoch = 0
-    adj = skeleton_parts()[0].to(rank)
+    adj = get_topology(args.dataset_name, device=device).edge_index
+    hops = skeleton_edge_hops(args.dataset_name, args.max_hops, device) if args.hop_bias else None
 
     for epoch in range(last_epoch, args.epoch_num + last_epoch):
         model.train()
-        running_loss = 0.
-        accuracy = 0.
-        correct = 0
-        total_samples = 0
+        train_sampler.set_epoch(epoch)
+        metrics = RunningMetrics()
         start = time.time()
-        total_batch = len(train_ds) // args.batch_size + 1
-
-        for i, batch in tqdm(enumerate(train_loader),
-                             total=total_batch,
-                             desc="Train Epoch {}".format(epoch + 1)):
-            batch = batch.to(rank)
-            sample, label, bi = batch.x, batch.y, batch.batch
-            optimizer.zero_grad()
-            out = model(sample, adj=adj, bi=bi)
-            loss = loss_compute(out, label.long())
-            loss.backward()
-            optimizer.step()
-
-            running_loss += loss.item()
-            pred = torch.max(out, 1)[1]
-            total_samples += label.size(0)
-            corr = (pred == label)
-            correct += corr.double().sum().item()
+        accumulator = GradientAccumulator(model, args.accum_steps, len(train_loader))
+
+        for i, (batch, seq) in tqdm(enumerate(train_loader),
+                                    total=len(train_loader),
+                                    desc="Train Epoch {}".format(epoch + 1),
+                                    disable=rank != 0):
+            batch, seq = batch.to(device), seq.to(device)
+            sample, label, bi = batch.x, batch.y, seq
+            if i % args.accum_steps == 0:
+                optimizer.zero_grad()
+            # the gradients are all-reduced on the last micro-batch of the window only
+            with accumulator.sync(i):
+                with autocast(device, args.precision):
+                    out = model(sample, adj=adj, bi=bi, hops=hops)
+                loss = loss_compute(out.float(), label.long())
+                accumulator.scale(loss, i).backward()
+            if accumulator.is_step(i):
+                optimizer.step()
+
+            metrics.update(loss, out, label)
+        # statistics of all the processes
+        result = metrics.compute(distributed=True)
         elapsed = time.time() - start
-        accuracy = correct / total_samples * 100.
-        print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
-              (running_loss / total_batch, accuracy, elapsed / len(train_ds)))
-
-        dist.barrier()
-
-        if rank == 0:  # We evaluate on a single GPU for now.
-            model.eval()
-            running_loss = 0.
-            accuracy = 0.
-            correct = 0
-            total_samples = 0
-            start = time.time()
-            total_batch = len(test_ds) // args.batch_size + 1
-            # adj = skeleton_parts()[0].to(rank)
-
-            for i, batch in tqdm(enumerate(test_loader),
-                                 total=total_batch,
-                                 desc="Test: "):
-                batch = batch.to(rank)
-                sample, label, bi = batch.x, batch.y, batch.batch
-                with torch.no_grad():
-                    out = model.module(sample, adj=adj, bi=bi)
-                running_loss += loss.item()
-                pred = torch.max(out, 1)[1]
-                total_samples += label.size(0)
-                corr = (pred == label)
-                correct += corr.double().sum().item()
-            elapsed = time.time() - start
-            accuracy = correct / total_samples * 100.
+        if rank == 0:
             print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
-                  (running_loss / total_batch, accuracy, elapsed / len(test_ds)))
+                  (result['loss'], result['accuracy'], elapsed / len(train_ds)))
 
-        dist.barrier()
+        model.eval()
+        metrics = RunningMetrics()
+        start = time.time()
+
+        for i, (batch, seq) in tqdm(enumerate(test_loader),
+                                    total=len(test_loader),
+                                    desc="Test: ",
+                                    disable=rank != 0):
+            batch, seq = batch.to(device), seq.to(device)
+            sample, label, bi = batch.x, batch.y, seq
+            with torch.no_grad(), autocast(device, args.precision):
+                out = model.module(sample, adj=adj, bi=bi, hops=hops)
+            metrics.update(loss_compute(out.float(), label.long()), out, label)
+        result = metrics.compute(distributed=True)
+        elapsed = time.time() - start
+        if rank == 0:
+            print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
+                  (result['loss'], result['accuracy'], elapsed / len(test_ds)))
 
     dist.destroy_process_group()
 
 
+def main():
+    """Runs ``--nproc_per_node`` training processes on this node (``--node_rank`` of
+    ``--nnodes``), e.g. on CPU-only nodes::
+
+        python train_dist.py --backend gloo --nproc_per_node 4
+        python train_dist.py --backend gloo --nproc_per_node 4 --nnodes 2 --node_rank <0|1> \\
+            --init_method tcp://<node 0>:12355
+    """
+    args = make_args()
+    if args.backend is None:
+        args.backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    nproc_per_node = args.nproc_per_node or (torch.cuda.device_count() if args.backend == 'nccl' else 1)
+    print('Let\'s use', nproc_per_node * args.nnodes, 'processes ({})!'.format(args.backend))
+    mp.spawn(run, args=(nproc_per_node, args), nprocs=nproc_per_node, join=True)
+
+
 if __name__ == '__main__':
-    world_size = torch.cuda.device_count()
-    print('Let\'s use', world_size, 'GPUs!')
-    mp.spawn(run, args=(world_size,), nprocs=world_size, join=True)
+    main()
@@ -12,6 +12,7 @@ from args import make_args
 from data.dataset3 import SkeletonDataset
 from models.net import DualGraphEncoder
 from optimizer import get_std_opt
+from utility.telemetry import GradientTelemetry
 
 
 class GCNTrainer(object):
@@ -31,6 +32,7 @@ class GCNTrainer(object):
         self.adj = self.adj.to(self.device)
         if self.log_dir is not None:
             self.writer = SummaryWriter(log_dir)
+            self.telemetry = GradientTelemetry(self.writer, self.model)
 
     def train(self, n_epochs):
 
@@ -57,18 +59,13 @@ class GCNTrainer(object):
                 loss.backward()
                 self.optimizer.step()
 
-                self.writer.add_scalar('train/train_loss', loss, i_acc + i + 1)
-
                 pred = torch.max(output, 1)[1]
                 results = pred == target
                 correct_points = torch.sum(results.long())
 
                 acc = correct_points.float() / results.size()[0]
-                self.writer.add_scalar('train/train_overall_acc', acc, i_acc + i + 1)
-
-                for name, param in self.model.named_parameters():
-                    if param.requires_grad and param.grad is not None:
-                        self.writer.add_scalar('gradients/' + name, param.grad.norm(2).item(), i + 1)
+                self.telemetry.snapshot(i_acc + i + 1, **{'train/train_loss': loss,
+                                                          'train/train_overall_acc': acc})
 
                 # log_str = 'epoch %d, step %d: train_loss %.3f; train_acc %.3f' % (epoch + 1, i + 1, loss, acc)
                 # log_str = 'epoch %d, step %d: train_loss %.3f' % (epoch + 1, i + 1, loss)
@@ -97,6 +94,7 @@ class GCNTrainer(object):
                 for param_group in self.optimizer.param_groups:
                     param_group['lr'] = param_group['lr'] * 0.5
 
+        self.telemetry.close()
         # export scalar data to JSON for external processing
         self.writer.export_scalars_to_json(self.log_dir + "/all_scalars.json")
         self.writer.close()
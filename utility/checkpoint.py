@@ -0,0 +1,226 @@
+import json
+import os
+import os.path as osp
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data.distributed import DistributedSampler
+
+__all__ = ['CheckpointManager', 'ResumableSampler', 'training_state', 'restore_training_state']
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffling sampler (of a shard of the dataset with ``num_replicas``) whose permutation
+    only depends on the seed and the epoch (``set_epoch``), and which can start in the middle
+    of an epoch (``state_dict`` / ``load_state_dict``) without loading the skipped samples."""
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        super(ResumableSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank,
+                                               shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.start = 0
+        super(ResumableSampler, self).set_epoch(epoch)
+
+    def __iter__(self):
+        return iter(list(super(ResumableSampler, self).__iter__())[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self, consumed=0):
+        """state after ``consumed`` more samples of the epoch (the last batch may be partial)"""
+        return {'epoch': self.epoch, 'seed': self.seed, 'start': min(self.start + consumed, self.num_samples)}
+
+    def load_state_dict(self, state):
+        self.epoch, self.seed, self.start = state['epoch'], state['seed'], state['start']
+
+
+def _rng_state():
+    # the numpy key as a tensor, the checkpoint only holds tensors and python values
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': (name, torch.from_numpy(key.astype(np.int64)), pos, has_gauss, cached_gaussian),
+             'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    name, key, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, key.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _unwrap(model):
+    return model.module if isinstance(model, (torch.nn.DataParallel,
+                                              torch.nn.parallel.DistributedDataParallel)) else model
+
+
+def training_state(model, optimizer, lr_scheduler=None, epoch=0, batch=0, sampler_state=None, **extra):
+    """Everything needed to resume the training after ``batch`` batches of ``epoch``: the model
+    (with the MaskPowerNorm counters), optimizer, scheduler, RNG states, ``sampler_state`` (e.g.
+    ResumableSampler.state_dict) and the host counters of the modules (e.g. the redraw steps of
+    the favor feature map), plus ``extra``. The tensors are not copied, see CheckpointManager.save."""
+    model = _unwrap(model)
+    state = {'epoch': epoch,
+             'batch': batch,
+             'model_state_dict': model.state_dict(),
+             'optimizer_state_dict': optimizer.state_dict(),
+             'rng_state': _rng_state(),
+             'counters': {name: m.steps for name, m in model.named_modules()
+                          if isinstance(getattr(m, 'steps', None), int)}}
+    if lr_scheduler is not None:
+        state['scheduler_state_dict'] = lr_scheduler.state_dict()
+    if sampler_state is not None:
+        state['sampler_state_dict'] = sampler_state
+    state.update(extra)
+    return state
+
+
+def restore_training_state(state, model, optimizer=None, lr_scheduler=None, sampler=None):
+    """Inverse of training_state, returns the epoch and the batches done in it"""
+    model = _unwrap(model)
+    model.load_state_dict(state['model_state_dict'])
+    if optimizer is not None:
+        optimizer.load_state_dict(state['optimizer_state_dict'])
+    if lr_scheduler is not None and 'scheduler_state_dict' in state:
+        lr_scheduler.load_state_dict(state['scheduler_state_dict'])
+    if sampler is not None and 'sampler_state_dict' in state:
+        sampler.load_state_dict(state['sampler_state_dict'])
+    modules = dict(model.named_modules())
+    for name, steps in state.get('counters', {}).items():
+        if name in modules:
+            modules[name].steps = steps
+    _set_rng_state(state['rng_state'])
+    return state['epoch'], state['batch']
+
+
+def _snapshot(obj):
+    """copy of the tensors of ``obj`` on the host (the training goes on modifying them)"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointManager(object):
+    """Checkpoints written by a background thread.
+
+    ``save`` copies the state to the host and returns, the thread writes it to a temporary file
+    renamed over root/name_<step>.pickle once complete (a checkpoint on disk is never partial).
+    The mid-epoch checkpoints are a rolling window of the last ``keep_last``; the end of epoch
+    ones (name_<epoch>.pickle, also read by load_checkpoint) are retained separately, the last
+    ``keep_epochs`` of them (None: all). The ``keep_best`` checkpoints of highest ``metric`` are
+    kept in any case. Their list is in root/name.json.
+
+    :param root: directory of the checkpoints
+    :param name: prefix of the files (e.g. args.save_name)
+    """
+
+    def __init__(self, root, name, keep_last=3, keep_best=1, keep_epochs=None):
+        self.root = root
+        self.name = name
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.keep_epochs = keep_epochs
+        os.makedirs(root, exist_ok=True)
+        self.index_path = osp.join(root, name + '.json')
+        self.checkpoints = []
+        if osp.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.checkpoints = [c for c in json.load(f) if osp.exists(c['path'])]
+        self.error = None
+        # a single checkpoint waits for the thread: save blocks if the previous one isn't written
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, name='CheckpointManager', daemon=True)
+        self._thread.start()
+
+    def save(self, state, step, metric=None, epoch=False):
+        """
+        :param state: e.g. training_state(...)
+        :param step: number of the checkpoint (e.g. the global optimizer step), in its file name
+        :param metric: the higher the better (e.g. the validation accuracy), for keep_best
+        :param epoch: an end of epoch checkpoint (``step`` the epoch), out of the keep_last window
+        """
+        if self.error is not None:
+            raise RuntimeError('the last checkpoint could not be written') from self.error
+        self._queue.put((_snapshot(state), step, metric, epoch))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, step, metric, epoch):
+        path = osp.join(self.root, '{}_{}.pickle'.format(self.name, step))
+        _atomic_save(state, path)
+        self.checkpoints = [c for c in self.checkpoints if c['path'] != path]
+        self.checkpoints.append({'path': path, 'step': step, 'metric': metric, 'epoch': epoch})
+        rolling = [c for c in self.checkpoints if not c.get('epoch', False)]
+        epochs = [c for c in self.checkpoints if c.get('epoch', False)]
+        keep = {c['path'] for c in rolling[-self.keep_last:]} if self.keep_last else set()
+        keep |= {c['path'] for c in (epochs if self.keep_epochs is None else
+                                     epochs[-self.keep_epochs:] if self.keep_epochs else [])}
+        ranked = sorted([c for c in self.checkpoints if c['metric'] is not None], key=lambda c: -c['metric'])
+        keep |= {c['path'] for c in ranked[:self.keep_best]}
+        for c in self.checkpoints:
+            if c['path'] not in keep and osp.exists(c['path']):
+                os.remove(c['path'])
+        self.checkpoints = [c for c in self.checkpoints if c['path'] in keep]
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.checkpoints, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def latest(self):
+        """path of the last checkpoint written, None if there is none"""
+        return self.checkpoints[-1]['path'] if self.checkpoints else None
+
+    def best(self):
+        ranked = sorted([c for c in self.checkpoints if c['metric'] is not None], key=lambda c: -c['metric'])
+        return ranked[0]['path'] if ranked else None
+
+    def load_latest(self, device='cpu'):
+        self.wait()
+        path = self.latest()
+        return torch.load(path, map_location=device) if path is not None else None
+
+    def wait(self):
+        """waits until the pending checkpoint is written"""
+        self._queue.join()
+        if self.error is not None:
+            raise RuntimeError('the last checkpoint could not be written') from self.error
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _atomic_save(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
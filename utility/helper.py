@@ -1,6 +1,8 @@
-import torch
+import contextlib
 import os.path as osp
 
+import torch
+
 
 def make_checkpoint(root, name, epoch, model, optimizer, loss):
     if not osp.exists(root):
@@ -22,3 +24,59 @@ def load_checkpoint(path, model, optimizer):
     loss = checkpoint['loss']
     return epoch, loss
 
+
+
+def load_model_state(path, device='cpu'):
+    """model_state_dict of a checkpoint, without the 'module.' prefix of (Distributed)DataParallel"""
+    state_dict = torch.load(path, map_location=device)['model_state_dict']
+    return {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+
+
+def autocast(device, precision='fp32'):
+    """Autocast context of the forward pass: with ``precision='bf16'`` the matmuls run in
+    bfloat16 (CPU or CUDA), the numerically sensitive parts of the model stay in float32.
+    """
+    device = torch.device(device)
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(precision == 'bf16'))
+
+
+class GradientAccumulator(object):
+    """Gradient accumulation over ``accum_steps`` micro-batches per optimizer step.
+
+    The loss of a micro-batch is divided by the number of micro-batches of its window (the
+    last window of an epoch may be shorter), and the gradients of a DistributedDataParallel
+    model are only all-reduced on the last micro-batch of a window (``no_sync`` on the others).
+
+    Example:
+        >>> accumulator = GradientAccumulator(model, args.accum_steps, len(data_loader))
+        >>> for i, batch in enumerate(data_loader):
+        >>>     with accumulator.sync(i):
+        >>>         accumulator.scale(loss_fn(model(batch), batch.y), i).backward()
+        >>>     if accumulator.is_step(i):
+        >>>         optimizer.step()
+        >>>         optimizer.zero_grad()
+    """
+
+    def __init__(self, model, accum_steps=1, num_batches=None):
+        assert accum_steps >= 1
+        self.model = model
+        self.accum_steps = accum_steps
+        self.num_batches = num_batches
+
+    def window(self, i):
+        """number of micro-batches of the window of the micro-batch i"""
+        if self.num_batches is None:
+            return self.accum_steps
+        return min(self.accum_steps, self.num_batches - i // self.accum_steps * self.accum_steps)
+
+    def is_step(self, i):
+        """whether the micro-batch i is the last one of its window"""
+        return (i + 1) % self.accum_steps == 0 or (self.num_batches is not None and i + 1 == self.num_batches)
+
+    def scale(self, loss, i):
+        return loss / self.window(i) if self.accum_steps > 1 else loss
+
+    def sync(self, i):
+        if isinstance(self.model, torch.nn.parallel.DistributedDataParallel) and not self.is_step(i):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
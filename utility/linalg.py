@@ -39,9 +39,9 @@ def softmax_(src: Tensor,
 
     :rtype: :class:`Tensor`
     """
-    out = src
+    out = src.float()  # kept in float32 under autocast
     if src.numel() > 0:
-        out = out - src.max()
+        out = out - out.max()
     out = out.exp()
 
     if index is not None:
@@ -71,6 +71,44 @@ def spmm_(indices, nz, m, n, dense, dim=-3):
     return scatter_add(out, rows, dim=dim, dim_size=m)
 
 
+def relational_adj(adj):
+    """Concatenates a list of adjacency matrices (one per relation, e.g. per head) to a single
+    edge list.
+
+    :param adj: list of LongTensor [2, num_edges_r]
+    :return: edge_index [2, num_edges] and edge_type [num_edges], the relation of every edge
+    """
+    edge_index = torch.cat(list(adj), dim=1)
+    counts = torch.tensor([a.shape[1] for a in adj], device=edge_index.device)
+    edge_type = torch.repeat_interleave(torch.arange(len(adj), device=edge_index.device), counts)
+    return edge_index, edge_type
+
+
+def relational_self_loops(edge_index, edge_type, num_nodes, num_relations):
+    """Removes the self loops of every relation and adds one loop per node and relation"""
+    keep = edge_index[0] != edge_index[1]
+    loops = torch.arange(num_nodes, device=edge_index.device).repeat(2, num_relations)
+    loop_type = torch.arange(num_relations, device=edge_index.device).repeat_interleave(num_nodes)
+    return torch.cat([edge_index[:, keep], loops], dim=1), torch.cat([edge_type[keep], loop_type])
+
+
+def relational_softmax(src, edge_index, edge_type, num_nodes, num_relations, dim=-1):
+    """softmax_ of the edge values ``src`` [..., num_edges] grouped by edge_index[1], separately
+    for every relation"""
+    return softmax_(src, edge_type * num_nodes + edge_index[1], num_nodes=num_relations * num_nodes, dim=dim)
+
+
+def relational_spmm(value, edge_index, edge_type, x, m, num_relations, dim=-2):
+    """Aggregation of all the relations at once: out[r * m + i] = sum over the edges (i, j) of
+    relation r of value * x[j], so out is [..., (num_relations m), channels] like batched_spmm.
+
+    :param value: Tensor [..., num_edges]
+    :param x: Tensor [..., num_nodes, channels], shared by the relations (not repeated)
+    """
+    rows = edge_type * m + edge_index[0]
+    return spmm_(torch.stack([rows, edge_index[1]]), value, num_relations * m, x.shape[dim], x, dim=dim)
+
+
 def batched_spmm(nzt, adj, x, m=None, n=None, dim=-2):
     """
     Args:
@@ -94,10 +132,11 @@ def batched_spmm(nzt, adj, x, m=None, n=None, dim=-2):
     else:  # adj is list of adjacency matrices
         assert heads == len(
             adj), "the number of heads and the number of adjacency matrices are not matched"
-        m = max([maybe_num_nodes(adj_[0], m) for adj_ in adj])
-        n = max([maybe_num_nodes(adj_[1], n) for adj_ in adj])
-        offset = torch.tensor([[m], [n]]).to(x.device)
-        adj_ = torch.cat([adj[k] + offset * k for k in range(heads)], dim=1)
+        edge_index, edge_type = relational_adj(adj)
+        m = maybe_num_nodes(edge_index[0], m)
+        n = max(num_nodes, maybe_num_nodes(edge_index[1], n))
+        offset = torch.tensor([[m], [n]], device=x.device)
+        adj_ = edge_index + offset * edge_type
     return spmm_(adj_, nzt_, heads * m, heads * n, x_, dim=dim)
 
 
@@ -113,14 +152,17 @@ def batched_transpose(adj, value, m=None, n=None):
         m = maybe_num_nodes(adj[0], m)
         n = maybe_num_nodes(adj[1], n)
         return transpose(adj, value, m, n)
-    else:  # adj is a list of Tensor
-        adj_ = [None] * value.shape[1]
-        vs = torch.zeros(value.shape)
-        m = max([maybe_num_nodes(a_[0], m) for a_ in adj])
-        n = max([maybe_num_nodes(a_[1], n) for a_ in adj])
-        for j in range(len(adj)):
-            adj_[j], vs[:, j] = transpose(adj[j], value[:, j], m, n)
-        return adj_, vs
+    else:  # adj is a list of Tensor (with the same number of edges), a single block diagonal transpose
+        heads = value.shape[1]
+        edge_index, edge_type = relational_adj(adj)
+        m = maybe_num_nodes(edge_index[0], m)
+        n = maybe_num_nodes(edge_index[1], n)
+        offset = torch.tensor([[m], [n]], device=value.device)
+        adj_, vs = transpose(edge_index + offset * edge_type, value.t().reshape(-1), heads * m, heads * n)
+        # the transposed edges are sorted by row, i.e. by relation first
+        adj_ = adj_.view(2, heads, -1) - offset.flip(0).unsqueeze(-1) * \
+            torch.arange(heads, device=value.device).view(1, -1, 1)
+        return list(adj_.unbind(dim=1)), vs.view(heads, -1).t()
 
 
 def transpose_(x, num_heads, reverse=False):
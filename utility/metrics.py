@@ -0,0 +1,91 @@
+import torch
+import torch.distributed as dist
+
+__all__ = ['RunningMetrics']
+
+
+class RunningMetrics(object):
+    """Running loss, top-k accuracy and confusion matrix of an epoch kept as device tensors.
+
+    ``update`` only launches kernels (no .item(), no loop over the samples), the values are
+    copied to the host by ``compute`` (after an all-reduce over the processes with
+    ``distributed``), e.g. once per epoch or log interval.
+
+    :param topk: the accuracies computed, e.g. (1, 5)
+    :param confusion: whether to keep the confusion matrix (labels x predictions)
+    """
+
+    def __init__(self, topk=(1,), confusion=False):
+        self.topk = tuple(topk)
+        self.confusion = confusion
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self._stats = None  # loss sum, samples, correct top-k
+        self._confusion = None
+
+    @torch.no_grad()
+    def update(self, loss, out, label):
+        """
+        :param loss: mean loss of the batch (0-dim tensor)
+        :param out: logits (batch, classes)
+        :param label: (batch)
+        """
+        if self._stats is None:
+            self._stats = torch.zeros(2 + len(self.topk), dtype=torch.float64, device=out.device)
+            if self.confusion:
+                self._confusion = torch.zeros(out.shape[-1] ** 2, dtype=torch.long, device=out.device)
+        label = label.long()
+        pred = out.topk(max(self.topk), dim=-1)[1]
+        correct = pred == label.unsqueeze(-1)  # (batch, k), at most one hit per row
+        hits = torch.stack([correct[:, :k].sum() for k in self.topk])
+        self._stats[0] += loss.detach().double()
+        self._stats[1] += label.shape[0]
+        self._stats[2:] += hits
+        if self._confusion is not None:
+            self._confusion += torch.bincount(label * out.shape[-1] + pred[:, 0], minlength=self._confusion.numel())
+        self.num_batches += 1
+
+    def all_reduce(self):
+        """sums the statistics of all the processes (every process must call it, and with
+        ``confusion`` have seen at least one batch)"""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        if self._stats is None:  # no batch in this process
+            device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else 'cpu'
+            self._stats = torch.zeros(2 + len(self.topk), dtype=torch.float64, device=device)
+        dist.all_reduce(self._stats)
+        if self._confusion is not None:
+            dist.all_reduce(self._confusion)
+        num_batches = torch.tensor([self.num_batches], device=self._stats.device)
+        dist.all_reduce(num_batches)
+        self.num_batches = int(num_batches.item())
+
+    def compute(self, distributed=False):
+        """
+        :return: dict of the mean loss per batch, the accuracies in % ('accuracy' for the top-1,
+                 'top<k>' otherwise) and the number of samples
+        """
+        if distributed:
+            self.all_reduce()
+        # no batch: zeros, with the same keys
+        stats = self._stats.tolist() if self._stats is not None else [0.] * (2 + len(self.topk))
+        samples = max(stats[1], 1)
+        result = {'loss': stats[0] / max(self.num_batches, 1), 'samples': int(stats[1])}
+        for k, hits in zip(self.topk, stats[2:]):
+            result['accuracy' if k == 1 else 'top%d' % k] = hits / samples * 100.
+        return result
+
+    def confusion_matrix(self):
+        """(labels, predictions) counts on the host"""
+        n = int(self._confusion.numel() ** 0.5)
+        return self._confusion.view(n, n).cpu()
+
+    def class_counts(self):
+        """samples, correct and wrong predictions of every class (lists), e.g. for the
+        distribution plots"""
+        confusion = self.confusion_matrix()
+        gt = confusion.sum(dim=1)
+        cr = confusion.diagonal()
+        return gt.tolist(), cr.tolist(), (gt - cr).tolist()
@@ -0,0 +1,127 @@
+import torch
+from torch.utils.data import DataLoader
+from torch_geometric.data import Batch
+
+
+class SequenceBatch(object):
+    """Metadata of a batch of variable-length frame sequences that are
+    concatenated along the frame dimension (PyG style batching).
+
+    It is built once per batch (ideally in the collate function, on the host)
+    so that the layers of the model do not have to rederive the same facts from
+    the batch index on every forward, e.g. with ``bi.max()`` or ``nonzero``
+    which force a host-device synchronization.
+
+    Attributes:
+        batch (LongTensor): sequence index of every frame      [total_frames]
+        offsets (LongTensor): index of the first frame of each sequence [B]
+        lengths (LongTensor): number of frames of each sequence  [B]
+        positions (LongTensor): position of every frame inside its sequence [total_frames]
+        rowptr (LongTensor): CSR pointer of the sequences       [B + 1]
+        max_length (int): length of the longest sequence (host value)
+        num_sequences (int): number of sequences B (host value)
+    """
+
+    def __init__(self, batch, offsets, lengths, positions, rowptr, max_length):
+        self.batch = batch
+        self.offsets = offsets
+        self.lengths = lengths
+        self.positions = positions
+        self.rowptr = rowptr
+        self.max_length = int(max_length)
+        self.num_sequences = lengths.shape[0]
+
+    @classmethod
+    def from_lengths(cls, lengths):
+        """
+        :param lengths: LongTensor [B], number of frames of each sequence
+        :return: SequenceBatch on the device of ``lengths``
+        """
+        lengths = lengths.long()
+        rowptr = torch.zeros(lengths.shape[0] + 1, dtype=torch.long, device=lengths.device)
+        torch.cumsum(lengths, dim=0, out=rowptr[1:])
+        offsets = rowptr[:-1]
+        batch = torch.repeat_interleave(torch.arange(lengths.shape[0], device=lengths.device), lengths)
+        positions = torch.arange(batch.shape[0], device=lengths.device) - offsets[batch]
+        max_length = int(lengths.max()) if lengths.numel() > 0 else 0
+        return cls(batch, offsets, lengths, positions, rowptr, max_length)
+
+    @classmethod
+    def from_batch_index(cls, bi, num_sequences=None):
+        """Builds the metadata from a (sorted) batch index. The lengths are
+        reduced on the host, so this costs a single synchronization when ``bi``
+        lives on an accelerator.
+        """
+        lengths = torch.bincount(bi.cpu(), minlength=num_sequences or 0)
+        return cls.from_lengths(lengths).to(bi.device)
+
+    @classmethod
+    def from_data(cls, data):
+        """Builds the metadata from a collated :class:`torch_geometric.data.Batch`."""
+        return cls.from_batch_index(data.batch, num_sequences=data.num_graphs)
+
+    def to(self, device, non_blocking=False):
+        return SequenceBatch(self.batch.to(device, non_blocking=non_blocking),
+                             self.offsets.to(device, non_blocking=non_blocking),
+                             self.lengths.to(device, non_blocking=non_blocking),
+                             self.positions.to(device, non_blocking=non_blocking),
+                             self.rowptr.to(device, non_blocking=non_blocking),
+                             self.max_length)
+
+    @property
+    def device(self):
+        return self.batch.device
+
+    @property
+    def padding_mask(self):
+        """BoolTensor [B, max_length], True on the padded positions of :meth:`pad`"""
+        positions = torch.arange(self.max_length, device=self.lengths.device)
+        return positions.unsqueeze(0) >= self.lengths.unsqueeze(-1)
+
+    def pad(self, x, dim=0, value=0.):
+        """Splits the frame dimension ``dim`` of ``x`` (total_frames) into [B, max_length],
+        the positions after the end of each sequence are filled with ``value``."""
+        x = x.movedim(dim, 0)
+        padded = x.new_full((self.num_sequences, self.max_length) + x.shape[1:], value)
+        padded[self.batch, self.positions] = x
+        return padded.movedim((0, 1), (dim, dim + 1))
+
+    def unpad(self, x, dim=0):
+        """Inverse of :meth:`pad`, concatenates the sequences of ``x`` [..., B, max_length, ...]"""
+        return x.movedim((dim, dim + 1), (0, 1))[self.batch, self.positions].movedim(0, dim)
+
+    def __len__(self):
+        return self.num_sequences
+
+    def __repr__(self):
+        return '{}(num_sequences={}, total_frames={}, max_length={})'.format(
+            self.__class__.__name__, self.num_sequences, self.batch.shape[0], self.max_length)
+
+
+def sequence_batch(bi):
+    """Returns ``bi`` as a :class:`SequenceBatch`, building it from a batch index if needed."""
+    if bi is None or isinstance(bi, SequenceBatch):
+        return bi
+    return SequenceBatch.from_batch_index(bi)
+
+
+class SequenceCollater(object):
+    def __init__(self, follow_batch=None):
+        self.follow_batch = follow_batch or []
+
+    def __call__(self, data_list):
+        batch = Batch.from_data_list(data_list, self.follow_batch)
+        lengths = torch.tensor([data.x.shape[0] for data in data_list], dtype=torch.long)
+        return batch, SequenceBatch.from_lengths(lengths)
+
+
+class SequenceDataLoader(DataLoader):
+    """Data loader merging skeleton sequences to a mini-batch. Every item is a
+    tuple ``(batch, seq)`` where ``seq`` is the :class:`SequenceBatch` of the
+    batch computed in the collate function (i.e. in the loader workers).
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, follow_batch=None, **kwargs):
+        kwargs.pop('collate_fn', None)
+        super(SequenceDataLoader, self).__init__(dataset, batch_size, shuffle,
+                                                 collate_fn=SequenceCollater(follow_batch), **kwargs)
@@ -0,0 +1,152 @@
+import os
+import os.path as osp
+import queue
+import threading
+
+import torch
+
+__all__ = ['GradientTelemetry', 'grad_flow_names']
+
+
+def grad_flow_names(name):
+    """parameters shown in the gradient flow plot (the weights, not the biases and norms)"""
+    return not (("bias" in name) or ("norm" in name) or ("bn" in name) or ("gain" in name) or ("dn" in name))
+
+
+class GradientTelemetry(object):
+    """Gradient and metrics logging which doesn't block the training step.
+
+    ``snapshot`` computes the L2 norm and the mean absolute value of all the gradients on
+    their device with two fused (``_foreach_norm``) reductions, and starts their copy to a
+    pinned host buffer together with the scalars of the step. A background thread waits for
+    the copy, writes the scalars to the SummaryWriter and renders the gradient flow plots.
+    When the thread falls behind by ``max_pending`` gradient snapshots, the gradients (and
+    plots) of the new ones are dropped (counted in ``dropped``) rather than stalling the step;
+    their scalars are always written.
+
+    :param writer: tensorboardX SummaryWriter (or None, only the plots)
+    :param model: the model, or its named_parameters()
+    :param plot_dir: directory of the gradient flow plots (None: no plot)
+    :param max_pending: gradient snapshots waiting for the background thread at most
+    """
+
+    def __init__(self, writer, model, plot_dir=None, max_pending=8):
+        named_parameters = model.named_parameters() if hasattr(model, 'named_parameters') else model
+        self.named_parameters = [(n, p) for n, p in named_parameters if p.requires_grad]
+        self.writer = writer
+        self.plot_dir = plot_dir
+        self.dropped = 0
+        self._numel = {}
+        self._queue = queue.Queue()
+        # gradient snapshots in the queue, released by the thread once written
+        self._slots = threading.Semaphore(max_pending)
+        # a buffer of the ring is reused once max_pending gradient snapshots are queued after it
+        # and the one being processed is done
+        self._buffers = [None] * (max_pending + 2)
+        self._next = 0
+        self._thread = threading.Thread(target=self._run, name='GradientTelemetry', daemon=True)
+        self._thread.start()
+
+    def _buffer(self, stats, ring=True):
+        if stats.device.type != 'cuda':
+            return stats.clone(), None
+        if ring:
+            buf = self._buffers[self._next]
+            if buf is None or buf.shape != stats.shape or buf.dtype != stats.dtype:
+                buf = self._buffers[self._next] = torch.empty(stats.shape, dtype=stats.dtype, pin_memory=True)
+            self._next = (self._next + 1) % len(self._buffers)
+        else:  # only scalars, not bounded by max_pending
+            buf = torch.empty(stats.shape, dtype=stats.dtype, pin_memory=True)
+        buf.copy_(stats, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(stats.device))
+        return buf, event
+
+    @torch.no_grad()
+    def snapshot(self, step, plot=False, grads=True, **scalars):
+        """Logs the gradient norms (if ``grads``) and ``scalars`` (floats or 0-dim tensors,
+        e.g. the loss, tags with '/' given as a dict ``**{'train/loss': loss}``) at ``step``,
+        and the gradient flow plot if ``plot``. Returns False if the gradients are dropped."""
+        slot = grads and self._slots.acquire(blocking=False)
+        if grads and not slot:
+            self.dropped += 1
+            plot = False
+        names = [n for n, p in self.named_parameters if p.grad is not None] if slot else []
+        tensors = [t.detach().reshape(1).float() for t in scalars.values() if torch.is_tensor(t)]
+        device = tensors[0].device if tensors else None
+        if names:
+            g = [p.grad for n, p in self.named_parameters if p.grad is not None]
+            device = g[0].device
+            key = (tuple(names), device)
+            if key not in self._numel:
+                self._numel = {key: torch.tensor([t.numel() for t in g], dtype=torch.float, device=device)}
+            numel = self._numel[key]
+            tensors += [torch.stack(torch._foreach_norm(g, 2)).float(),
+                        torch.stack(torch._foreach_norm(g, 1)).float() / numel]
+        stats, event = self._buffer(torch.cat([t.to(device) for t in tensors]), ring=slot) if tensors else (None, None)
+        self._queue.put_nowait((step, plot, names, scalars, stats, event, slot))
+        return slot or not grads
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item[:-1])
+            except Exception as e:  # the logging must not stop the training
+                print('GradientTelemetry: {}'.format(e))
+            finally:
+                if item is not None and item[-1]:
+                    self._slots.release()
+                self._queue.task_done()
+
+    def _write(self, step, plot, names, scalars, stats, event):
+        if event is not None:
+            event.synchronize()
+        values = stats.tolist() if stats is not None else []
+        k = 0
+        for tag, value in scalars.items():
+            if torch.is_tensor(value):
+                value, k = values[k], k + 1
+            if self.writer is not None:
+                self.writer.add_scalar(tag, value, step)
+        n = len(names)
+        norms, means = values[k:k + n], values[k + n:k + 2 * n]
+        if self.writer is not None:
+            for name, norm in zip(names, norms):
+                self.writer.add_scalar('gradients/' + name, norm, step)
+            if names:
+                self.writer.add_scalar('gradients/total_norm', sum(v * v for v in norms) ** 0.5, step)
+        if plot and self.plot_dir is not None:
+            layers = [(name, mean) for name, mean in zip(names, means) if grad_flow_names(name)]
+            self._plot(layers, step)
+
+    def _plot(self, layers, step):
+        # the object oriented API of matplotlib, pyplot is not thread safe
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.plot([mean for _, mean in layers], alpha=0.3, color="b")
+        ax.hlines(0, 0, len(layers) + 1, linewidth=1.5, color="k")
+        ax.set_xticks(range(len(layers)))
+        ax.set_xticklabels([name for name, _ in layers], rotation="vertical", fontsize=4)
+        ax.set_xlim(xmin=0, xmax=len(layers))
+        ax.set_xlabel("Layers")
+        ax.set_ylabel("average gradient")
+        ax.set_title("Gradient flow" + str(step))
+        ax.grid(True)
+        os.makedirs(self.plot_dir, exist_ok=True)
+        fig.savefig(osp.join(self.plot_dir, 'step_%d.png' % step), dpi=300)
+
+    def flush(self):
+        """waits until the pending snapshots are written"""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
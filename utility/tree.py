@@ -1,6 +1,13 @@
+import hashlib
+import os
+import os.path as osp
 import queue
+import tempfile
+
 import torch
 
+_hop_tables = {}
+
 class TreeNode: 
     def __init__(self, value, parent=None, children=None):
         self.value = value
@@ -123,3 +130,51 @@ def tree_encoding_from_traversal(onehot_length=7, device='cuda', max_padding=Non
         tree[i]._positional_encoding = get_padded_positional_encoding(tree[i], max_padding)
 
     return torch.Tensor([tree[i]._positional_encoding for i in range(len(tree))]).to(device)
+
+
+def hop_distance(edge_index, num_nodes=None):
+    """All pairs shortest path lengths (in hops) of an undirected graph, by a breadth first
+    search from every node at once (one boolean matrix product per hop).
+
+    :param edge_index: LongTensor [2, num_edges]
+    :return: LongTensor [num_nodes, num_nodes], num_nodes for the unreachable pairs
+    """
+    edge_index = edge_index.cpu()
+    n = num_nodes or int(edge_index.max()) + 1
+    adj = torch.zeros(n, n)
+    adj[edge_index[0], edge_index[1]] = 1.
+    adj = adj + adj.t()
+    reach = torch.eye(n, dtype=torch.bool)
+    dist = torch.full((n, n), n, dtype=torch.long)
+    dist[reach] = 0
+    for hop in range(1, n):
+        frontier = (torch.mm(reach.float(), adj) > 0) & ~reach
+        if not frontier.any():
+            break
+        dist[frontier] = hop
+        reach |= frontier
+    return dist
+
+
+def hop_table(edge_index, num_nodes=None, cache_dir=None):
+    """:func:`hop_distance` of a skeleton, computed once per topology and cached in memory
+    and, if ``cache_dir`` is given, on disk (``hops_<hash of the edges>.pt``)."""
+    edge_index = edge_index.cpu().long()
+    n = num_nodes or int(edge_index.max()) + 1
+    key = hashlib.sha1(edge_index.numpy().tobytes() + str(n).encode()).hexdigest()[:16]
+    if key in _hop_tables:
+        return _hop_tables[key]
+    path = osp.join(cache_dir, 'hops_{}.pt'.format(key)) if cache_dir else None
+    if path and osp.exists(path):
+        table = torch.load(path)
+    else:
+        table = hop_distance(edge_index, n)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            # a temporary file per writer: the ranks / workers may build the table at the same time
+            fd, tmp = tempfile.mkstemp(prefix='hops_{}.'.format(key), suffix='.tmp', dir=cache_dir)
+            os.close(fd)
+            torch.save(table, tmp)
+            os.replace(tmp, path)
+    _hop_tables[key] = table
+    return table
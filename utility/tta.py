@@ -0,0 +1,78 @@
+import itertools
+import math
+
+import torch
+
+from .sequence import SequenceBatch, sequence_batch
+
+__all__ = ['TestTimeAugmentation']
+
+
+class TestTimeAugmentation(object):
+    """Test-time augmentation in a single forward: every clip of a batch is expanded into K
+    deterministic views (centered temporal crops, rotated about the z axis), the views of all
+    the clips are concatenated into one ragged batch with their own sequences, and the logits of
+    the views of a clip are averaged.
+
+    The frames of a clip are those of its ``num_persons`` persons one after the other
+    ('(m f) n c'), every person is cropped the same. The rotation applies to every group of 3
+    channels (position, bone, motion vector: x, y rotated, z unchanged).
+
+    :param window_sizes: frames of the crops (per person), 0 for the whole clip; a clip shorter
+                         than a crop is taken whole
+    :param angles: rotations in degrees, K = len(window_sizes) * len(angles) views
+    """
+
+    def __init__(self, window_sizes=(75, 94, 112), angles=(0.,), num_persons=2):
+        views = list(itertools.product(window_sizes, angles))
+        self.window_sizes = torch.tensor([size for size, _ in views], dtype=torch.long)
+        self.angles = torch.tensor([angle for _, angle in views]) * math.pi / 180.
+        self.num_persons = num_persons
+        self.num_views = len(views)
+
+    def rotations(self, device=None):
+        """rotation matrices of the views about the z axis [K, 3, 3]"""
+        cos, sin = torch.cos(self.angles), torch.sin(self.angles)
+        zero, one = torch.zeros_like(cos), torch.ones_like(cos)
+        return torch.stack([cos, -sin, zero, sin, cos, zero, zero, zero, one], dim=-1).view(-1, 3, 3).to(device)
+
+    def expand(self, x, seq):
+        """
+        :param x: frames of the clips       [total_frames, joints, channels]
+        :param seq: SequenceBatch of the clips (B)
+        :return: frames of the views and their SequenceBatch (K * B sequences, view major: the
+                 view k of the clip b is the sequence k * B + b)
+        """
+        device = x.device
+        num_sequences = seq.num_sequences
+        frames = seq.lengths // self.num_persons                              # [B]
+        sizes = self.window_sizes.to(device).unsqueeze(-1)                  # [K, 1]
+        crop = torch.where(sizes > 0, torch.minimum(sizes, frames), frames)  # [K, B]
+        start = ((frames - crop) // 2).flatten()
+        crop = crop.flatten()
+        views = SequenceBatch.from_lengths(crop * self.num_persons)
+
+        j = views.batch
+        b = j % num_sequences
+        person, t = views.positions // crop[j], views.positions % crop[j]
+        x = x[seq.offsets[b] + person * frames[b] + start[j] + t]
+
+        if bool((self.angles != 0).any()):
+            if x.shape[-1] % 3 != 0:
+                raise ValueError('rotation of {} channels'.format(x.shape[-1]))
+            rotation = self.rotations(device).to(x.dtype)[j // num_sequences]  # [frames, 3, 3]
+            shape = x.shape
+            x = torch.einsum('fngc,fdc->fngd', x.view(shape[0], shape[1], -1, 3), rotation).reshape(shape)
+        return x, views
+
+    @torch.no_grad()
+    def __call__(self, model, x, bi, **kwargs):
+        """logits of the clips averaged over their views (B, classes), ``model(x, bi=..., **kwargs)``
+
+        :param bi: batch index or SequenceBatch of the clips, the views are given to the model
+                   the same way
+        """
+        seq = sequence_batch(bi)
+        x, views = self.expand(x, seq)
+        out = model(x, bi=views if isinstance(bi, SequenceBatch) else views.batch, **kwargs)
+        return out.view(self.num_views, seq.num_sequences, -1).mean(dim=0)
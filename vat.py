@@ -3,17 +3,23 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from models.powernorm import frozen_stats
+
 
 @contextlib.contextmanager
 def _disable_tracking_bn_stats(model):
-
-    def switch_attr(m):
-        if hasattr(m, 'track_running_stats'):
-            m.track_running_stats ^= True
-            
-    model.apply(switch_attr)
-    yield
-    model.apply(switch_attr)
+    """The BatchNorm and MaskPowerNorm layers of ``model`` normalize with the statistics of the
+    batch without updating their running statistics and counters."""
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    states = [m.track_running_stats for m in bns]
+    for m in bns:
+        m.track_running_stats = False
+    try:
+        with frozen_stats(model):
+            yield
+    finally:
+        for m, state in zip(bns, states):
+            m.track_running_stats = state
 
 
 def _l2_normalize(d):
@@ -35,29 +41,36 @@ class VATLoss(nn.Module):
         self.eps = eps
         self.ip = ip
 
-    def forward(self, model, x, **kwargs):
-        with torch.no_grad():
-            pred = F.softmax(model(x, **kwargs), dim=1)
+    def _adv_direction(self, model, x, pred, d, **kwargs):
+        # only the gradient of the input: no gradients of the parameters to compute and clear
+        d.requires_grad_()
+        logp_hat = F.log_softmax(model(x + self.xi * d, **kwargs), dim=1)
+        adv_distance = F.kl_div(logp_hat, pred, reduction='batchmean')
+        return _l2_normalize(torch.autograd.grad(adv_distance, d)[0])
+
+    def _lds(self, model, x, pred, d, **kwargs):
+        logp_hat = F.log_softmax(model(x + self.eps * d, **kwargs), dim=1)
+        return F.kl_div(logp_hat, pred, reduction='batchmean')
+
+    def forward(self, model, x, logits=None, **kwargs):
+        """
+        :param logits: output of the model for ``x`` if already computed (e.g. by the forward of
+                       the supervised loss), saves the clean forward
+        """
+        if logits is None:
+            with torch.no_grad():
+                logits = model(x, **kwargs)
+        pred = F.softmax(logits.detach(), dim=1)
 
         # prepare random unit tensor
-        d = torch.rand(x.shape).sub(0.5).to(x.device)
-        d = _l2_normalize(d)
+        d = _l2_normalize(torch.rand_like(x).sub_(0.5))
 
         with _disable_tracking_bn_stats(model):
             # calc adversarial direction
             for _ in range(self.ip):
-                d.requires_grad_()
-                pred_hat = model(x + self.xi * d, **kwargs)
-                logp_hat = F.log_softmax(pred_hat, dim=1)
-                adv_distance = F.kl_div(logp_hat, pred, reduction='batchmean')
-                adv_distance.backward()
-                d = _l2_normalize(d.grad)
-                model.zero_grad()
-    
+                d = self._adv_direction(model, x, pred, d, **kwargs)
+
             # calc LDS
-            r_adv = d * self.eps
-            pred_hat = model(x + r_adv, **kwargs)
-            logp_hat = F.log_softmax(pred_hat, dim=1)
-            lds = F.kl_div(logp_hat, pred, reduction='batchmean')
+            lds = self._lds(model, x, pred, d, **kwargs)
 
-        return lds
\ No newline at end of file
+        return lds
@@ -8,14 +8,17 @@ import numpy as np
 import torch
 import torch.nn as nn
 from tensorboardX import SummaryWriter
-from torch_geometric.data import DataLoader
 from tqdm import tqdm, trange
 
 from args import make_args
 from data.dataset3 import SkeletonDataset, skeleton_parts
 from models.net import DualGraphEncoder
 from optimizer import SGD_AGC, CosineAnnealingWarmupRestarts
-from utility.helper import make_checkpoint, load_checkpoint
+from models.powernorm import scale_warmup
+from utility.checkpoint import CheckpointManager, ResumableSampler, training_state, restore_training_state
+from utility.helper import load_checkpoint, GradientAccumulator
+from utility.metrics import RunningMetrics
+from utility.sequence import SequenceDataLoader
 from random import shuffle
 import imageio
 from vat import VATLoss
@@ -73,7 +76,8 @@ def run_epoch(data_loader,
               args=None,
               writer=None,
               epoch_num=0,
-              adj=None):
+              adj=None,
+              checkpoint=None):
     """Standard Training and Logging Function
 
         :param data_loader:
@@ -87,26 +91,27 @@ def run_epoch(data_loader,
         :param args:
         :param writer:
         :param epoch_num:
+        :param checkpoint: called with the number of batches done every args.save_interval
+                           optimizer steps, e.g. to save a mid-epoch checkpoint
 
     """
     # torch.autograd.set_detect_anomaly(True)
-    running_loss = 0.
-    accuracy = 0.
-    correct = 0
-    total_samples = 0
+    metrics = RunningMetrics()
     start = time.time()
     total_batch = len(dataset) // args.batch_size + 1
+    accumulator = GradientAccumulator(model, args.accum_steps, len(data_loader))
     gradflow_file_list = []
-    for i, batch in tqdm(enumerate(data_loader),
-                         total=total_batch,
-                         desc=desc):
-        batch = batch.to(device)
-        sample, label, bi = batch.x, batch.y, batch.batch
+    for i, (batch, seq) in tqdm(enumerate(data_loader),
+                                total=total_batch,
+                                desc=desc):
+        batch, seq = batch.to(device), seq.to(device)
+        sample, label, bi = batch.x, batch.y, seq
 
-        with torch.set_grad_enabled(is_train):
+        with torch.set_grad_enabled(is_train), accumulator.sync(i):
             out = model(sample, adj=adj, bi=bi)
             if vat_loss is not None:
-                lds = vat_loss(model, sample, adj=adj, bi=bi)
+                # the clean logits of the supervised loss are reused
+                lds = vat_loss(model, sample, logits=out, adj=adj, bi=bi)
             loss = loss_compute(out, label.long())
             loss_ = loss
             if is_train:
@@ -117,10 +122,15 @@ def run_epoch(data_loader,
                 #    if param.requires_grad:
                 #        loss += l2_lambda * torch.sum(((param)) ** 2)
                 
-                optimizer.zero_grad()
-                loss.backward()
+                if i % args.accum_steps == 0:
+                    optimizer.zero_grad()
+                accumulator.scale(loss, i).backward()
                 # torch.nn.utils.clip_grad_norm_(model.parameters(), 9.0)
-                optimizer.step()
+                if accumulator.is_step(i):
+                    optimizer.step()
+                    update = i // args.accum_steps
+                    if checkpoint is not None and args.save_interval and (update + 1) % args.save_interval == 0:
+                        checkpoint(i + 1)
                 if i % 400 == 0:
                     step = (i + 1) + total_batch * epoch_num
                     path = osp.join(os.getcwd(), 'gradflow')
@@ -136,10 +146,7 @@ def run_epoch(data_loader,
                 # writer.add_scalar('gradients/' + name, param.grad.norm(2).item(), (i + 1) + total_batch * epoch_num)
 
             # statistics
-            running_loss += loss_.item()
-            pred = torch.max(out, 1)[1]
-            total_samples += label.size(0)
-            correct += (pred == label).double().sum().item()
+            metrics.update(loss_, out, label)
     
     gif_path = osp.join(os.getcwd(), 'gif_gradlow')
     if not osp.exists(gif_path):
@@ -147,12 +154,13 @@ def run_epoch(data_loader,
     #gif_grad_flow(gradflow_file_list, gif_path, str(epoch_num))
     gradflow_file_list = []
 
+    result = metrics.compute()
     elapsed = time.time() - start
-    accuracy = correct / total_samples * 100.
+    accuracy = result['accuracy']
     print('\n------ loss: %.3f; accuracy: %.3f; average time: %.4f' %
-          (running_loss / total_batch, accuracy, elapsed / len(dataset)))
+          (result['loss'], accuracy, elapsed / len(dataset)))
 
-    return running_loss / total_batch, accuracy
+    return result['loss'], accuracy
 
 
 def main():
@@ -181,7 +189,7 @@ def main():
                               use_motion_vector=False,
                               benchmark='xsub', sample='val')
 
-    adj = skeleton_parts().to(device)
+    adj = skeleton_parts()[0].to(device)
 
     last_train = int(len(train_ds) * 0.8)
 
@@ -189,9 +197,9 @@ def main():
     # train_loader = DataLoader(train_ds.data,
     #                          batch_size=args.batch_size,
     #                          shuffle=True)
-    test_loader = DataLoader(test_ds,
-                             batch_size=args.batch_size,
-                             shuffle=True)
+    test_loader = SequenceDataLoader(test_ds,
+                                     batch_size=args.batch_size,
+                                     shuffle=True)
 
     # criterion = LabelSmoothing(V, padding_idx=dataset.pad_id, smoothing=0.1)
     # make_model black box
@@ -204,7 +212,7 @@ def main():
                              sequential=False,
                              num_conv_layers=args.num_conv_layers,
                              drop_rate=args.drop_rate)
-    model = model.to(device)
+    model = scale_warmup(model, args.accum_steps).to(device)
     # noam_opt = get_std_opt(model, args)
 
     optimizer = SGD_AGC(model.parameters(), lr=args.lr, momentum=0.9, weight_decay=0.0)
@@ -219,23 +227,49 @@ def main():
                                            model, optimizer)
         print("Load Model: ", last_epoch)
 
+    # checkpoints written in the background, the last and best ones are kept
+    checkpoints = CheckpointManager(args.save_root, args.save_name, args.keep_last, args.keep_best,
+                                    args.keep_epochs or None)
+    sampler_state = None
+    if args.resume and checkpoints.latest() is not None:
+        state = checkpoints.load_latest(device)
+        last_epoch, _ = restore_training_state(state, model, optimizer, lr_scheduler)
+        train_ds = train_ds[state['order']]
+        if state['batch'] > 0:  # mid-epoch: same split, the sampler skips the batches done
+            sampler_state = state['sampler_state_dict']
+        print("Resume: epoch {} batch {}".format(last_epoch, state['batch']))
+
     loss_compute = nn.CrossEntropyLoss().to(device)
     vat_loss = VATLoss(xi=10.0, eps=1.0, ip=1)
 
     for epoch in trange(last_epoch, args.epoch_num + last_epoch):
-        shuffled_list = [i for i in range(len(train_ds))]
-        shuffle(shuffled_list)
-        train_ds = train_ds[shuffled_list]
+        if sampler_state is None:
+            shuffled_list = [i for i in range(len(train_ds))]
+            shuffle(shuffled_list)
+            train_ds = train_ds[shuffled_list]
 
         train_ds_ = train_ds[:last_train]
         valid_ds_ = train_ds[last_train:]
 
-        train_loader = DataLoader(train_ds_,
-                                  batch_size=args.batch_size,
-                                  shuffle=True)
-        valid_loader = DataLoader(valid_ds_,
-                                  batch_size=args.batch_size,
-                                  shuffle=True)
+        train_sampler = ResumableSampler(train_ds_, seed=args.seed)
+        train_sampler.set_epoch(epoch)
+        if sampler_state is not None:
+            train_sampler.load_state_dict(sampler_state)
+            sampler_state = None
+        first_batch = train_sampler.start // args.batch_size
+
+        def save(batches):
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch, first_batch + batches,
+                                            sampler_state=train_sampler.state_dict(batches * args.batch_size),
+                                            order=train_ds.indices()),
+                             step='{}_{}'.format(epoch, first_batch + batches))
+
+        train_loader = SequenceDataLoader(train_ds_,
+                                          batch_size=args.batch_size,
+                                          sampler=train_sampler)
+        valid_loader = SequenceDataLoader(valid_ds_,
+                                          batch_size=args.batch_size,
+                                          shuffle=True)
 
         
         # print('Epoch: {} Training...'.format(epoch))
@@ -245,16 +279,14 @@ def main():
 
         loss, accuracy = run_epoch(train_loader, model, optimizer,
                                    loss_compute, vat_loss, train_ds_, device, is_train=True,
-                                   desc="Train Epoch {}".format(epoch + 1), args=args, writer=writer, epoch_num=epoch, adj=adj)
+                                   desc="Train Epoch {}".format(epoch + 1), args=args, writer=writer, epoch_num=epoch, adj=adj,
+                                   checkpoint=save)
         print('Epoch: {} Evaluating...'.format(epoch + 1))
 
         # TODO Save model
         writer.add_scalar('train/train_loss', loss, epoch + 1)
         writer.add_scalar('train/train_overall_acc', accuracy, epoch + 1)
 
-        if epoch % args.epoch_save == 0:
-            make_checkpoint(args.save_root, args.save_name, epoch, model, optimizer, loss)
-
         # Validation
         model.eval()
         loss, accuracy = run_epoch(valid_loader, model, optimizer,
@@ -267,6 +299,12 @@ def main():
         # if epoch > 15:
         lr_scheduler.step()
 
+        # save_name_<epoch>.pickle, also read by load_checkpoint (--load_model)
+        if epoch % args.epoch_save == 0:
+            checkpoints.save(training_state(model, optimizer, lr_scheduler, epoch + 1, 0,
+                                            order=train_ds.indices(), loss=loss),
+                             step=epoch, metric=accuracy, epoch=True)
+
         if epoch % 10 == 0:
             model.eval()
             loss, accuracy = run_epoch(test_loader, model, optimizer,
@@ -276,6 +314,7 @@ def main():
             writer.add_scalar('test/test_loss', loss, epoch + 1)
             writer.add_scalar('test/test_overall_acc', accuracy, epoch + 1)
 
+    checkpoints.close()
     writer.export_scalars_to_json(osp.join(args.log_dir, "all_scalars.json"))
     writer.close()
 